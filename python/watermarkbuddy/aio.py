@@ -0,0 +1,398 @@
+# stdlib modules
+from __future__ import absolute_import
+import io
+import os
+import json
+import time
+import asyncio
+
+# tool modules
+from watermarkbuddy import batch
+from watermarkbuddy import capabilities
+from watermarkbuddy import events
+from watermarkbuddy import incremental
+from watermarkbuddy import process
+from watermarkbuddy import watermarkbuddy
+
+# Asyncio counterparts of the watermarkbuddy functions, requiring Python 3.5+.
+# ffmpeg and ffprobe run as asyncio subprocesses, so waiting on them does not
+# tie up any thread. Only rare blocking steps, being the scale2ref detection
+# and scaling the watermark in a separate pass, run in the default executor.
+
+# amount of bytes to read from a subprocess pipe at once
+_CHUNK_SIZE = 64 * 1024
+
+
+# =============================================================================
+# private
+# =============================================================================
+async def _kill(proc):
+    """
+    Kills a subprocess, if still running, and waits for it to exit.
+
+    :param proc: subprocess to kill
+    :type proc: asyncio.subprocess.Process
+    """
+    if proc.returncode is None:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+
+
+async def _read(stream, write):
+    """
+    Passes the output of a subprocess pipe on until it is exhausted.
+
+    :param stream: pipe of the subprocess
+    :type stream: asyncio.StreamReader
+
+    :param write: function called with each chunk read
+    :type write: callable
+    """
+    while True:
+        chunk = await stream.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        write(chunk)
+
+
+async def _execute_cmd(args, timeout=None, capture=False):
+    """
+    Executes a command in an asyncio subprocess, see process.run.
+
+    Stderr is read as it is written, only keeping its last lines to report
+    errors with. On timeout or cancellation, the subprocess is killed before
+    the error is raised.
+
+    :param args: arguments representing the command to execute
+    :type args: list
+
+    :param timeout: maximum amount of seconds the command may run
+    :type timeout: float
+
+    :param capture: set True to return stdout, kept in memory as a whole
+    :type capture: bool
+
+    :raises RuntimeError: if an error occurred during the execution
+    :raises asyncio.TimeoutError: if the command did not complete in time
+
+    :return: stdout if captured, else empty
+    :rtype: bytes
+    """
+    events.emit("command", args=list(args))
+    proc = await asyncio.create_subprocess_exec(*args,
+                                                stdin=asyncio.subprocess.DEVNULL,
+                                                stdout=asyncio.subprocess.PIPE if capture else asyncio.subprocess.DEVNULL,
+                                                stderr=asyncio.subprocess.PIPE)
+    tail = process.Tail()
+    output = io.BytesIO()
+    readers = [_read(proc.stderr, tail.feed)]
+    if capture:
+        readers.append(_read(proc.stdout, output.write))
+    try:
+        await asyncio.wait_for(asyncio.gather(proc.wait(), *readers), timeout)
+    except BaseException:
+        await _kill(proc)
+        raise
+
+    if proc.returncode != 0:
+        msg = tail.get_text() or "exited with code {}".format(proc.returncode)
+        raise RuntimeError(msg)
+    return output.getvalue()
+
+
+async def _run_blocking(func, *args):
+    """
+    Runs a blocking function in the default executor.
+
+    :param func: function to run
+    :type func: callable
+
+    :param args: arguments to call the function with
+    :type args: tuple
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, func, *args)
+
+
+async def _get_scale2ref_expression(single_pass):
+    """
+    Returns the scale2ref expression to autoscale the watermark in one pass,
+    see watermarkbuddy._get_scale2ref_expression.
+
+    :param single_pass: True to require single pass, False to disable it,
+                        None to use it when supported by ffmpeg
+    :type single_pass: bool
+
+    :rtype: str
+    """
+    if single_pass is False:
+        return None
+    if capabilities.is_loaded():
+        # memoized, does not block
+        return watermarkbuddy._get_scale2ref_expression(single_pass)
+    return await _run_blocking(watermarkbuddy._get_scale2ref_expression, single_pass)
+
+
+async def _get_animation(input_file,
+                         watermark_file,
+                         windows,
+                         fade_in=None,
+                         fade_out=None,
+                         loop_watermark=False,
+                         probe_cache=None):
+    """
+    Returns the filters looping and fading the watermark, if requested, see
+    watermarkbuddy._get_animation. Counting the frames of the watermark runs
+    in the default executor.
+
+    :param input_file: file to add watermark to
+    :type input_file: str
+
+    :param watermark_file: file to use as watermark, before scaling
+    :type watermark_file: str
+
+    :param windows: start and end time of each window, see
+                    watermarkbuddy._get_windows
+    :type windows: list[tuple[float, float]]
+
+    :param fade_in: see watermarkbuddy.add_watermark
+    :type fade_in: float
+
+    :param fade_out: see watermarkbuddy.add_watermark
+    :type fade_out: float
+
+    :param loop_watermark: see watermarkbuddy.add_watermark
+    :type loop_watermark: bool
+
+    :param probe_cache: cache to reuse probed stream data from
+    :type probe_cache: watermarkbuddy.cache.ProbeCache
+
+    :return: filters, None to apply the watermark as is
+    :rtype: str
+    """
+    if not (loop_watermark or fade_in or fade_out):
+        return None
+    return await _run_blocking(watermarkbuddy._get_animation,
+                               input_file,
+                               watermark_file,
+                               windows,
+                               fade_in,
+                               fade_out,
+                               loop_watermark,
+                               probe_cache)
+
+
+async def _run_job(job, semaphore, timeout):
+    """
+    Executes a job, catching any error it raises, see batch.run_job.
+
+    :param job: job to execute
+    :type job: watermarkbuddy.batch.Job
+
+    :param semaphore: semaphore limiting the amount of concurrent ffmpeg runs
+    :type semaphore: asyncio.Semaphore
+
+    :param timeout: maximum amount of seconds each ffmpeg run may take
+    :type timeout: float
+
+    :rtype: watermarkbuddy.batch.JobResult
+    """
+    start = time.time()
+    error = None
+    tmp_output = None
+    try:
+        tmp_output = batch.make_tmp_output(job.output_file)
+        await add_watermark_async(job.input_file,
+                                  job.watermark_file,
+                                  tmp_output,
+                                  semaphore=semaphore,
+                                  timeout=timeout,
+                                  **job.options)
+        incremental.replace_file(tmp_output, job.output_file)
+    except asyncio.TimeoutError:
+        error = "timed out"
+    except asyncio.CancelledError:
+        # an Exception before Python 3.8, cancel the batch instead of failing
+        raise
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+    finally:
+        # left behind on failure or cancellation only
+        if tmp_output and os.path.exists(tmp_output):
+            os.remove(tmp_output)
+    return batch.JobResult(job, time.time() - start, error=error)
+
+
+# =============================================================================
+# public
+# =============================================================================
+async def get_stream_data_async(file_path, cache=None, timeout=None):
+    """
+    Gets the video stream data of a file without blocking the event loop.
+
+    :param file_path: file to read
+    :type file_path: str
+
+    :param cache: cache to reuse probed stream data from
+    :type cache: watermarkbuddy.cache.ProbeCache
+
+    :param timeout: maximum amount of seconds ffprobe may run
+    :type timeout: float
+
+    :raises asyncio.TimeoutError: if ffprobe did not complete in time
+
+    :rtype: dict
+    """
+    if cache is not None:
+        stream_data = cache.lookup(file_path)
+        if stream_data is not None:
+            return stream_data
+
+    stdout = await _execute_cmd(watermarkbuddy._get_probe_args(file_path), timeout, capture=True)
+    stream_data = json.loads(stdout.decode("utf-8"))["streams"][0]
+    if cache is not None:
+        cache.store(file_path, stream_data)
+    return stream_data
+
+
+async def add_watermark_async(input_file,
+                              watermark_file,
+                              output_file,
+                              autoscale=False,
+                              position="top-left",
+                              offset_x=0,
+                              offset_y=0,
+                              blend_mode="normal",
+                              cache=None,
+                              single_pass=None,
+                              probe_cache=None,
+                              backend="ffmpeg",
+                              profile=None,
+                              threads=None,
+                              start=None,
+                              end=None,
+                              windows=None,
+                              fade_in=None,
+                              fade_out=None,
+                              loop_watermark=False,
+                              semaphore=None,
+                              timeout=None):
+    """
+    Add a watermark to a file without blocking the event loop, see
+    watermarkbuddy.add_watermark for the watermark arguments.
+
+    Cancelling the task or exceeding the timeout kills the running ffmpeg.
+
+    :param semaphore: semaphore limiting the amount of concurrent ffmpeg runs,
+                      shared between calls
+    :type semaphore: asyncio.Semaphore
+
+    :param timeout: maximum amount of seconds each ffmpeg run may take,
+                    excluding the time waiting for the semaphore
+    :type timeout: float
+
+    :raises asyncio.TimeoutError: if ffmpeg did not complete in time
+    """
+    if not os.path.exists(input_file):
+        msg = "input file does not exist: {}"
+        raise ValueError(msg.format(input_file))
+
+    watermarkbuddy.validate_watermark(watermark_file, output_file, position, offset_x, offset_y, blend_mode)
+    watermarkbuddy.validate_backend(backend)
+    watermarkbuddy.validate_profile(profile)
+    watermarkbuddy.validate_timeline(start, end, windows, fade_in, fade_out, loop_watermark)
+    if backend != "ffmpeg":
+        raise ValueError("asyncio api only supports the ffmpeg backend")
+
+    windows = watermarkbuddy._get_windows(start, end, windows)
+
+    # a private semaphore does not limit anything
+    semaphore = semaphore or asyncio.Semaphore(1)
+    async with semaphore:
+        watermark = watermark_file
+        tmp_watermark = None
+        scale2ref = None
+        if autoscale:
+            scale2ref = await _get_scale2ref_expression(single_pass)
+            if not scale2ref:
+                stream_data = await get_stream_data_async(input_file, probe_cache, timeout)
+                watermark = await _run_blocking(watermarkbuddy._prescale_watermark,
+                                                stream_data,
+                                                watermark_file,
+                                                cache)
+                if cache is None:
+                    tmp_watermark = watermark
+
+        args = watermarkbuddy._get_watermark_args(input_file,
+                                                  watermark,
+                                                  output_file,
+                                                  autoscale,
+                                                  position,
+                                                  offset_x,
+                                                  offset_y,
+                                                  blend_mode,
+                                                  scale2ref,
+                                                  watermarkbuddy._get_encode_args(profile,
+                                                                                  input_file,
+                                                                                  output_file,
+                                                                                  threads),
+                                                  watermarkbuddy._get_windows_enable(windows),
+                                                  await _get_animation(input_file,
+                                                                       watermark_file,
+                                                                       windows,
+                                                                       fade_in,
+                                                                       fade_out,
+                                                                       loop_watermark,
+                                                                       probe_cache))
+        try:
+            await _execute_cmd(args, timeout)
+        finally:
+            if tmp_watermark:
+                os.remove(tmp_watermark)
+
+
+async def add_watermarks_async(jobs, concurrency=None, timeout=None, callback=None):
+    """
+    Executes watermark jobs concurrently, see batch.add_watermarks.
+
+    A failing or timed out job does not stop the batch, its error is stored on
+    its result. Cancelling the batch kills all running ffmpeg subprocesses.
+
+    :param jobs: jobs to execute
+    :type jobs: list[watermarkbuddy.batch.Job]
+
+    :param concurrency: maximum amount of concurrent ffmpeg runs, defaults to
+                        CPU count
+    :type concurrency: int
+
+    :param timeout: maximum amount of seconds each ffmpeg run may take
+    :type timeout: float
+
+    :param callback: function called with each JobResult once it completes
+    :type callback: callable
+
+    :rtype: watermarkbuddy.batch.BatchResult
+    """
+    concurrency = concurrency or batch.get_default_workers()
+    if concurrency < 1:
+        raise ValueError("invalid concurrency {!r}".format(concurrency))
+
+    start = time.time()
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [asyncio.ensure_future(_run_job(job, semaphore, timeout)) for job in jobs]
+    results = []
+    try:
+        for future in asyncio.as_completed(tasks):
+            result = await future
+            results.append(result)
+            if callback:
+                callback(result)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return batch.BatchResult(results, time.time() - start)
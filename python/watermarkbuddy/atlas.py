@@ -0,0 +1,387 @@
+# stdlib modules
+from __future__ import absolute_import
+import os
+import json
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+# tool modules
+from watermarkbuddy import batch
+from watermarkbuddy import cache
+from watermarkbuddy import watermarkbuddy
+
+# bump to invalidate atlases written by older releases
+_INDEX_VERSION = 1
+
+# file holding the watermark and the pre-rendered sizes of an atlas
+_INDEX_FNAME = "index.json"
+
+# directory of an atlas holding the sizes scaled down on demand
+_DERIVED_DNAME = "derived"
+
+
+# =============================================================================
+# classes
+# =============================================================================
+class WatermarkAtlas(object):
+    """
+    Watermark pre-rendered at a set of widths, stored in a directory along
+    with an index, see build_atlas.
+
+    The atlas can be passed as cache to add_watermark when autoscaling in a
+    separate pass. A pre-rendered size matching the input is used as is,
+    other sizes are scaled down from the nearest larger pre-rendered one and
+    cached next to the atlas. Other watermarks are scaled from their original
+    file, like watermarkbuddy.cache.WatermarkCache does.
+    """
+
+    def __init__(self, directory, tolerance=0, max_size=256 * 1024 * 1024):
+        """
+        Initializes the object.
+
+        :param directory: directory holding the atlas
+        :type directory: str
+
+        :param tolerance: maximum difference in width, in pixels, for a
+                          pre-rendered size to be used as is
+        :type tolerance: int
+
+        :param max_size: maximum total size of the sizes scaled on demand in
+                         bytes
+        :type max_size: int
+
+        :raises ValueError: if the directory does not hold an atlas
+        """
+        self.directory = directory
+        self.tolerance = tolerance
+        index = _load_index(directory)
+        if index is None:
+            raise ValueError("not a watermark atlas: {}".format(directory))
+        self.watermark_file = index["watermark"]["file"]
+        self.digest = index["watermark"]["digest"]
+        self.entries = index["entries"]
+        self._derived = cache.WatermarkCache(os.path.join(directory, _DERIVED_DNAME), max_size)
+
+    def _is_source(self, watermark_file):
+        """
+        Returns whether a file is the watermark the atlas was rendered from.
+
+        :param watermark_file: file to use as watermark
+        :type watermark_file: str
+
+        :rtype: bool
+        """
+        return self._derived._get_digest(watermark_file) == self.digest
+
+    def _find(self, width, sar):
+        """
+        Returns the pre-rendered size to use for a width, being the nearest
+        one within tolerance or else the nearest larger one.
+
+        :param width: width to scale the watermark to
+        :type width: int
+
+        :param sar: sample aspect ratio, formatted as num/den
+        :type sar: str
+
+        :return: entry of the index and whether it is used as is, entry None
+                 if no size is within tolerance or larger
+        :rtype: tuple[dict, bool]
+        """
+        entries = [entry for entry in self.entries if entry["sar"] == sar]
+        if entries:
+            nearest = min(entries, key=lambda entry: abs(entry["width"] - width))
+            if abs(nearest["width"] - width) <= self.tolerance:
+                return nearest, True
+
+        larger = [entry for entry in entries if entry["width"] > width]
+        if larger:
+            return min(larger, key=lambda entry: entry["width"]), False
+        return None, False
+
+    def get_widths(self):
+        """
+        Returns the pre-rendered widths and sample aspect ratios.
+
+        :rtype: list[tuple[int, str]]
+        """
+        return sorted((entry["width"], entry["sar"]) for entry in self.entries)
+
+    def get_scaled(self, watermark_file, width, sar):
+        """
+        Returns a version of the watermark scaled to a width, see
+        watermarkbuddy.cache.WatermarkCache.get_scaled.
+
+        :param watermark_file: file to use as watermark
+        :type watermark_file: str
+
+        :param width: width to scale the watermark to
+        :type width: int
+
+        :param sar: sample aspect ratio to set, formatted as num/den
+        :type sar: str
+
+        :rtype: str
+        """
+        if not self._is_source(watermark_file):
+            return self._derived.get_scaled(watermark_file, width, sar)
+
+        entry, exact = self._find(width, sar)
+        if entry is None:
+            # wider than all pre-rendered sizes, scale up the original
+            return self._derived.get_scaled(watermark_file, width, sar)
+
+        path = os.path.join(self.directory, entry["file"])
+        if exact:
+            return path
+        return self._derived.get_scaled(path, width, sar)
+
+
+# =============================================================================
+# private
+# =============================================================================
+def _load_index(directory):
+    """
+    Returns the index of an atlas.
+
+    :param directory: directory holding the atlas
+    :type directory: str
+
+    :return: index, None if the directory does not hold an atlas of this
+             release
+    :rtype: dict
+    """
+    try:
+        with open(os.path.join(directory, _INDEX_FNAME)) as fp:
+            index = json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
+    if index.get("version") != _INDEX_VERSION:
+        return None
+    return index
+
+
+def _save_index(directory, index):
+    """
+    Writes the index of an atlas, replacing the previous one atomically.
+
+    :param directory: directory holding the atlas
+    :type directory: str
+
+    :param index: index to write
+    :type index: dict
+    """
+    fp, tmp_path = tempfile.mkstemp(prefix=".index.", dir=directory)
+    try:
+        with os.fdopen(fp, "w") as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        replace = getattr(os, "replace", os.rename)
+        replace(tmp_path, os.path.join(directory, _INDEX_FNAME))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _get_fname(width, sar, ext):
+    """
+    Returns the file name of a pre-rendered size.
+
+    :param width: width of the watermark
+    :type width: int
+
+    :param sar: sample aspect ratio, formatted as num/den
+    :type sar: str
+
+    :param ext: file extension of the watermark
+    :type ext: str
+
+    :rtype: str
+    """
+    return "{}_{}{}".format(width, sar.replace("/", "-"), ext)
+
+
+def _render(watermark_file, directory, width, sar):
+    """
+    Renders a size of the watermark into an atlas.
+
+    :param watermark_file: file to use as watermark
+    :type watermark_file: str
+
+    :param directory: directory holding the atlas
+    :type directory: str
+
+    :param width: width to scale the watermark to
+    :type width: int
+
+    :param sar: sample aspect ratio to set, formatted as num/den
+    :type sar: str
+
+    :return: entry of the index
+    :rtype: dict
+    """
+    ext = os.path.splitext(watermark_file)[1]
+    fname = _get_fname(width, sar, ext)
+    fp, tmp_path = tempfile.mkstemp(prefix=".", suffix=ext, dir=directory)
+    os.close(fp)
+    try:
+        watermarkbuddy._scale_watermark(watermark_file, tmp_path, width, sar)
+        os.rename(tmp_path, os.path.join(directory, fname))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return {"width": width, "sar": sar, "file": fname}
+
+
+def _render_sizes(watermark_file, directory, sizes, workers=None):
+    """
+    Renders sizes of the watermark into an atlas concurrently.
+
+    :param watermark_file: file to use as watermark
+    :type watermark_file: str
+
+    :param directory: directory holding the atlas
+    :type directory: str
+
+    :param sizes: widths and sample aspect ratios to render
+    :type sizes: list[tuple[int, str]]
+
+    :param workers: maximum amount of concurrent renders, defaults to CPU count
+    :type workers: int
+
+    :return: entries of the index
+    :rtype: list[dict]
+    """
+    pool = ThreadPool(min(workers or batch.get_default_workers(), len(sizes)))
+    try:
+        return pool.map(lambda size: _render(watermark_file, directory, *size), sizes)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _get_index(watermark_file, directory):
+    """
+    Returns the index of the atlas of a watermark, starting a new one if the
+    directory holds no atlas or an atlas of another watermark.
+
+    :param watermark_file: file to use as watermark
+    :type watermark_file: str
+
+    :param directory: directory holding the atlas
+    :type directory: str
+
+    :rtype: dict
+    """
+    digest = cache.hash_file(watermark_file)
+    index = _load_index(directory)
+    if index is not None and index["watermark"]["digest"] == digest:
+        return index
+
+    if index is not None:
+        # remove the sizes of the previous watermark
+        for entry in index["entries"]:
+            os.remove(os.path.join(directory, entry["file"]))
+        cache.WatermarkCache(os.path.join(directory, _DERIVED_DNAME)).clear()
+    return {"version": _INDEX_VERSION,
+            "watermark": {"file": os.path.abspath(watermark_file), "digest": digest},
+            "entries": []}
+
+
+def _normalize_sizes(sizes):
+    """
+    Returns the distinct sizes to render, widths given without sample aspect
+    ratio defaulting to square pixels.
+
+    :param sizes: widths or widths and sample aspect ratios
+    :type sizes: list[int or tuple[int, str]]
+
+    :raises ValueError: if a width is invalid
+
+    :rtype: list[tuple[int, str]]
+    """
+    normalized = set()
+    for size in sizes:
+        width, sar = size if isinstance(size, (tuple, list)) else (size, "1/1")
+        if int(width) < 1:
+            raise ValueError("invalid atlas width {!r}".format(width))
+        normalized.add((int(width), sar.replace(":", "/")))
+    return sorted(normalized)
+
+
+# =============================================================================
+# public
+# =============================================================================
+def get_sizes(stream_data):
+    """
+    Returns the distinct widths and sample aspect ratios of probed files, as
+    used to autoscale a watermark to them.
+
+    :param stream_data: video stream data of the files, see
+                        watermarkbuddy.batch.probe_files
+    :type stream_data: list[dict]
+
+    :rtype: list[tuple[int, str]]
+    """
+    return sorted(set((int(data["width"]), data.get("sample_aspect_ratio", "1:1").replace(":", "/"))
+                      for data in stream_data))
+
+
+def collect_sizes(file_paths, probe_cache=None, workers=None):
+    """
+    Probes files and returns their distinct widths and sample aspect ratios,
+    see get_sizes. Files which cannot be probed are skipped.
+
+    :param file_paths: files to probe
+    :type file_paths: list[str]
+
+    :param probe_cache: cache to store the probed stream data in
+    :type probe_cache: watermarkbuddy.cache.ProbeCache
+
+    :param workers: maximum amount of concurrent probes, defaults to CPU count
+    :type workers: int
+
+    :rtype: list[tuple[int, str]]
+    """
+    stream_data, _ = batch.probe_files(file_paths, probe_cache, workers)
+    return get_sizes(stream_data.values())
+
+
+def build_atlas(watermark_file, directory, sizes, workers=None):
+    """
+    Pre-renders a watermark at a set of sizes into a directory, along with an
+    index, see WatermarkAtlas.
+
+    Sizes already rendered from the same watermark are kept. If the directory
+    holds an atlas of another watermark, it is replaced.
+
+    :param watermark_file: file to use as watermark
+    :type watermark_file: str
+
+    :param directory: directory to store the atlas in
+    :type directory: str
+
+    :param sizes: widths or widths and sample aspect ratios (num/den) to
+                  render, widths alone rendering square pixels
+    :type sizes: list[int or tuple[int, str]]
+
+    :param workers: maximum amount of concurrent renders, defaults to CPU count
+    :type workers: int
+
+    :raises ValueError: if the watermark does not exist or a width is invalid
+
+    :rtype: WatermarkAtlas
+    """
+    if not os.path.exists(watermark_file):
+        msg = "watermark file does not exist: {}"
+        raise ValueError(msg.format(watermark_file))
+    sizes = _normalize_sizes(sizes)
+    cache._makedirs(directory)
+
+    index = _get_index(watermark_file, directory)
+    rendered = set((entry["width"], entry["sar"]) for entry in index["entries"])
+    missing = [size for size in sizes if size not in rendered]
+    if missing:
+        entries = _render_sizes(watermark_file, directory, missing, workers)
+        index["entries"] = sorted(index["entries"] + entries, key=lambda e: (e["width"], e["sar"]))
+    _save_index(directory, index)
+    return WatermarkAtlas(directory)
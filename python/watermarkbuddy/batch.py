@@ -0,0 +1,597 @@
+# stdlib modules
+from __future__ import absolute_import
+import os
+import re
+import glob
+import time
+import shutil
+import tempfile
+import functools
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# tool modules
+from watermarkbuddy import cache
+from watermarkbuddy import events
+from watermarkbuddy import incremental
+from watermarkbuddy import process
+from watermarkbuddy import watermarkbuddy
+
+# umask of the process applied to the tmp outputs mkstemp creates owner-only,
+# read on first use, see _get_umask
+_UMASK = {}
+_UMASK_LOCK = threading.Lock()
+
+# seconds after which a tmp output no job is writing to anymore is removed,
+# being left behind by a process which got killed
+_STALE_TMP_AGE = 3600
+
+# names of tmp outputs generated by mkstemp, see make_tmp_output
+_TMP_OUTPUT_PATTERN = re.compile(r"^\..+\.[a-z0-9_]{8}(\.[^.]+)?$")
+
+# stale tmp outputs of each output directory, see _get_stale_tmp_outputs
+_STALE_TMP_OUTPUTS = {}
+_STALE_TMP_LOCK = threading.Lock()
+
+
+# =============================================================================
+# classes
+# =============================================================================
+class Job(object):
+    """Arguments of a single watermark operation."""
+
+    def __init__(self, input_file, watermark_file, output_file, **options):
+        """
+        Initializes the object.
+
+        :param input_file: file to add watermark to
+        :type input_file: str
+
+        :param watermark_file: file to use as watermark
+        :type watermark_file: str
+
+        :param output_file: output file path
+        :type output_file: str
+
+        :param options: keyword arguments passed to add_watermark
+        :type options: dict
+        """
+        self.input_file = input_file
+        self.watermark_file = watermark_file
+        self.output_file = output_file
+        self.options = options
+
+    def __repr__(self):
+        """Returns the representation of the object."""
+        return "Job({!r}, {!r}, {!r})".format(self.input_file,
+                                              self.watermark_file,
+                                              self.output_file)
+
+
+class JobResult(object):
+    """Outcome of a single watermark operation."""
+
+    def __init__(self, job, elapsed, error=None, skipped=False):
+        """
+        Initializes the object.
+
+        :param job: job which was executed
+        :type job: Job
+
+        :param elapsed: wall time of the job in seconds
+        :type elapsed: float
+
+        :param error: error message if the job failed
+        :type error: str
+
+        :param skipped: whether the job was skipped as its output is up to date
+        :type skipped: bool
+        """
+        self.job = job
+        self.elapsed = elapsed
+        self.error = error
+        self.skipped = skipped
+
+    @property
+    def succeeded(self):
+        """
+        Returns whether the job completed without error.
+
+        :rtype: bool
+        """
+        return self.error is None
+
+
+class BatchResult(object):
+    """Outcome of a batch of watermark operations."""
+
+    def __init__(self, results, elapsed):
+        """
+        Initializes the object.
+
+        :param results: results of all executed jobs
+        :type results: list[JobResult]
+
+        :param elapsed: wall time of the whole batch in seconds
+        :type elapsed: float
+        """
+        self.results = results
+        self.elapsed = elapsed
+
+    @property
+    def succeeded(self):
+        """
+        Returns the results of the jobs which completed without error.
+
+        :rtype: list[JobResult]
+        """
+        return [r for r in self.results if r.succeeded]
+
+    @property
+    def failed(self):
+        """
+        Returns the results of the jobs which failed.
+
+        :rtype: list[JobResult]
+        """
+        return [r for r in self.results if not r.succeeded]
+
+    @property
+    def skipped(self):
+        """
+        Returns the results of the jobs which were skipped.
+
+        :rtype: list[JobResult]
+        """
+        return [r for r in self.results if r.skipped]
+
+    @property
+    def throughput(self):
+        """
+        Returns the amount of processed files per second, skipped jobs
+        excluded.
+
+        :rtype: float
+        """
+        if not self.elapsed:
+            return 0.0
+        return (len(self.results) - len(self.skipped)) / self.elapsed
+
+
+# =============================================================================
+# private
+# =============================================================================
+def _read_umask():
+    """
+    Returns the umask of the process without changing it, as os.umask would
+    for a moment for every thread.
+
+    Reads it from /proc if available, else from the mode of a probe file.
+
+    :rtype: int
+    """
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("Umask:"):
+                    return int(line.split()[1], 8)
+    except (IOError, OSError, ValueError):
+        pass
+
+    directory = tempfile.mkdtemp(prefix="watermarkbuddy-umask-")
+    try:
+        path = os.path.join(directory, "probe")
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+        return 0o666 & ~os.stat(path).st_mode
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _get_umask():
+    """
+    Returns the umask of the process, read once.
+
+    :rtype: int
+    """
+    with _UMASK_LOCK:
+        if "umask" not in _UMASK:
+            _UMASK["umask"] = _read_umask()
+        return _UMASK["umask"]
+
+
+def _get_stale_tmp_outputs(directory):
+    """
+    Returns the names of the files of a directory which look like tmp outputs
+    left behind by a killed process, being those which were not written to
+    for _STALE_TMP_AGE seconds. Directories are listed once per process.
+
+    :param directory: directory of output files
+    :type directory: str
+
+    :rtype: set[str]
+    """
+    directory = os.path.abspath(directory)
+    with _STALE_TMP_LOCK:
+        if directory not in _STALE_TMP_OUTPUTS:
+            try:
+                fnames = os.listdir(directory)
+            except OSError:
+                fnames = []
+            stale = set()
+            now = time.time()
+            for fname in fnames:
+                if not _TMP_OUTPUT_PATTERN.match(fname):
+                    continue
+                try:
+                    if now - os.path.getmtime(os.path.join(directory, fname)) > _STALE_TMP_AGE:
+                        stale.add(fname)
+                except OSError:
+                    # removed by another process meanwhile
+                    pass
+            _STALE_TMP_OUTPUTS[directory] = stale
+        return _STALE_TMP_OUTPUTS[directory]
+
+
+def _remove_stale_tmp_outputs(output_file):
+    """
+    Removes the tmp outputs of an output file left behind by a killed process,
+    see _get_stale_tmp_outputs.
+
+    :param output_file: output file path
+    :type output_file: str
+    """
+    directory, fname = os.path.split(os.path.abspath(output_file))
+    base, ext = os.path.splitext(fname)
+    prefix = ".{}.".format(base)
+    stale = _get_stale_tmp_outputs(directory)
+    with _STALE_TMP_LOCK:
+        fnames = [name for name in stale
+                  if name.startswith(prefix) and name.endswith(ext) and len(name) == len(prefix) + 8 + len(ext)]
+        stale.difference_update(fnames)
+    for name in fnames:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+
+
+def _skip_up_to_date(jobs, manifest=None):
+    """
+    Splits jobs with an up to date output from the jobs to execute.
+
+    :param jobs: jobs to split
+    :type jobs: list[Job]
+
+    :param manifest: manifest to check outputs with
+    :type manifest: watermarkbuddy.incremental.Manifest
+
+    :return: results of the skipped jobs and the jobs to execute
+    :rtype: tuple[list[JobResult], list[Job]]
+    """
+    if manifest is None:
+        return [], jobs
+
+    skipped = []
+    pending = []
+    for job in jobs:
+        if manifest.is_up_to_date(job):
+            skipped.append(JobResult(job, 0.0, skipped=True))
+        else:
+            pending.append(job)
+    return skipped, pending
+
+
+def _map_jobs(jobs, workers, processes=False, callback=None, timeout=None, max_rss=None):
+    """
+    Executes jobs on a pool of workers.
+
+    :param jobs: jobs to execute
+    :type jobs: list[Job]
+
+    :param workers: maximum amount of concurrent jobs
+    :type workers: int
+
+    :param processes: set True to use a process pool instead of threads
+    :type processes: bool
+
+    :param callback: function called with each JobResult once it completes
+    :type callback: callable
+
+    :param timeout: maximum amount of seconds each job may run
+    :type timeout: float
+
+    :param max_rss: maximum resident memory of each ffmpeg process in bytes
+    :type max_rss: int
+
+    :rtype: list[JobResult]
+    """
+    results = []
+    if not jobs:
+        return results
+
+    execute = functools.partial(run_job, timeout=timeout, max_rss=max_rss)
+    pool_cls = multiprocessing.Pool if processes else ThreadPool
+    pool = pool_cls(min(workers, len(jobs)))
+    try:
+        for result in pool.imap_unordered(execute, jobs):
+            results.append(result)
+            if callback:
+                callback(result)
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return results
+
+
+def _expand_path(path):
+    """
+    Expands a file path, directory or glob pattern to the files it matches.
+
+    :param path: file path, directory or glob pattern
+    :type path: str
+
+    :raises ValueError: if the path does not match any file
+
+    :rtype: list[str]
+    """
+    if os.path.isfile(path):
+        return [path]
+
+    if os.path.isdir(path):
+        matches = [os.path.join(path, fname)
+                   for fname in sorted(os.listdir(path))
+                   if not fname.startswith(".")]
+    else:
+        matches = sorted(glob.glob(path))
+
+    matches = [m for m in matches if os.path.isfile(m)]
+    if not matches:
+        raise ValueError("no files found matching: {}".format(path))
+    return matches
+
+
+# =============================================================================
+# public
+# =============================================================================
+def get_default_workers():
+    """
+    Returns the default amount of workers, being the amount of CPUs.
+
+    :rtype: int
+    """
+    try:
+        count = os.cpu_count()
+    except AttributeError:
+        count = multiprocessing.cpu_count()
+    return count or 1
+
+
+def collect_files(paths):
+    """
+    Collects the files from a list of file paths, directories or glob patterns.
+
+    Directories are not traversed recursively and hidden files are ignored.
+
+    :param paths: file paths, directories or glob patterns
+    :type paths: list[str]
+
+    :raises ValueError: if a path does not match any file
+
+    :rtype: list[str]
+    """
+    files = []
+    seen = set()
+    for path in paths:
+        for match in _expand_path(path):
+            if match not in seen:
+                seen.add(match)
+                files.append(match)
+    return files
+
+
+def build_jobs(input_files, watermark_file, output_dir, **options):
+    """
+    Builds jobs writing each input file to the output directory.
+
+    :param input_files: files to add watermark to
+    :type input_files: list[str]
+
+    :param watermark_file: file to use as watermark
+    :type watermark_file: str
+
+    :param output_dir: directory to write the output files in
+    :type output_dir: str
+
+    :param options: keyword arguments passed to add_watermark
+    :type options: dict
+
+    :raises ValueError: if multiple input files share the same file name
+
+    :rtype: list[Job]
+    """
+    jobs = []
+    output_files = set()
+    for input_file in input_files:
+        output_file = os.path.join(output_dir, os.path.basename(input_file))
+        if output_file in output_files:
+            msg = "multiple input files would be written to: {}"
+            raise ValueError(msg.format(output_file))
+        output_files.add(output_file)
+        jobs.append(Job(input_file, watermark_file, output_file, **options))
+    return jobs
+
+
+def make_tmp_output(output_file):
+    """
+    Creates an empty tmp file next to an output file, to write it to before
+    renaming it to the output file once complete. Stale tmp files of the
+    same output left behind by a killed process are removed.
+
+    :param output_file: output file path
+    :type output_file: str
+
+    :rtype: str
+    """
+    output_dir, fname = os.path.split(output_file)
+    base, ext = os.path.splitext(fname)
+    _remove_stale_tmp_outputs(output_file)
+    fp, tmp_output = tempfile.mkstemp(prefix=".{}.".format(base),
+                                      suffix=ext,
+                                      dir=output_dir or None)
+    os.close(fp)
+    # outputs get the mode of a newly created file, not the one of mkstemp
+    os.chmod(tmp_output, 0o666 & ~_get_umask())
+    return tmp_output
+
+
+def run_job(job, timeout=None, max_rss=None):
+    """
+    Executes a job, catching any error it raises.
+
+    The output is written to a tmp file next to it, renamed once complete, so
+    an interrupted job never leaves a partial output behind.
+
+    :param job: job to execute
+    :type job: Job
+
+    :param timeout: maximum amount of seconds the job may run, see
+                    process.limits
+    :type timeout: float
+
+    :param max_rss: maximum resident memory of each ffmpeg process of the job
+                    in bytes, see process.limits
+    :type max_rss: int
+
+    :rtype: JobResult
+    """
+    start = time.time()
+    error = None
+    tmp_output = None
+    try:
+        tmp_output = make_tmp_output(job.output_file)
+        with process.limits(timeout, max_rss):
+            with events.context(input_file=job.input_file, output_file=job.output_file), events.stage("job"):
+                watermarkbuddy.add_watermark(job.input_file,
+                                             job.watermark_file,
+                                             tmp_output,
+                                             **job.options)
+        incremental.replace_file(tmp_output, job.output_file)
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+        if tmp_output and os.path.exists(tmp_output):
+            os.remove(tmp_output)
+    return JobResult(job, time.time() - start, error=error)
+
+
+def add_watermarks(jobs,
+                   workers=None,
+                   processes=False,
+                   callback=None,
+                   manifest=None,
+                   timeout=None,
+                   max_rss=None):
+    """
+    Executes watermark jobs concurrently on a pool of workers.
+
+    A failing job does not stop the batch, its error is stored on its result.
+    So does a job exceeding its limits, which gets killed.
+
+    :param jobs: jobs to execute
+    :type jobs: list[Job]
+
+    :param workers: maximum amount of concurrent jobs, defaults to CPU count
+    :type workers: int
+
+    :param processes: set True to use a process pool instead of threads
+    :type processes: bool
+
+    :param callback: function called with each JobResult once it completes
+    :type callback: callable
+
+    :param manifest: manifest to skip jobs with an up to date output with,
+                     updated with each succeeded job
+    :type manifest: watermarkbuddy.incremental.Manifest
+
+    :param timeout: maximum amount of seconds each job may run, None for no
+                    limit
+    :type timeout: float
+
+    :param max_rss: maximum resident memory of each ffmpeg process in bytes,
+                    None for no limit
+    :type max_rss: int
+
+    :rtype: BatchResult
+    """
+    jobs = list(jobs)
+    workers = workers or get_default_workers()
+    if workers < 1:
+        raise ValueError("invalid amount of workers {!r}".format(workers))
+
+    start = time.time()
+    results, jobs = _skip_up_to_date(jobs, manifest)
+    if callback:
+        for result in results:
+            callback(result)
+
+    def on_result(result):
+        if manifest is not None and result.succeeded:
+            manifest.update(result.job)
+        if callback:
+            callback(result)
+
+    try:
+        results.extend(_map_jobs(jobs, workers, processes, on_result, timeout, max_rss))
+    finally:
+        if manifest is not None:
+            manifest.save()
+
+    return BatchResult(results, time.time() - start)
+
+
+def probe_files(file_paths, probe_cache=None, workers=None):
+    """
+    Probes the video stream data of many files concurrently.
+
+    Warms the given probe cache, so the encode phase does not need to probe.
+
+    :param file_paths: files to probe
+    :type file_paths: list[str]
+
+    :param probe_cache: cache to store the probed stream data in
+    :type probe_cache: watermarkbuddy.cache.ProbeCache
+
+    :param workers: maximum amount of concurrent probes, defaults to CPU count
+    :type workers: int
+
+    :return: stream data and error messages, both keyed by file path
+    :rtype: tuple[dict[str, dict], dict[str, str]]
+    """
+    file_paths = list(file_paths)
+    if probe_cache is None:
+        probe_cache = cache.ProbeCache()
+
+    def probe(file_path):
+        try:
+            return file_path, probe_cache.get_stream_data(file_path), None
+        except Exception as e:
+            return file_path, None, str(e) or e.__class__.__name__
+
+    workers = min(workers or get_default_workers(), len(file_paths)) or 1
+    pool = ThreadPool(workers)
+    stream_data = {}
+    errors = {}
+    try:
+        for file_path, data, error in pool.imap_unordered(probe, file_paths):
+            if error is None:
+                stream_data[file_path] = data
+            else:
+                errors[file_path] = error
+    finally:
+        pool.close()
+        pool.join()
+    return stream_data, errors
@@ -0,0 +1,1087 @@
+# stdlib modules
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import itertools
+import tempfile
+import subprocess
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# tool modules
+from watermarkbuddy import batch
+from watermarkbuddy import capabilities
+from watermarkbuddy import process
+from watermarkbuddy import watermarkbuddy
+from watermarkbuddy import __version__
+
+# offsets of the parity suite, moving the watermark inwards and partly out of
+# the image
+_PARITY_OFFSETS = [(0, 0), (37, 21), (-45, -30)]
+
+# blend modes turning a rounding difference of one level into a large one, by
+# flipping bits or crossing a threshold, compared with a lower threshold
+_ROUNDING_SENSITIVE_MODES = ("and", "hardmix", "multiply128", "or", "xor")
+_ROUNDING_SENSITIVE_MARGIN = 10.0
+
+# directory holding this package, put on the path of the processes started
+# by the startup suite so they import the same release
+_PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# =============================================================================
+# private
+# =============================================================================
+def _percentile(values, percentile):
+    """
+    Returns the percentile of a list of values, using linear interpolation.
+
+    :param values: values to get the percentile of
+    :type values: list[float]
+
+    :param percentile: percentile to get, between 0 and 100
+    :type percentile: float
+
+    :rtype: float
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = (len(values) - 1) * percentile / 100.0
+    lower = int(index)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (index - lower)
+
+
+def _get_peak_rss():
+    """
+    Returns the peak resident set size of this process and of its children.
+
+    :return: peak RSS in kilobytes of self and children, None if unavailable
+    :rtype: dict
+    """
+    if resource is None:
+        return {"self_kb": None, "children_kb": None}
+    return {"self_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "children_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}
+
+
+def _generate_image(path, width, height):
+    """
+    Generates a synthetic still image using the ffmpeg testsrc source.
+
+    :param path: file path to write the image to
+    :type path: str
+
+    :param width: width of the image
+    :type width: int
+
+    :param height: height of the image
+    :type height: int
+    """
+    source = "testsrc=s={}x{}".format(width, height)
+    watermarkbuddy.execute_cmd(["ffmpeg", "-hide_banner", "-y",
+                                "-f", "lavfi", "-i", source,
+                                "-frames:v", "1",
+                                path])
+
+
+def _generate_video(path, width, height, duration):
+    """
+    Generates a synthetic video with audio using the ffmpeg testsrc source.
+
+    :param path: file path to write the video to
+    :type path: str
+
+    :param width: width of the video
+    :type width: int
+
+    :param height: height of the video
+    :type height: int
+
+    :param duration: duration of the video in seconds
+    :type duration: float
+    """
+    video = "testsrc=s={}x{}:d={}".format(width, height, duration)
+    audio = "sine=d={}".format(duration)
+    watermarkbuddy.execute_cmd(["ffmpeg", "-hide_banner", "-y",
+                                "-f", "lavfi", "-i", video,
+                                "-f", "lavfi", "-i", audio,
+                                "-pix_fmt", "yuv420p",
+                                "-shortest",
+                                path])
+
+
+def _generate_watermark(path, width, height):
+    """
+    Generates a synthetic semi transparent watermark.
+
+    :param path: file path to write the watermark to
+    :type path: str
+
+    :param width: width of the watermark
+    :type width: int
+
+    :param height: height of the watermark
+    :type height: int
+    """
+    source = "color=c=red@0.5:s={}x{},format=rgba".format(width, height)
+    watermarkbuddy.execute_cmd(["ffmpeg", "-hide_banner", "-y",
+                                "-f", "lavfi", "-i", source,
+                                "-frames:v", "1",
+                                path])
+
+
+def _generate_pattern_watermark(path, width, height):
+    """
+    Generates a synthetic semi transparent watermark using the ffmpeg testsrc
+    source, so misplaced pixels show up in comparisons.
+
+    :param path: file path to write the watermark to
+    :type path: str
+
+    :param width: width of the watermark
+    :type width: int
+
+    :param height: height of the watermark
+    :type height: int
+    """
+    source = "testsrc=s={}x{},format=rgba,colorchannelmixer=aa=0.6".format(width, height)
+    watermarkbuddy.execute_cmd(["ffmpeg", "-hide_banner", "-y",
+                                "-f", "lavfi", "-i", source,
+                                "-frames:v", "1",
+                                path])
+
+
+def _generate_animation(path, width, height, duration):
+    """
+    Generates a synthetic animated watermark using the ffmpeg testsrc source.
+
+    :param path: file path to write the animation to, e.g. a gif
+    :type path: str
+
+    :param width: width of the animation
+    :type width: int
+
+    :param height: height of the animation
+    :type height: int
+
+    :param duration: duration of the animation in seconds
+    :type duration: float
+    """
+    source = "testsrc=s={}x{}:r=10:d={}".format(width, height, duration)
+    watermarkbuddy.execute_cmd(["ffmpeg", "-hide_banner", "-y",
+                                "-f", "lavfi", "-i", source,
+                                path])
+
+
+def _generate_inputs(directory, resolutions, video_duration):
+    """
+    Generates the synthetic inputs to benchmark with.
+
+    :param directory: directory to write the inputs in
+    :type directory: str
+
+    :param resolutions: width and height of each input to generate
+    :type resolutions: list[tuple[int, int]]
+
+    :param video_duration: duration of the videos in seconds, 0 to skip videos
+    :type video_duration: float
+
+    :return: input files keyed by name
+    :rtype: dict[str, str]
+    """
+    inputs = {}
+    for width, height in resolutions:
+        name = "image_{}x{}".format(width, height)
+        path = os.path.join(directory, name + ".jpg")
+        _generate_image(path, width, height)
+        inputs[name] = path
+
+        if video_duration:
+            name = "video_{}x{}".format(width, height)
+            path = os.path.join(directory, name + ".mp4")
+            _generate_video(path, width, height, video_duration)
+            inputs[name] = path
+    return inputs
+
+
+def _measure_spawn_overhead(repeat=5):
+    """
+    Measures the wall time of spawning a no-op ffmpeg process.
+
+    :param repeat: amount of measurements
+    :type repeat: int
+
+    :return: median wall time in seconds
+    :rtype: float
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        watermarkbuddy.execute_cmd(["ffmpeg", "-version"])
+        timings.append(time.time() - start)
+    return _percentile(timings, 50)
+
+
+def _run_case(input_file, watermark_file, directory, batch_size, repeat, workers, options):
+    """
+    Benchmarks watermarking batches of a single input.
+
+    :param input_file: file to add watermark to
+    :type input_file: str
+
+    :param watermark_file: file to use as watermark
+    :type watermark_file: str
+
+    :param directory: directory to write the outputs in
+    :type directory: str
+
+    :param batch_size: amount of files per batch
+    :type batch_size: int
+
+    :param repeat: amount of batches to run
+    :type repeat: int
+
+    :param workers: maximum amount of concurrent jobs
+    :type workers: int
+
+    :param options: keyword arguments passed to add_watermark
+    :type options: dict
+
+    :return: measured metrics
+    :rtype: dict
+    """
+    ext = os.path.splitext(input_file)[1]
+    jobs = [batch.Job(input_file,
+                      watermark_file,
+                      os.path.join(directory, "out{}{}".format(i, ext)),
+                      **options)
+            for i in range(batch_size)]
+
+    # warm up imports, memoized probes and the page cache
+    batch.add_watermarks(jobs[:1], workers=1)
+
+    latencies = []
+    elapsed = 0.0
+    errors = []
+    for _ in range(repeat):
+        result = batch.add_watermarks(jobs, workers=workers)
+        elapsed += result.elapsed
+        latencies.extend(r.elapsed for r in result.succeeded)
+        errors.extend(r.error for r in result.failed)
+
+    files = batch_size * repeat
+    return {"files": files,
+            "errors": len(errors),
+            "error": errors[0] if errors else None,
+            "files_per_sec": files / elapsed if elapsed else 0.0,
+            "latency_p50": _percentile(latencies, 50),
+            "latency_p95": _percentile(latencies, 95)}
+
+
+def _get_pipeline_cases(namespace, inputs):
+    """
+    Returns the benchmark cases of the pipeline suite.
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :param inputs: input files keyed by name
+    :type inputs: dict[str, str]
+
+    :rtype: list[dict]
+    """
+    cases = []
+    product = itertools.product(sorted(inputs),
+                                namespace.backends,
+                                namespace.autoscale,
+                                namespace.positions,
+                                namespace.blend_modes,
+                                namespace.batch_sizes)
+    for name, backend, autoscale, position, blend_mode, batch_size in product:
+        if backend == "pillow" and not name.startswith("image"):
+            continue
+        if autoscale and position != namespace.positions[0]:
+            # position is ignored when autoscaling
+            continue
+        cases.append({"input": name,
+                      "batch_size": batch_size,
+                      "options": {"backend": backend,
+                                  "autoscale": autoscale,
+                                  "position": position,
+                                  "blend_mode": blend_mode}})
+    return cases
+
+
+def _setup_suite(namespace, directory):
+    """
+    Generates the synthetic inputs and watermark of a suite.
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :param directory: directory to write inputs and outputs in
+    :type directory: str
+
+    :return: input files keyed by name, watermark file and output directory
+    :rtype: tuple[dict[str, str], str, str]
+    """
+    inputs = _generate_inputs(directory, namespace.resolutions, namespace.video_duration)
+    watermark_file = os.path.join(directory, "watermark.png")
+    _generate_watermark(watermark_file, 320, 180)
+
+    output_dir = os.path.join(directory, "output")
+    os.mkdir(output_dir)
+    return inputs, watermark_file, output_dir
+
+
+def _measure_psnr(output_file, reference_file, region=None):
+    """
+    Measures the average PSNR of an output compared to a reference.
+
+    :param output_file: file to measure the quality of
+    :type output_file: str
+
+    :param reference_file: file to compare with
+    :type reference_file: str
+
+    :param region: x, y, width and height of the region to compare, None to
+                   compare the whole frame
+    :type region: tuple[int, int, int, int]
+
+    :return: average PSNR in dB, None if it could not be measured
+    :rtype: float
+    """
+    lavfi = "psnr"
+    if region is not None:
+        crop = "crop=x={}:y={}:w={}:h={}".format(*region)
+        lavfi = "[0:v]{crop}[output];[1:v]{crop}[reference];[output][reference]psnr".format(crop=crop)
+    args = ["ffmpeg", "-hide_banner",
+            "-i", output_file,
+            "-i", reference_file,
+            "-lavfi", lavfi,
+            "-f", "null", "-"]
+    # the psnr filter prints its summary to stderr on exit
+    tail = process.Tail()
+    try:
+        process.run(args, tail=tail)
+    except RuntimeError:
+        return None
+    match = re.search(r"average:([0-9.]+|inf)", tail.get_text())
+    return float(match.group(1)) if match else None
+
+
+def _run_profiles_suite(namespace, directory):
+    """
+    Benchmarks the encoding profiles, measuring the size and quality of the
+    outputs next to their throughput.
+
+    The PSNR is measured against the input, so it includes the difference
+    made by the watermark. Only compare it between profiles.
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :param directory: directory to write inputs and outputs in
+    :type directory: str
+
+    :return: results of each benchmark case
+    :rtype: list[dict]
+    """
+    inputs, watermark_file, output_dir = _setup_suite(namespace, directory)
+
+    results = []
+    for name in sorted(inputs):
+        for profile in [None] + watermarkbuddy.get_profiles():
+            case = {"input": name,
+                    "batch_size": namespace.batch_sizes[-1],
+                    "options": {"profile": profile}}
+            case.update(_run_case(inputs[name],
+                                  watermark_file,
+                                  output_dir,
+                                  case["batch_size"],
+                                  namespace.repeat,
+                                  namespace.workers,
+                                  case["options"]))
+
+            output_file = os.path.join(output_dir, "out0" + os.path.splitext(inputs[name])[1])
+            case["output_size"] = os.path.getsize(output_file)
+            case["psnr"] = _measure_psnr(output_file, inputs[name])
+            results.append(case)
+            _print_case(case)
+    return results
+
+
+def _run_stream_loop_case(input_file, watermark_file, output_file, repeat):
+    """
+    Benchmarks looping a watermark by demuxing it again with -stream_loop,
+    the reference add_watermark improves on by decoding it only once.
+
+    :param input_file: video to add watermark to
+    :type input_file: str
+
+    :param watermark_file: animated file to use as watermark
+    :type watermark_file: str
+
+    :param output_file: file path to write the output to
+    :type output_file: str
+
+    :param repeat: amount of runs
+    :type repeat: int
+
+    :return: measured metrics, see _run_case
+    :rtype: dict
+    """
+    # same filter graph as add_watermark, only looping the input instead
+    overlay = watermarkbuddy._get_overlay("top-left", offset_x=0, offset_y=0) + ":shortest=1"
+    args = ["ffmpeg", "-hide_banner", "-v", "error", "-y",
+            "-i", input_file,
+            "-stream_loop", "-1", "-i", watermark_file,
+            "-filter_complex", watermarkbuddy._get_filter_complex(overlay, "normal"),
+            output_file]
+    latencies = []
+    for _ in range(repeat):
+        start = time.time()
+        process.run(args)
+        latencies.append(time.time() - start)
+
+    elapsed = sum(latencies)
+    return {"files": repeat,
+            "errors": 0,
+            "error": None,
+            "files_per_sec": repeat / elapsed if elapsed else 0.0,
+            "latency_p50": _percentile(latencies, 50),
+            "latency_p95": _percentile(latencies, 95)}
+
+
+def _get_animation_inputs(namespace, directory):
+    """
+    Generates the videos of the animation suite, at the default duration and
+    four times as long to show how looping scales with the input.
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :param directory: directory to write the inputs in
+    :type directory: str
+
+    :return: input files and their duration in seconds, keyed by name
+    :rtype: dict[str, tuple[str, float]]
+    """
+    duration = namespace.video_duration or 2
+    inputs = {}
+    for (width, height), factor in itertools.product(namespace.resolutions, (1, 4)):
+        name = "video_{}x{}_{:g}s".format(width, height, duration * factor)
+        path = os.path.join(directory, name + ".mp4")
+        _generate_video(path, width, height, duration * factor)
+        inputs[name] = (path, duration * factor)
+    return inputs
+
+
+def _run_animation_suite(namespace, directory):
+    """
+    Benchmarks static and animated watermarks, looped and faded, next to
+    looping the watermark with -stream_loop.
+
+    Next to the throughput, cases report the median seconds spent per second
+    of input, which stays flat as the input gets longer if the watermark is
+    decoded only once.
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :param directory: directory to write inputs and outputs in
+    :type directory: str
+
+    :return: results of each benchmark case
+    :rtype: list[dict]
+    """
+    inputs = _get_animation_inputs(namespace, directory)
+    static_file = os.path.join(directory, "watermark.png")
+    _generate_watermark(static_file, 320, 180)
+    animated_file = os.path.join(directory, "watermark.gif")
+    _generate_animation(animated_file, 320, 180, 1)
+    output_dir = os.path.join(directory, "output")
+    os.mkdir(output_dir)
+
+    variants = [("static", static_file, {}),
+                ("anim", animated_file, {}),
+                ("anim", animated_file, {"loop_watermark": True}),
+                ("anim", animated_file, {"loop_watermark": True, "fade_in": 0.5, "fade_out": 0.5})]
+    results = []
+    for name in sorted(inputs):
+        input_file, duration = inputs[name]
+        for watermark_name, watermark_file, options in variants:
+            case = {"input": "{}+{}".format(name, watermark_name),
+                    "batch_size": 1,
+                    "options": options}
+            case.update(_run_case(input_file, watermark_file, output_dir, 1,
+                                  namespace.repeat, 1, options))
+            case["seconds_per_source_second"] = case["latency_p50"] / duration
+            results.append(case)
+            _print_case(case)
+
+        case = {"input": "{}+anim".format(name),
+                "batch_size": 1,
+                "options": {"stream_loop": True}}
+        case.update(_run_stream_loop_case(input_file, animated_file,
+                                          os.path.join(output_dir, "stream_loop.mp4"),
+                                          namespace.repeat))
+        case["seconds_per_source_second"] = case["latency_p50"] / duration
+        results.append(case)
+        _print_case(case)
+    return results
+
+
+def _get_parity_cases(namespace, blend_modes):
+    """
+    Returns the options of the cases of the parity suite.
+
+    Every blend mode is compared at the top-left corner, the blend modes to
+    benchmark are compared at every position, without offset, with offsets
+    moving the watermark inwards and partly out of the image, and autoscaled.
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :param blend_modes: blend modes supported by the pillow backend
+    :type blend_modes: list[str]
+
+    :rtype: list[dict]
+    """
+    cases = [{"blend_mode": blend_mode} for blend_mode in blend_modes]
+    for blend_mode in namespace.blend_modes:
+        if blend_mode not in blend_modes:
+            continue
+        geometries = itertools.product(watermarkbuddy.get_positions(), _PARITY_OFFSETS)
+        for position, (offset_x, offset_y) in geometries:
+            if position == "top-left" and not offset_x and not offset_y:
+                # already compared with every blend mode
+                continue
+            cases.append({"blend_mode": blend_mode,
+                          "position": position,
+                          "offset_x": offset_x,
+                          "offset_y": offset_y})
+        cases.append({"blend_mode": blend_mode, "autoscale": True})
+    return cases
+
+
+def _get_watermark_region(options, size, watermark_size):
+    """
+    Returns the region of an image the watermark is placed in, so misplaced
+    watermarks are not averaged out over the whole image.
+
+    :param options: keyword arguments passed to add_watermark
+    :type options: dict
+
+    :param size: width and height of the image
+    :type size: tuple[int, int]
+
+    :param watermark_size: width and height of the watermark
+    :type watermark_size: tuple[int, int]
+
+    :return: x, y, width and height of the region, clipped to the image
+    :rtype: tuple[int, int, int, int]
+    """
+    width, height = watermark_size
+    x, y = options.get("offset_x", 0), options.get("offset_y", 0)
+    if options.get("autoscale"):
+        width, height = size[0], int(round(size[0] * height / width))
+        x, y = 0, 0
+    else:
+        position = options.get("position", "top-left")
+        if position.endswith("right"):
+            x = size[0] - width - x
+        if position.startswith("bottom"):
+            y = size[1] - height - y
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + width, size[0]), min(y + height, size[1])
+    return left, top, right - left, bottom - top
+
+
+def _run_parity_suite(namespace, directory):
+    """
+    Compares the outputs of the pillow backend with the ones of the ffmpeg
+    backend for each blend mode the pillow backend supports, as well as for
+    each position, offset and autoscale, see _get_parity_cases.
+
+    Cases report the PSNR of the pillow output against the ffmpeg output, of
+    the whole image and of the region of the watermark, next to the
+    throughput of the pillow backend. Cases fail parity if either PSNR is
+    below the parity threshold, lowered for rounding sensitive blend modes.
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :param directory: directory to write inputs and outputs in
+    :type directory: str
+
+    :return: results of each benchmark case
+    :rtype: list[dict]
+    """
+    # imported on first use, as it loads numpy and Pillow
+    from watermarkbuddy import compositor
+
+    # odd size, so rounding differences in placing and scaling show up
+    watermark_file = os.path.join(directory, "watermark.png")
+    watermark_size = (161, 91)
+    _generate_pattern_watermark(watermark_file, *watermark_size)
+    output_dir = os.path.join(directory, "output")
+    os.mkdir(output_dir)
+    reference_file = os.path.join(directory, "reference.jpg")
+
+    results = []
+    for width, height in namespace.resolutions:
+        name = "image_{}x{}".format(width, height)
+        input_file = os.path.join(directory, name + ".jpg")
+        _generate_image(input_file, width, height)
+
+        for options in _get_parity_cases(namespace, compositor.get_blend_modes()):
+            case = {"input": name,
+                    "batch_size": 1,
+                    "options": dict(options, backend="pillow")}
+            case.update(_run_case(input_file, watermark_file, output_dir, 1,
+                                  namespace.repeat, 1, case["options"]))
+
+            watermarkbuddy.add_watermark(input_file, watermark_file, reference_file, **options)
+            output_file = os.path.join(output_dir, "out0.jpg")
+            region = _get_watermark_region(options, (width, height), watermark_size)
+            case["psnr"] = _measure_psnr(output_file, reference_file)
+            case["region_psnr"] = _measure_psnr(output_file, reference_file, region)
+            threshold = namespace.parity_threshold
+            if options["blend_mode"] in _ROUNDING_SENSITIVE_MODES:
+                threshold -= _ROUNDING_SENSITIVE_MARGIN
+            case["parity"] = all(psnr is not None and psnr >= threshold
+                                 for psnr in (case["psnr"], case["region_psnr"]))
+            results.append(case)
+            _print_case(case)
+    return results
+
+
+def _find_script(name):
+    """
+    Returns the path of a script of this package, searching PATH first and
+    the bin directory of a source checkout second.
+
+    :param name: name of the script
+    :type name: str
+
+    :return: path of the script, None if not found
+    :rtype: str
+    """
+    path = capabilities._which(name)
+    if path is not None:
+        return path
+    path = os.path.join(os.path.dirname(_PACKAGE_ROOT), "bin", name)
+    return path if os.path.isfile(path) else None
+
+
+def _parse_importtime(output, limit=10):
+    """
+    Parses the report of python -X importtime.
+
+    :param output: standard error of the python process
+    :type output: str
+
+    :param limit: amount of imports to return
+    :type limit: int
+
+    :return: top level imports and their cumulative time in milliseconds,
+             slowest first
+    :rtype: list[tuple[str, float]]
+    """
+    imports = []
+    for match in re.finditer(r"^import time:\s+\d+ \|\s+(\d+) \| (\S+)$", output, re.MULTILINE):
+        imports.append((match.group(2), int(match.group(1)) / 1000.0))
+    return sorted(imports, key=lambda item: -item[1])[:limit]
+
+
+def _get_python_env():
+    """
+    Returns the environment of the python processes of the startup suite,
+    importing this package from the same directory as this process.
+
+    :rtype: dict[str, str]
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [_PACKAGE_ROOT, env.get("PYTHONPATH")]))
+    return env
+
+
+def _time_command(args, repeat):
+    """
+    Measures the wall time of starting a python process, after a warm up run
+    writing its bytecode and filling the page cache.
+
+    :param args: arguments passed to the python interpreter
+    :type args: list[str]
+
+    :param repeat: amount of measurements
+    :type repeat: int
+
+    :return: wall time of each measurement in seconds
+    :rtype: list[float]
+    """
+    env = _get_python_env()
+    timings = []
+    with open(os.devnull, "w") as devnull:
+        for i in range(repeat + 1):
+            start = time.time()
+            subprocess.check_call([sys.executable] + args, stdout=devnull, env=env)
+            if i:
+                timings.append(time.time() - start)
+    return timings
+
+
+def _get_import_report(args):
+    """
+    Returns the slowest top level imports of a python process.
+
+    :param args: arguments passed to the python interpreter
+    :type args: list[str]
+
+    :rtype: list[tuple[str, float]]
+    """
+    proc = subprocess.Popen([sys.executable, "-X", "importtime"] + args,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            env=_get_python_env())
+    _, stderr = proc.communicate()
+    return _parse_importtime(stderr.decode("utf-8", "replace"))
+
+
+def _get_startup_commands(directory):
+    """
+    Returns the commands of the startup suite, skipping scripts which are
+    not found.
+
+    :param directory: directory to write the inputs and outputs in
+    :type directory: str
+
+    :return: name and python arguments of each command
+    :rtype: list[tuple[str, list[str]]]
+    """
+    commands = [("python", ["-c", "pass"]),
+                ("import watermarkbuddy", ["-c", "from watermarkbuddy import watermarkbuddy"])]
+    cli = _find_script("watermarkbuddy-cli")
+    if cli is not None:
+        input_file = os.path.join(directory, "image.png")
+        watermark_file = os.path.join(directory, "watermark.png")
+        _generate_image(input_file, 64, 64)
+        _generate_watermark(watermark_file, 16, 16)
+        commands.append(("watermarkbuddy-cli --help", [cli, "--help"]))
+        commands.append(("watermarkbuddy-cli image", [cli,
+                                                      "-i", input_file,
+                                                      "-w", watermark_file,
+                                                      "-o", os.path.join(directory, "output.png")]))
+    client = _find_script("watermarkbuddy-client")
+    if client is not None:
+        commands.append(("watermarkbuddy-client --help", [client, "--help"]))
+    return commands
+
+
+def _run_startup_suite(namespace, directory):
+    """
+    Benchmarks the cold start of the command line interfaces, as paid by
+    every asset when an orchestrator runs a process per asset.
+
+    Each command reports its wall time, its overhead over starting a bare
+    interpreter and its slowest top level imports, see python -X importtime.
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :param directory: directory to write inputs and outputs in
+    :type directory: str
+
+    :return: results of each benchmark case
+    :rtype: list[dict]
+    """
+    results = []
+    baseline = None
+    for name, args in _get_startup_commands(directory):
+        timings = _time_command(args, namespace.repeat)
+        case = {"input": name,
+                "batch_size": 1,
+                "options": {},
+                "files": len(timings),
+                "errors": 0,
+                "error": None,
+                "files_per_sec": len(timings) / sum(timings),
+                "latency_p50": _percentile(timings, 50),
+                "latency_p95": _percentile(timings, 95),
+                "imports": _get_import_report(args)}
+        if baseline is None:
+            baseline = case["latency_p50"]
+        case["overhead_p50"] = case["latency_p50"] - baseline
+        results.append(case)
+        _print_case(case)
+    return results
+
+
+def _run_pipeline_suite(namespace, directory):
+    """
+    Benchmarks add_watermark over inputs, settings and batch sizes.
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :param directory: directory to write inputs and outputs in
+    :type directory: str
+
+    :return: results of each benchmark case
+    :rtype: list[dict]
+    """
+    inputs, watermark_file, output_dir = _setup_suite(namespace, directory)
+
+    results = []
+    for case in _get_pipeline_cases(namespace, inputs):
+        metrics = _run_case(inputs[case["input"]],
+                            watermark_file,
+                            output_dir,
+                            case["batch_size"],
+                            namespace.repeat,
+                            namespace.workers,
+                            case["options"])
+        case.update(metrics)
+        results.append(case)
+        _print_case(case)
+    return results
+
+
+def _print_case(case):
+    """
+    Prints a one line summary of a benchmark case to stderr.
+
+    :param case: benchmark case and its metrics
+    :type case: dict
+    """
+    settings = " ".join("{}={}".format(k, v) for k, v in sorted(case["options"].items()))
+    msg = "{:<24} batch={:<4} {:<60} {:>8.2f} files/s p50={:.3f}s p95={:.3f}s errors={}"
+    print(msg.format(case["input"],
+                     case["batch_size"],
+                     settings,
+                     case["files_per_sec"],
+                     case["latency_p50"],
+                     case["latency_p95"],
+                     case["errors"]), file=sys.stderr)
+
+
+def _compare(results, baseline, tolerance):
+    """
+    Returns the cases whose throughput regressed compared to a baseline.
+
+    :param results: benchmark cases and their metrics
+    :type results: list[dict]
+
+    :param baseline: benchmark cases and their metrics of a previous run
+    :type baseline: list[dict]
+
+    :param tolerance: allowed relative drop of throughput
+    :type tolerance: float
+
+    :rtype: list[dict]
+    """
+    def key(case):
+        return json.dumps([case["suite"], case["input"], case["batch_size"], case["options"]],
+                          sort_keys=True)
+
+    previous = dict((key(case), case) for case in baseline)
+    regressions = []
+    for case in results:
+        before = previous.get(key(case))
+        if before is None or not before["files_per_sec"]:
+            continue
+        ratio = case["files_per_sec"] / before["files_per_sec"]
+        if ratio < 1.0 - tolerance:
+            regressions.append({"case": case, "baseline": before, "ratio": ratio})
+    return regressions
+
+
+def _parse_resolution(value):
+    """
+    Parses a WIDTHxHEIGHT resolution.
+
+    :param value: resolution to parse
+    :type value: str
+
+    :rtype: tuple[int, int]
+    """
+    try:
+        width, height = value.lower().split("x")
+        return int(width), int(height)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid resolution {!r}".format(value))
+
+
+def _parse_bool(value):
+    """
+    Parses an on/off boolean.
+
+    :param value: boolean to parse
+    :type value: str
+
+    :rtype: bool
+    """
+    value = value.lower()
+    if value not in ("on", "off"):
+        raise argparse.ArgumentTypeError("invalid value {!r}, use on or off".format(value))
+    return value == "on"
+
+
+# benchmark suites, keyed by name
+_SUITES = {"pipeline": _run_pipeline_suite,
+           "profiles": _run_profiles_suite,
+           "animation": _run_animation_suite,
+           "parity": _run_parity_suite,
+           "startup": _run_startup_suite}
+
+
+# =============================================================================
+# public
+# =============================================================================
+def build_parser():
+    """
+    Builds the command line interface of the benchmark.
+
+    :rtype: argparse.ArgumentParser
+    """
+    description = "Benchmarks the WatermarkBuddy pipeline on synthetic inputs."
+    parser = argparse.ArgumentParser(description=description)
+
+    help = "benchmark suites to run (default=pipeline) values: {}"
+    choices = sorted(_SUITES)
+    parser.add_argument("--suite", help=help.format(", ".join(choices)), nargs="+",
+                        choices=choices, default=["pipeline"], metavar="")
+
+    help = "resolutions of the synthetic inputs (default=640x360 1920x1080)"
+    parser.add_argument("--resolutions", help=help, nargs="+", type=_parse_resolution,
+                        default=[(640, 360), (1920, 1080)])
+
+    help = "duration of the synthetic videos in seconds, 0 to skip videos (default=2)"
+    parser.add_argument("--video-duration", help=help, type=float, default=2.0)
+
+    help = "backends to benchmark (default=ffmpeg)"
+    parser.add_argument("--backends", help=help, nargs="+",
+                        choices=watermarkbuddy.get_backends(), default=["ffmpeg"])
+
+    help = "autoscale settings to benchmark (default=off on)"
+    parser.add_argument("--autoscale", help=help, nargs="+", type=_parse_bool,
+                        default=[False, True])
+
+    help = "positions to benchmark (default=top-left bottom-right)"
+    parser.add_argument("--positions", help=help, nargs="+",
+                        choices=watermarkbuddy.get_positions(),
+                        default=["top-left", "bottom-right"], metavar="")
+
+    help = "blend modes to benchmark (default=normal multiply)"
+    parser.add_argument("--blend-modes", help=help, nargs="+",
+                        choices=watermarkbuddy.get_blend_modes(),
+                        default=["normal", "multiply"], metavar="")
+
+    help = "batch sizes to benchmark (default=1 8)"
+    parser.add_argument("--batch-sizes", help=help, nargs="+", type=int, default=[1, 8])
+
+    help = "amount of times each batch is run (default=3)"
+    parser.add_argument("--repeat", help=help, type=int, default=3)
+
+    help = "maximum amount of concurrent jobs per batch (default=cpu count)"
+    parser.add_argument("-j", "--workers", help=help, type=int, default=None)
+
+    help = "minimum PSNR in dB of the pillow outputs against the ffmpeg outputs (default=25)"
+    parser.add_argument("--parity-threshold", help=help, type=float, default=25.0)
+
+    help = "json file to write the results to (default=stdout)"
+    parser.add_argument("-o", "--output", help=help, default=None)
+
+    help = "json results of a previous run to detect throughput regressions against"
+    parser.add_argument("--baseline", help=help, default=None)
+
+    help = "allowed relative throughput drop against the baseline (default=0.1)"
+    parser.add_argument("--tolerance", help=help, type=float, default=0.1)
+
+    return parser
+
+
+def run(namespace):
+    """
+    Runs the benchmark suites.
+
+    :param namespace: parsed command line arguments, see build_parser
+    :type namespace: argparse.Namespace
+
+    :return: machine readable report of the benchmark
+    :rtype: dict
+    """
+    directory = tempfile.mkdtemp(prefix="watermarkbuddy-bench-")
+    try:
+        cases = []
+        for suite in namespace.suite:
+            suite_dir = os.path.join(directory, suite)
+            os.mkdir(suite_dir)
+            for case in _SUITES[suite](namespace, suite_dir):
+                case["suite"] = suite
+                cases.append(case)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {"version": __version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": batch.get_default_workers(),
+            "spawn_overhead": _measure_spawn_overhead(),
+            "peak_rss": _get_peak_rss(),
+            "cases": cases}
+
+
+def main(argv=None):
+    """
+    Runs the benchmark command line interface.
+
+    :param argv: command line arguments, defaults to sys.argv
+    :type argv: list[str]
+
+    :return: exit code, 1 if a regression against the baseline or a parity
+             failure was detected
+    :rtype: int
+    """
+    parser = build_parser()
+    namespace = parser.parse_args(argv)
+    report = run(namespace)
+
+    if namespace.baseline:
+        with open(namespace.baseline) as fp:
+            baseline = json.load(fp)
+        report["regressions"] = _compare(report["cases"], baseline["cases"], namespace.tolerance)
+
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if namespace.output:
+        with open(namespace.output, "w") as fp:
+            fp.write(data)
+    else:
+        print(data)
+
+    for regression in report.get("regressions", []):
+        msg = "regression: {} {} {:.0%} of baseline throughput"
+        print(msg.format(regression["case"]["suite"],
+                         regression["case"]["input"],
+                         regression["ratio"]), file=sys.stderr)
+
+    failures = [case for case in report["cases"] if case.get("parity") is False]
+    for case in failures:
+        settings = " ".join("{}={}".format(k, v) for k, v in sorted(case["options"].items()))
+        msg = "parity: {} {} {} dB, {} dB in the watermark region, below threshold"
+        print(msg.format(case["input"], settings, case["psnr"], case["region_psnr"]), file=sys.stderr)
+    return 1 if report.get("regressions") or failures else 0
@@ -0,0 +1,479 @@
+# stdlib modules
+from __future__ import absolute_import
+import os
+import json
+import time
+import errno
+import tempfile
+import threading
+import collections
+
+# tool modules
+from watermarkbuddy import watermarkbuddy
+
+# amount of files whose hash or stream data is kept in memory
+_MAX_MEMO_ENTRIES = 4096
+
+# amount of locks guarding the creation of cache entries
+_KEY_LOCKS = 64
+
+# prefix of entries being written, never evicted while in flight
+_TMP_PREFIX = ".tmp."
+
+# age in seconds after which an entry being written is considered abandoned
+_STALE_TMP_AGE = 3600
+
+
+# =============================================================================
+# classes
+# =============================================================================
+class WatermarkCache(object):
+    """
+    Content addressed on disk cache of scaled watermarks.
+
+    Entries are keyed by the watermark content hash, the target width and the
+    sample aspect ratio. Once the total size exceeds the maximum, the least
+    recently used entries are evicted.
+    """
+
+    def __init__(self, directory=None, max_size=256 * 1024 * 1024):
+        """
+        Initializes the object.
+
+        :param directory: directory to store scaled watermarks in
+        :type directory: str
+
+        :param max_size: maximum total size of the cache in bytes
+        :type max_size: int
+        """
+        if directory is None:
+            directory = os.path.join(get_default_cache_dir(), "watermarks")
+        self.directory = directory
+        self.max_size = max_size
+        self._digests = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = [threading.Lock() for _ in range(_KEY_LOCKS)]
+
+    def __getstate__(self):
+        """Returns the picklable state of the object, dropping the locks."""
+        state = self.__dict__.copy()
+        del state["_lock"]
+        del state["_key_locks"]
+        return state
+
+    def __setstate__(self, state):
+        """Restores the state of the object, recreating the locks."""
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._key_locks = [threading.Lock() for _ in range(_KEY_LOCKS)]
+
+    def _get_digest(self, file_path):
+        """
+        Returns the content hash of a file, memoized on its size and mtime.
+
+        :param file_path: file to hash
+        :type file_path: str
+
+        :rtype: str
+        """
+        stat = os.stat(file_path)
+        path = os.path.abspath(file_path)
+        with self._lock:
+            entry = _lookup_memo(self._digests, path, stat)
+        if entry is not None:
+            return entry
+
+        digest = hash_file(file_path)
+        with self._lock:
+            _store_memo(self._digests, path, stat, digest)
+        return digest
+
+    def _get_key_lock(self, key):
+        """
+        Returns the lock guarding the creation of a cache entry.
+
+        Entries share a fixed pool of locks, so the amount of locks does not
+        grow with the amount of entries.
+
+        :param key: cache entry file name
+        :type key: str
+
+        :rtype: threading.Lock
+        """
+        return self._key_locks[hash(key) % len(self._key_locks)]
+
+    def get_path(self, watermark_file, width, sar):
+        """
+        Returns the path of the cache entry for a scaled watermark.
+
+        :param watermark_file: file to use as watermark
+        :type watermark_file: str
+
+        :param width: width to scale the watermark to
+        :type width: int
+
+        :param sar: sample aspect ratio, formatted as num/den
+        :type sar: str
+
+        :rtype: str
+        """
+        digest = self._get_digest(watermark_file)
+        ext = os.path.splitext(watermark_file)[1]
+        fname = "{}_{}_{}{}".format(digest, width, sar.replace("/", "-"), ext)
+        return os.path.join(self.directory, fname)
+
+    def get_scaled(self, watermark_file, width, sar):
+        """
+        Returns a version of the watermark scaled to a width.
+
+        The scaled watermark is created on a cache miss.
+
+        :param watermark_file: file to use as watermark
+        :type watermark_file: str
+
+        :param width: width to scale the watermark to
+        :type width: int
+
+        :param sar: sample aspect ratio to set, formatted as num/den
+        :type sar: str
+
+        :rtype: str
+        """
+        path = self.get_path(watermark_file, width, sar)
+        with self._get_key_lock(os.path.basename(path)):
+            try:
+                # mark entry as recently used
+                os.utime(path, None)
+                return path
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+            # write to tmp file first so other processes never read a
+            # partially written entry
+            _makedirs(self.directory)
+            ext = os.path.splitext(path)[1]
+            fp, tmp_path = tempfile.mkstemp(suffix=ext, prefix=_TMP_PREFIX, dir=self.directory)
+            os.close(fp)
+            try:
+                watermarkbuddy._scale_watermark(watermark_file, tmp_path, width, sar)
+                os.rename(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+        self.evict(keep=path)
+        return path
+
+    def _list_entries(self):
+        """
+        Returns the entries of the cache, ignoring the ones being written.
+
+        Entries being written which were abandoned for over an hour, for
+        example by a killed process, are removed.
+
+        :return: modification time, size and path of each entry
+        :rtype: list[tuple[float, int, str]]
+        """
+        entries = []
+        stale_time = time.time() - _STALE_TMP_AGE
+        for fname in os.listdir(self.directory):
+            path = os.path.join(self.directory, fname)
+            try:
+                stat = os.stat(path)
+                if not fname.startswith(_TMP_PREFIX):
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                elif stat.st_mtime < stale_time:
+                    os.remove(path)
+            except OSError:
+                continue
+        return entries
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries exceeding the maximum size.
+
+        :param keep: entry to keep regardless, like the one just returned
+        :type keep: str
+        """
+        with self._lock:
+            entries = self._list_entries()
+            total = sum(entry[1] for entry in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+
+    def clear(self):
+        """Removes all entries from the cache."""
+        if not os.path.isdir(self.directory):
+            return
+        for fname in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, fname))
+
+
+class ProbeCache(object):
+    """
+    Cache of ffprobe stream data, kept in memory and optionally on disk.
+
+    Entries are keyed by file path and invalidated when the size or
+    modification time of the file changes. If a database path is given, the
+    entries are persisted in an SQLite database and shared between runs.
+    """
+
+    def __init__(self, path=None):
+        """
+        Initializes the object.
+
+        :param path: SQLite database to persist entries in
+        :type path: str
+        """
+        self.path = path
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def __getstate__(self):
+        """Returns the picklable state of the object, dropping the locks."""
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_connection"] = None
+        return state
+
+    def __setstate__(self, state):
+        """Restores the state of the object, recreating the locks."""
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _get_connection(self):
+        """
+        Returns the connection to the database, creating it on first use.
+
+        :rtype: sqlite3.Connection
+        """
+        if self._connection is None:
+            # imported on first use, so runs which never probe do not load it
+            import sqlite3
+            _makedirs(os.path.dirname(os.path.abspath(self.path)))
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("CREATE TABLE IF NOT EXISTS probes ("
+                               "path TEXT PRIMARY KEY, "
+                               "size INTEGER, "
+                               "mtime REAL, "
+                               "data TEXT)")
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def _load(self, path, size, mtime):
+        """
+        Returns the persisted stream data of a file, if still valid.
+
+        :param path: absolute file path
+        :type path: str
+
+        :param size: current size of the file
+        :type size: int
+
+        :param mtime: current modification time of the file
+        :type mtime: float
+
+        :rtype: dict
+        """
+        cursor = self._get_connection().execute(
+            "SELECT data FROM probes WHERE path=? AND size=? AND mtime=?",
+            (path, size, mtime))
+        row = cursor.fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _save(self, path, size, mtime, stream_data):
+        """
+        Persists the stream data of a file.
+
+        :param path: absolute file path
+        :type path: str
+
+        :param size: size of the file
+        :type size: int
+
+        :param mtime: modification time of the file
+        :type mtime: float
+
+        :param stream_data: video stream data of the file
+        :type stream_data: dict
+        """
+        connection = self._get_connection()
+        connection.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?)",
+                           (path, size, mtime, json.dumps(stream_data)))
+        connection.commit()
+
+    def lookup(self, file_path):
+        """
+        Returns the cached video stream data of a file.
+
+        :param file_path: file to look up
+        :type file_path: str
+
+        :return: stream data, None on a cache miss
+        :rtype: dict
+        """
+        stat = os.stat(file_path)
+        path = os.path.abspath(file_path)
+
+        with self._lock:
+            stream_data = _lookup_memo(self._entries, path, stat)
+            if stream_data is None and self.path:
+                stream_data = self._load(path, stat.st_size, stat.st_mtime)
+                if stream_data is not None:
+                    _store_memo(self._entries, path, stat, stream_data)
+        return stream_data
+
+    def store(self, file_path, stream_data):
+        """
+        Caches the video stream data of a file.
+
+        :param file_path: probed file
+        :type file_path: str
+
+        :param stream_data: video stream data of the file
+        :type stream_data: dict
+        """
+        stat = os.stat(file_path)
+        path = os.path.abspath(file_path)
+
+        with self._lock:
+            _store_memo(self._entries, path, stat, stream_data)
+            if self.path:
+                self._save(path, stat.st_size, stat.st_mtime, stream_data)
+
+    def get_stream_data(self, file_path):
+        """
+        Returns the video stream data of a file, probing it on a cache miss.
+
+        :param file_path: file to read
+        :type file_path: str
+
+        :rtype: dict
+        """
+        stream_data = self.lookup(file_path)
+        if stream_data is None:
+            stream_data = watermarkbuddy._probe_stream_data(file_path)
+            self.store(file_path, stream_data)
+        return stream_data
+
+    def close(self):
+        """Closes the connection to the database, if any."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+# =============================================================================
+# private
+# =============================================================================
+def _lookup_memo(memo, path, stat):
+    """
+    Returns a value memoized for a file, if the file did not change since.
+
+    The entry is marked as most recently used.
+
+    :param memo: memoized values, keyed by absolute file path
+    :type memo: collections.OrderedDict
+
+    :param path: absolute file path
+    :type path: str
+
+    :param stat: current status of the file
+    :type stat: os.stat_result
+
+    :return: memoized value, None if missing or outdated
+    :rtype: object
+    """
+    entry = memo.pop(path, None)
+    if entry is None or entry[:2] != (stat.st_size, stat.st_mtime):
+        return None
+    memo[path] = entry
+    return entry[2]
+
+
+def _store_memo(memo, path, stat, value):
+    """
+    Memoizes a value for a file, replacing the value of an older version.
+
+    Once the maximum amount of entries is exceeded, the least recently used
+    entries are dropped.
+
+    :param memo: memoized values, keyed by absolute file path
+    :type memo: collections.OrderedDict
+
+    :param path: absolute file path
+    :type path: str
+
+    :param stat: current status of the file
+    :type stat: os.stat_result
+
+    :param value: value to memoize
+    :type value: object
+    """
+    memo.pop(path, None)
+    memo[path] = (stat.st_size, stat.st_mtime, value)
+    while len(memo) > _MAX_MEMO_ENTRIES:
+        memo.popitem(last=False)
+
+
+def _makedirs(directory):
+    """
+    Creates a directory and its parents if they do not exist yet.
+
+    :param directory: directory to create
+    :type directory: str
+    """
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+# =============================================================================
+# public
+# =============================================================================
+def get_default_cache_dir():
+    """
+    Returns the default directory to store cached data in.
+
+    Follows the XDG base directory specification, defaulting to
+    ~/.cache/watermarkbuddy.
+
+    :rtype: str
+    """
+    root = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(root, "watermarkbuddy")
+
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """
+    Returns the SHA-1 hex digest of the content of a file.
+
+    :param file_path: file to hash
+    :type file_path: str
+
+    :param chunk_size: amount of bytes to read at once
+    :type chunk_size: int
+
+    :rtype: str
+    """
+    # imported on first use, as importing it loads the ssl library
+    import hashlib
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
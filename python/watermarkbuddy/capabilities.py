@@ -0,0 +1,339 @@
+# stdlib modules
+from __future__ import absolute_import
+import os
+import re
+import json
+import tempfile
+import threading
+
+# tool modules
+from watermarkbuddy import events
+from watermarkbuddy import process
+
+# bump to invalidate capabilities cached by older releases
+_CACHE_VERSION = 1
+
+# capabilities loaded by this process, keyed by binaries, see _get_key
+_CAPABILITIES = {}
+_CAPABILITIES_LOCK = threading.Lock()
+
+
+# =============================================================================
+# private
+# =============================================================================
+def _which(name):
+    """
+    Returns the path of an executable, searching PATH like a shell does.
+
+    :param name: name or path of the executable
+    :type name: str
+
+    :return: absolute path of the executable, None if not found
+    :rtype: str
+    """
+    if os.path.dirname(name):
+        candidates = [name]
+    else:
+        extensions = os.environ.get("PATHEXT", "").split(os.pathsep) if os.name == "nt" else []
+        candidates = [os.path.join(directory, name + extension)
+                      for directory in os.environ.get("PATH", os.defpath).split(os.pathsep)
+                      for extension in [""] + extensions]
+
+    for candidate in candidates:
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return os.path.abspath(candidate)
+    return None
+
+
+def _get_key():
+    """
+    Returns the key identifying the installed ffmpeg and ffprobe binaries,
+    being their path and modification time.
+
+    :return: key, None if ffmpeg is not found
+    :rtype: str
+    """
+    binaries = []
+    for name in ("ffmpeg", "ffprobe"):
+        path = _which(name)
+        binaries.append([path, os.stat(path).st_mtime] if path else None)
+    if binaries[0] is None:
+        return None
+    return json.dumps(binaries)
+
+
+def _get_cache_path():
+    """
+    Returns the file to persist the capabilities in.
+
+    :rtype: str
+    """
+    # imported here, as the cache module imports the module importing this one
+    from watermarkbuddy import cache
+    return os.path.join(cache.get_default_cache_dir(), "capabilities.json")
+
+
+def _run(args):
+    """
+    Executes a command, returning its output as text.
+
+    :param args: arguments representing the command to execute
+    :type args: list
+
+    :raises RuntimeError: if an error occurred during the execution
+
+    :return: stdout of the executed process
+    :rtype: str
+    """
+    return process.run(args, capture=True).decode("utf-8", "replace")
+
+
+def _parse_version(output):
+    """
+    Parses the version printed by ffmpeg -version or ffprobe -version.
+
+    :param output: output of the command
+    :type output: str
+
+    :rtype: str
+    """
+    match = re.search(r"version (\S+)", output)
+    return match.group(1) if match else None
+
+
+def _parse_table(output):
+    """
+    Parses the names listed by ffmpeg -filters or ffmpeg -encoders, being the
+    second column of each row below the legend.
+
+    :param output: output of the command
+    :type output: str
+
+    :rtype: list[str]
+    """
+    names = []
+    rows = False
+    for line in output.splitlines():
+        if line.strip().startswith("---"):
+            rows = True
+        elif rows and len(line.split()) > 1:
+            names.append(line.split()[1])
+    if not rows:
+        # legend separator missing in ffmpeg -filters of older releases
+        names = [line.split()[1] for line in output.splitlines()
+                 if re.match(r"^ [.A-Z|]{2,3} \S+ ", line)]
+    return names
+
+
+def _parse_hwaccels(output):
+    """
+    Parses the methods listed by ffmpeg -hwaccels.
+
+    :param output: output of the command
+    :type output: str
+
+    :rtype: list[str]
+    """
+    lines = output.split("methods:", 1)[-1].splitlines()
+    return [line.strip() for line in lines if line.strip()]
+
+
+def _parse_blend_modes(output):
+    """
+    Parses the values of the first mode option listed by ffmpeg -h
+    filter=blend.
+
+    :param output: output of the command
+    :type output: str
+
+    :rtype: list[str]
+    """
+    blend_modes = []
+    lines = iter(output.splitlines())
+    for line in lines:
+        if re.match(r"^\s+(all|c\d)_mode\s", line):
+            break
+    for line in lines:
+        match = re.match(r"^\s{4,}(\w+)\s+-?\d+\s", line)
+        if not match:
+            break
+        if match.group(1) not in blend_modes:
+            blend_modes.append(match.group(1))
+    return blend_modes
+
+
+def _detect_scale2ref(ffmpeg):
+    """
+    Detects how ffmpeg names the scale2ref expression variables.
+
+    Some ffmpeg releases swapped the variables of the scaled input with the
+    ones of the reference input. A tiny graph is rendered to find out which
+    naming applies.
+
+    :param ffmpeg: path of the ffmpeg executable
+    :type ffmpeg: str
+
+    :return: "default" or "swapped", None if scale2ref is unsupported
+    :rtype: str
+    """
+    # scale an 8x8 input to the size of the iw/ih variables, being 32x16 if
+    # those refer to the reference input
+    args = [ffmpeg,
+            "-v", "error",
+            "-f", "lavfi", "-i", "color=s=32x16",
+            "-f", "lavfi", "-i", "color=s=8x8",
+            "-filter_complex", "[1:v][0:v]scale2ref=w=iw:h=ih[s][r];[r]nullsink",
+            "-map", "[s]",
+            "-frames:v", "1",
+            "-f", "rawvideo",
+            "-pix_fmt", "gray",
+            "pipe:1"]
+    try:
+        stdout = process.run(args, capture=True)
+    except RuntimeError:
+        return None
+    return "swapped" if len(stdout) == 32 * 16 else "default"
+
+
+def _probe(key):
+    """
+    Probes the capabilities of the installed ffmpeg and ffprobe.
+
+    :param key: key identifying the binaries, see _get_key
+    :type key: str
+
+    :rtype: dict
+    """
+    (ffmpeg, _), ffprobe = json.loads(key)
+    filters = _parse_table(_run([ffmpeg, "-hide_banner", "-filters"]))
+    capabilities = {"ffmpeg": ffmpeg,
+                    "version": _parse_version(_run([ffmpeg, "-version"])),
+                    "filters": filters,
+                    "encoders": _parse_table(_run([ffmpeg, "-hide_banner", "-encoders"])),
+                    "hwaccels": _parse_hwaccels(_run([ffmpeg, "-hide_banner", "-hwaccels"])),
+                    "blend_modes": [],
+                    "scale2ref": None,
+                    "ffprobe": None,
+                    "ffprobe_version": None}
+    if "blend" in filters:
+        output = _run([ffmpeg, "-hide_banner", "-h", "filter=blend"])
+        capabilities["blend_modes"] = _parse_blend_modes(output)
+    if "scale2ref" in filters:
+        capabilities["scale2ref"] = _detect_scale2ref(ffmpeg)
+    if ffprobe:
+        capabilities["ffprobe"] = ffprobe[0]
+        capabilities["ffprobe_version"] = _parse_version(_run([ffprobe[0], "-version"]))
+    return capabilities
+
+
+def _load(path, key):
+    """
+    Returns the persisted capabilities of the binaries, if any.
+
+    :param path: file the capabilities are persisted in
+    :type path: str
+
+    :param key: key identifying the binaries, see _get_key
+    :type key: str
+
+    :rtype: dict
+    """
+    try:
+        with open(path) as fp:
+            entries = json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
+    if entries.get("version") != _CACHE_VERSION:
+        return None
+    return entries.get("entries", {}).get(key)
+
+
+def _save(path, key, capabilities):
+    """
+    Persists the capabilities of the binaries, keeping the ones of other
+    binaries. Failing to write the cache is not an error.
+
+    :param path: file to persist the capabilities in
+    :type path: str
+
+    :param key: key identifying the binaries, see _get_key
+    :type key: str
+
+    :param capabilities: capabilities of the binaries
+    :type capabilities: dict
+    """
+    entries = {}
+    try:
+        with open(path) as fp:
+            entries = json.load(fp)
+    except (IOError, OSError, ValueError):
+        pass
+    if entries.get("version") != _CACHE_VERSION:
+        entries = {"version": _CACHE_VERSION, "entries": {}}
+    entries["entries"][key] = capabilities
+
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fp, tmp_path = tempfile.mkstemp(prefix=".capabilities.", dir=directory)
+    except (IOError, OSError):
+        return
+    try:
+        with os.fdopen(fp, "w") as f:
+            json.dump(entries, f, indent=1, sort_keys=True)
+        replace = getattr(os, "replace", os.rename)
+        replace(tmp_path, path)
+    except (IOError, OSError):
+        os.remove(tmp_path)
+
+
+# =============================================================================
+# public
+# =============================================================================
+def get_capabilities(refresh=False):
+    """
+    Returns the capabilities of the installed ffmpeg and ffprobe.
+
+    Capabilities are probed once and persisted in the cache directory, keyed
+    by the path and modification time of the binaries. Later calls, also from
+    other processes, only look up the binaries and read the cache.
+
+    The returned dict holds the ffmpeg path and version, its available
+    filters, blend modes, encoders and hardware acceleration methods, the
+    scale2ref variable naming ("default", "swapped" or None if unsupported)
+    and the ffprobe path and version (None if ffprobe is not found).
+
+    :param refresh: set True to probe the binaries again
+    :type refresh: bool
+
+    :raises RuntimeError: if ffmpeg is not found
+
+    :rtype: dict
+    """
+    key = _get_key()
+    if key is None:
+        raise RuntimeError("ffmpeg not found")
+
+    with _CAPABILITIES_LOCK:
+        capabilities = None if refresh else _CAPABILITIES.get(key)
+        if capabilities is None:
+            path = _get_cache_path()
+            capabilities = None if refresh else _load(path, key)
+            if capabilities is None:
+                with events.stage("detect"):
+                    capabilities = _probe(key)
+                _save(path, key, capabilities)
+            _CAPABILITIES[key] = capabilities
+    return capabilities
+
+
+def is_loaded():
+    """
+    Returns whether the capabilities of the installed binaries are loaded in
+    this process, so get_capabilities returns without blocking.
+
+    :rtype: bool
+    """
+    key = _get_key()
+    return key is not None and key in _CAPABILITIES
@@ -0,0 +1,933 @@
+# stdlib modules
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import sys
+import json
+import argparse
+
+# tool modules
+from watermarkbuddy import watermarkbuddy
+from watermarkbuddy import cache
+from watermarkbuddy import events
+from watermarkbuddy import process
+
+# the modules of the other modes are imported on demand by their handlers, so
+# a single job only pays for importing the modules it uses
+
+
+# =============================================================================
+# private
+# =============================================================================
+def _parse_window(value):
+    """
+    Parses a time range given on the command line.
+
+    :param value: time range formatted as START:END, either may be empty
+    :type value: str
+
+    :raises argparse.ArgumentTypeError: if the time range is invalid
+
+    :rtype: tuple[float, float]
+    """
+    try:
+        start, end = value.split(":")
+        return float(start) if start else None, float(end) if end else None
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid time range {!r}, expected START:END".format(value))
+
+
+def _build_parser():
+    """
+    Builds the command line interface.
+
+    :rtype: argparse.ArgumentParser
+    """
+    description = "Watermarking tool using ffmpeg."
+    parser = argparse.ArgumentParser(description=description)
+
+    # required arguments
+    req_args = parser.add_argument_group("required arguments")
+
+    help = "file(s), directories or glob patterns to add watermark to, - to read from stdin (not required with --job-file)"
+    req_args.add_argument("-i", "--input", help=help, nargs="+")
+
+    help = "file to use as watermark (not required with --variants or --job-file)"
+    req_args.add_argument("-w", "--watermark", help=help)
+
+    help = "output file path, or output directory when processing multiple files, - to write to stdout (not required with --variants or --job-file)"
+    req_args.add_argument("-o", "--output", help=help)
+
+    # optional arguments
+    help = "automatically resize the watermark to input resolution"
+    parser.add_argument("-a", "--autoscale", help=help, required=False, action="store_true")
+
+    help = "x axis offset of the watermark"
+    parser.add_argument("-x", "--offsetx", help=help, type=int, default=0)
+
+    help = "y axis offset of the watermark"
+    parser.add_argument("-y", "--offsety", help=help, type=int, default=0)
+
+    help = "position of the watermark (default=top-left) values: {}"
+    choices = watermarkbuddy.get_positions()
+    help = help.format(", ".join(choices))
+    parser.add_argument("-p", "--position", help=help, choices=choices, default="top-left", metavar="")
+
+    help = "blend mode to use to apply watermark with (default=normal) values: {}"
+    choices = watermarkbuddy.get_blend_modes()
+    help = help.format(", ".join(choices))
+    parser.add_argument("-b", "--blendmode", help=help, choices=choices, default="normal", metavar="")
+
+    help = "backend to composite with (default=ffmpeg) values: {}"
+    choices = watermarkbuddy.get_backends()
+    help = help.format(", ".join(choices))
+    parser.add_argument("--backend", help=help, choices=choices, default="ffmpeg", metavar="")
+
+    help = "encoding profile setting codec, preset and quality of the output (default=ffmpeg defaults) values: {}"
+    choices = watermarkbuddy.get_profiles()
+    help = help.format(", ".join(choices))
+    parser.add_argument("--profile", help=help, choices=choices, default=None, metavar="")
+
+    help = ("amount of threads each ffmpeg process may use to encode "
+            "(default=automatic, with --profile the cpu count divided over the concurrent files)")
+    parser.add_argument("--threads", help=help, type=int, default=None)
+
+    help = "time in seconds to start applying the watermark from, videos only"
+    parser.add_argument("--start", help=help, type=float, default=None)
+
+    help = "time in seconds to stop applying the watermark at, videos only"
+    parser.add_argument("--end", help=help, type=float, default=None)
+
+    help = ("time range in seconds to apply the watermark in, videos only, START or END may be omitted "
+            "to apply it from the start or until the end of the video, repeat to show the watermark multiple times, e.g. 0:5 --window 30:")
+    parser.add_argument("--window", help=help, type=_parse_window, action="append", default=None, metavar="START:END")
+
+    help = "seconds to fade the watermark in over at the start of each time range, videos only"
+    parser.add_argument("--fade-in", help=help, type=float, default=None, metavar="SECONDS")
+
+    help = "seconds to fade the watermark out over at the end of each time range, videos only"
+    parser.add_argument("--fade-out", help=help, type=float, default=None, metavar="SECONDS")
+
+    help = ("loop an animated watermark, e.g. a gif, until the end of the input, decoding it only once "
+            "(default=animated watermarks play once and hold their last frame)")
+    parser.add_argument("--loop-watermark", help=help, action="store_true")
+
+    help = ("split a long video into keyframe aligned segments of about SECONDS, watermarking them "
+            "concurrently (default=duration divided over --jobs, at least 10s)")
+    parser.add_argument("--segments", help=help, type=float, nargs="?", const=0, default=None, metavar="SECONDS")
+
+    help = "maximum amount of files, or segments with --segments, to process concurrently (default=cpu count)"
+    parser.add_argument("-j", "--jobs", help=help, type=int, default=None)
+
+    help = ("when processing multiple files, start the files estimated to take longest first and share "
+            "--thread-budget threads between the concurrent ffmpeg processes, reporting the predicted makespan")
+    parser.add_argument("--schedule", help=help, action="store_true")
+
+    help = "with --schedule, maximum total amount of ffmpeg threads (default=cpu count)"
+    parser.add_argument("--thread-budget", help=help, type=int, default=None)
+
+    help = "autoscale in a separate ffmpeg pass instead of within the main filter graph"
+    parser.add_argument("--two-pass", help=help, action="store_true")
+
+    help = ("skip files whose output is up to date, recording processed files in a manifest "
+            "(default=.watermarkbuddy-manifest.json in the output directory)")
+    parser.add_argument("--incremental", help=help, nargs="?", const="", default=None, metavar="MANIFEST")
+
+    help = "with --incremental, compare the content of input files whose size or modification time changed"
+    parser.add_argument("--hash-inputs", help=help, action="store_true")
+
+    help = ("watch the input directories, adding the watermark to new files once written, "
+            "mirroring the directory structure in the output directory")
+    parser.add_argument("--watch", help=help, action="store_true")
+
+    help = "with --watch, seconds a file must remain unchanged before it is processed (default=2)"
+    parser.add_argument("--settle", help=help, type=float, default=2.0, metavar="SECONDS")
+
+    help = "with --watch, poll for changes instead of using inotify, e.g. for network shares"
+    parser.add_argument("--poll", help=help, action="store_true")
+
+    help = "format of the input read from stdin, e.g. png, jpg, mkv (default=probed by ffmpeg)"
+    parser.add_argument("--input-format", help=help, default=None)
+
+    help = "format of the output written to stdout, e.g. png, jpg, mkv (default=output file extension)"
+    parser.add_argument("--output-format", help=help, default=None)
+
+    help = "json file listing watermark variants to create from a single input in one pass"
+    parser.add_argument("--variants", help=help, default=None)
+
+    help = ("json, yaml or csv file listing jobs, each holding input_file, output_file and watermark_file "
+            "and optionally any of the watermark arguments, which default to the ones on the command line")
+    parser.add_argument("--job-file", help=help, default=None, metavar="FILE")
+
+    help = ("add the files, or the jobs of --job-file, to a queue in a shared directory instead of "
+            "processing them, to be processed by workers on any host, see --worker")
+    parser.add_argument("--queue", help=help, default=None, metavar="DIR")
+
+    help = "process the jobs of a queue in a shared directory until all of them completed"
+    parser.add_argument("--worker", help=help, default=None, metavar="DIR")
+
+    help = "print the progress of a queue in a shared directory as json"
+    parser.add_argument("--queue-status", help=help, default=None, metavar="DIR")
+
+    help = ("with --worker or --queue-status, seconds after which the claim of a job whose worker stopped "
+            "sending heartbeats expires, so another worker takes it over (default=60)")
+    parser.add_argument("--claim-expiry", help=help, type=float, default=60.0, metavar="SECONDS")
+
+    help = "directory to cache scaled watermarks in (default={})"
+    help = help.format(os.path.join(cache.get_default_cache_dir(), "watermarks"))
+    parser.add_argument("--cache-dir", help=help, default=None)
+
+    help = "do not cache scaled watermarks between runs"
+    parser.add_argument("--no-cache", help=help, action="store_true")
+
+    help = ("directory of a watermark atlas to take scaled watermarks from when autoscaling, "
+            "implies --two-pass, see --build-atlas")
+    parser.add_argument("--atlas", help=help, default=None, metavar="DIR")
+
+    help = ("pre-render the watermark into an atlas directory at every distinct width of the inputs "
+            "and/or at --atlas-widths, then exit")
+    parser.add_argument("--build-atlas", help=help, default=None, metavar="DIR")
+
+    help = "widths to pre-render the watermark at with --build-atlas"
+    parser.add_argument("--atlas-widths", help=help, type=int, nargs="+", default=[], metavar="WIDTH")
+
+    help = "sqlite database to persist probed stream data in between runs (default={})"
+    default = os.path.join(cache.get_default_cache_dir(), "probes.sqlite")
+    help = help.format(default)
+    parser.add_argument("--probe-cache", help=help, nargs="?", const=default, default=None)
+
+    help = "maximum amount of seconds each file, or segment with --segments, may take before ffmpeg is killed"
+    parser.add_argument("--timeout", help=help, type=float, default=None, metavar="SECONDS")
+
+    help = "maximum resident memory of each ffmpeg process in megabytes before it is killed"
+    parser.add_argument("--max-rss", help=help, type=int, default=None, metavar="MB")
+
+    help = "write stage timings, ffmpeg command lines and progress as json lines to a file, - for stderr"
+    parser.add_argument("--log-jsonl", help=help, default=None, metavar="FILE")
+
+    help = "print stage timings and ffmpeg progress to stderr"
+    parser.add_argument("--progress", help=help, action="store_true")
+
+    return parser
+
+
+def _subscribe(namespace):
+    """
+    Subscribes the instrumentation outputs requested on the command line.
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+    """
+    if namespace.log_jsonl:
+        stream = sys.stderr if namespace.log_jsonl == "-" else open(namespace.log_jsonl, "a")
+        events.subscribe(events.JsonLinesLogger(stream))
+    if namespace.progress:
+        events.subscribe(events.print_progress)
+
+
+def _get_options(namespace):
+    """
+    Returns the watermark options defined on the command line.
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :rtype: dict
+    """
+    watermark_cache = None
+    if namespace.watermark_atlas is not None:
+        watermark_cache = namespace.watermark_atlas
+    elif not namespace.no_cache:
+        watermark_cache = cache.WatermarkCache(namespace.cache_dir)
+
+    return {"autoscale": namespace.autoscale,
+            "position": namespace.position,
+            "offset_x": namespace.offsetx,
+            "offset_y": namespace.offsety,
+            "blend_mode": namespace.blendmode,
+            "cache": watermark_cache,
+            "single_pass": False if namespace.two_pass or namespace.atlas else None,
+            "probe_cache": cache.ProbeCache(namespace.probe_cache),
+            "backend": namespace.backend,
+            "profile": namespace.profile,
+            "threads": namespace.threads,
+            "start": namespace.start,
+            "end": namespace.end,
+            "windows": namespace.window,
+            "fade_in": namespace.fade_in,
+            "fade_out": namespace.fade_out,
+            "loop_watermark": namespace.loop_watermark}
+
+
+def _get_limits(namespace):
+    """
+    Returns the limits of each job defined on the command line.
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :return: timeout in seconds and maximum resident memory in bytes
+    :rtype: dict
+    """
+    max_rss = namespace.max_rss * 1024 * 1024 if namespace.max_rss else None
+    return {"timeout": namespace.timeout, "max_rss": max_rss}
+
+
+def _load_atlas(parser, namespace):
+    """
+    Loads the watermark atlas requested on the command line, if any.
+
+    :param parser: command line interface
+    :type parser: argparse.ArgumentParser
+
+    :param namespace: parsed command line arguments, the atlas is stored as
+                      watermark_atlas
+    :type namespace: argparse.Namespace
+    """
+    namespace.watermark_atlas = None
+    if namespace.atlas:
+        from watermarkbuddy import atlas
+        try:
+            namespace.watermark_atlas = atlas.WatermarkAtlas(namespace.atlas)
+        except ValueError as e:
+            parser.error(str(e))
+
+
+def _build_atlas(parser, namespace):
+    """
+    Pre-renders the watermark into an atlas at the widths of the inputs and
+    the requested widths.
+
+    :param parser: command line interface
+    :type parser: argparse.ArgumentParser
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+    """
+    from watermarkbuddy import atlas
+    from watermarkbuddy import batch
+    if not namespace.watermark:
+        parser.error("the following arguments are required: -w/--watermark")
+
+    sizes = list(namespace.atlas_widths)
+    if namespace.input:
+        input_files = batch.collect_files(namespace.input)
+        probe_cache = cache.ProbeCache(namespace.probe_cache)
+        sizes.extend(atlas.collect_sizes(input_files, probe_cache, workers=namespace.jobs))
+    if not sizes:
+        parser.error("--build-atlas requires -i/--input and/or --atlas-widths")
+
+    try:
+        watermark_atlas = atlas.build_atlas(namespace.watermark,
+                                            namespace.build_atlas,
+                                            sizes,
+                                            workers=namespace.jobs)
+    except ValueError as e:
+        parser.error(str(e))
+
+    for width, sar in watermark_atlas.get_widths():
+        print("{} sar={}".format(width, sar))
+
+
+def _get_manifest(namespace, directory):
+    """
+    Returns the manifest requested with --incremental, if any.
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :param directory: directory to store the manifest in if no path is given
+    :type directory: str
+
+    :rtype: watermarkbuddy.incremental.Manifest
+    """
+    if namespace.incremental is None:
+        return None
+    from watermarkbuddy import incremental
+    path = namespace.incremental or os.path.join(directory, ".watermarkbuddy-manifest.json")
+    return incremental.Manifest(path, hash_inputs=namespace.hash_inputs)
+
+
+def _is_batch(namespace):
+    """
+    Returns whether the command line requests processing multiple files.
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :rtype: bool
+    """
+    if len(namespace.input) > 1 or os.path.isdir(namespace.output):
+        return True
+    if namespace.incremental is not None:
+        return True
+    return not os.path.isfile(namespace.input[0])
+
+
+def _print_failure(result):
+    """
+    Prints the error of a failed job.
+
+    :param result: result of the executed job
+    :type result: watermarkbuddy.batch.JobResult
+    """
+    if not result.succeeded:
+        msg = "failed: {}: {}".format(result.job.input_file, result.error)
+        print(msg, file=sys.stderr)
+
+
+def _get_batch_threads(namespace, count):
+    """
+    Returns the amount of threads each ffmpeg process may use, sharing the
+    cpus between the files processed concurrently.
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :param count: amount of files to process
+    :type count: int
+
+    :rtype: int
+    """
+    from watermarkbuddy import batch
+    cpus = batch.get_default_workers()
+    workers = min(namespace.jobs or cpus, count) or 1
+    return max(1, cpus // workers)
+
+
+def _run_scheduled(namespace, jobs, probe_cache, manifest):
+    """
+    Adds the watermark to multiple files concurrently, starting the files
+    estimated to take longest first.
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :param jobs: jobs to execute
+    :type jobs: list[watermarkbuddy.batch.Job]
+
+    :param probe_cache: cache to store the probed stream data in
+    :type probe_cache: watermarkbuddy.cache.ProbeCache
+
+    :param manifest: manifest to skip jobs with an up to date output with
+    :type manifest: watermarkbuddy.incremental.Manifest
+
+    :rtype: watermarkbuddy.scheduler.ScheduleResult
+    """
+    from watermarkbuddy import scheduler
+    result = scheduler.add_watermarks_scheduled(jobs,
+                                                workers=namespace.jobs,
+                                                thread_budget=namespace.thread_budget,
+                                                probe_cache=probe_cache,
+                                                callback=_print_failure,
+                                                manifest=manifest,
+                                                **_get_limits(namespace))
+    print("predicted makespan {:.2f}s, actual {:.2f}s".format(result.predicted, result.makespan))
+    return result
+
+
+def _run_batch(parser, namespace):
+    """
+    Adds the watermark to multiple files concurrently.
+
+    :param parser: command line interface
+    :type parser: argparse.ArgumentParser
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :return: exit code
+    :rtype: int
+    """
+    from watermarkbuddy import batch
+    if not os.path.isdir(namespace.output):
+        parser.error("output must be an existing directory when processing multiple files")
+
+    manifest = _get_manifest(namespace, namespace.output)
+
+    try:
+        input_files = batch.collect_files(namespace.input)
+        options = _get_options(namespace)
+        if options["profile"] and options["threads"] is None and not namespace.schedule:
+            options["threads"] = _get_batch_threads(namespace, len(input_files))
+        jobs = batch.build_jobs(input_files,
+                                namespace.watermark,
+                                namespace.output,
+                                **options)
+
+        if namespace.schedule:
+            result = _run_scheduled(namespace, jobs, options["probe_cache"], manifest)
+        else:
+            # probe all inputs upfront when autoscaling in a separate pass
+            if namespace.autoscale and namespace.two_pass:
+                batch.probe_files(input_files, options["probe_cache"], workers=namespace.jobs)
+
+            result = batch.add_watermarks(jobs,
+                                          workers=namespace.jobs,
+                                          callback=_print_failure,
+                                          manifest=manifest,
+                                          **_get_limits(namespace))
+    except ValueError as e:
+        parser.error(str(e))
+
+    msg = "processed {} files in {:.2f}s ({:.2f} files/s), {} skipped, {} failed"
+    print(msg.format(len(result.results),
+                     result.elapsed,
+                     result.throughput,
+                     len(result.skipped),
+                     len(result.failed)))
+    return 1 if result.failed else 0
+
+
+def _print_result(result):
+    """
+    Prints the output or the error of a completed job.
+
+    :param result: result of the executed job
+    :type result: watermarkbuddy.batch.JobResult
+    """
+    if result.succeeded:
+        print("processed: {} -> {}".format(result.job.input_file, result.job.output_file))
+        sys.stdout.flush()
+    else:
+        _print_failure(result)
+
+
+def _run_watch(parser, namespace):
+    """
+    Watches the input directories until interrupted, adding the watermark to
+    new files.
+
+    :param parser: command line interface
+    :type parser: argparse.ArgumentParser
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+    """
+    from watermarkbuddy import watch
+    manifest = _get_manifest(namespace, namespace.output)
+
+    limits = _get_limits(namespace)
+    try:
+        hot_folder = watch.HotFolder(namespace.input,
+                                     namespace.watermark,
+                                     namespace.output,
+                                     workers=namespace.jobs,
+                                     settle=namespace.settle,
+                                     manifest=manifest,
+                                     callback=_print_result,
+                                     timeout=limits["timeout"],
+                                     max_rss=limits["max_rss"],
+                                     **_get_options(namespace))
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        hot_folder.run(polling=namespace.poll)
+    except KeyboardInterrupt:
+        pass
+
+
+def _run_job_file(parser, namespace):
+    """
+    Executes all jobs listed in a job file, grouping jobs sharing an input
+    file, watermark and geometry.
+
+    :param parser: command line interface
+    :type parser: argparse.ArgumentParser
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :return: exit code
+    :rtype: int
+    """
+    from watermarkbuddy import batch
+    from watermarkbuddy import jobfile
+    manifest = _get_manifest(namespace, os.path.dirname(os.path.abspath(namespace.job_file)))
+
+    try:
+        options = _get_options(namespace)
+        jobs = jobfile.load_jobs(namespace.job_file, **options)
+
+        # probe all inputs upfront when autoscaling in a separate pass
+        if namespace.two_pass:
+            input_files = sorted(set(job.input_file for job in jobs if job.options.get("autoscale")))
+            batch.probe_files(input_files, options["probe_cache"], workers=namespace.jobs)
+
+        result = jobfile.run_jobs(jobs,
+                                  workers=namespace.jobs,
+                                  callback=_print_failure,
+                                  manifest=manifest,
+                                  **_get_limits(namespace))
+    except (ValueError, RuntimeError) as e:
+        parser.error(str(e))
+
+    msg = "processed {} files in {:.2f}s ({:.2f} files/s), {} skipped, {} failed"
+    print(msg.format(len(result.results),
+                     result.elapsed,
+                     result.throughput,
+                     len(result.skipped),
+                     len(result.failed)))
+    return 1 if result.failed else 0
+
+
+def _submit_jobs(parser, namespace):
+    """
+    Adds the jobs of the command line, or of a job file, to a queue in a
+    shared directory.
+
+    :param parser: command line interface
+    :type parser: argparse.ArgumentParser
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+    """
+    from watermarkbuddy import batch
+    from watermarkbuddy import distributed
+    from watermarkbuddy import jobfile
+    try:
+        options = _get_options(namespace)
+        if namespace.job_file:
+            jobs = jobfile.load_jobs(namespace.job_file, **options)
+        else:
+            if not os.path.isdir(namespace.output):
+                parser.error("output must be an existing directory when queueing files")
+            input_files = batch.collect_files(namespace.input)
+            jobs = batch.build_jobs(input_files, namespace.watermark, namespace.output, **options)
+        job_ids = distributed.submit_jobs(namespace.queue, jobs)
+    except (ValueError, RuntimeError) as e:
+        parser.error(str(e))
+
+    print("queued {} jobs, {} queued already".format(len(job_ids), len(jobs) - len(job_ids)))
+
+
+def _run_worker(parser, namespace):
+    """
+    Processes the jobs of a queue in a shared directory until all of them
+    completed.
+
+    :param parser: command line interface
+    :type parser: argparse.ArgumentParser
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :return: exit code
+    :rtype: int
+    """
+    from watermarkbuddy import distributed
+    options = _get_options(namespace)
+    limits = _get_limits(namespace)
+    try:
+        worker = distributed.Worker(namespace.worker,
+                                    workers=namespace.jobs,
+                                    expiry=namespace.claim_expiry,
+                                    callback=_print_result,
+                                    timeout=limits["timeout"],
+                                    max_rss=limits["max_rss"],
+                                    cache=options["cache"],
+                                    probe_cache=options["probe_cache"])
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        result = worker.run()
+    except KeyboardInterrupt:
+        return 1
+
+    msg = "processed {} files in {:.2f}s ({:.2f} files/s), {} failed"
+    print(msg.format(len(result.results), result.elapsed, result.throughput, len(result.failed)))
+    return 1 if result.failed else 0
+
+
+def _print_queue_status(parser, namespace):
+    """
+    Prints the progress of a queue in a shared directory.
+
+    :param parser: command line interface
+    :type parser: argparse.ArgumentParser
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+    """
+    from watermarkbuddy import distributed
+    try:
+        status = distributed.get_status(namespace.queue_status, expiry=namespace.claim_expiry)
+    except ValueError as e:
+        parser.error(str(e))
+    print(json.dumps(status, indent=1, sort_keys=True))
+
+
+def _validate_stream_arguments(parser, namespace):
+    """
+    Validates the arguments streaming from stdin and/or to stdout, rejecting
+    the ones add_watermark_stream does not support.
+
+    :param parser: command line interface
+    :type parser: argparse.ArgumentParser
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+    """
+    if len(namespace.input) > 1:
+        parser.error("stdin cannot be combined with other inputs")
+
+    arguments = [("--backend", namespace.backend != "ffmpeg"),
+                 ("--profile", namespace.profile is not None),
+                 ("--threads", namespace.threads is not None),
+                 ("--start", namespace.start is not None),
+                 ("--end", namespace.end is not None),
+                 ("--window", namespace.window is not None),
+                 ("--fade-in", namespace.fade_in is not None),
+                 ("--fade-out", namespace.fade_out is not None),
+                 ("--loop-watermark", namespace.loop_watermark),
+                 ("--segments", namespace.segments is not None)]
+    unsupported = [name for name, used in arguments if used]
+    if unsupported:
+        msg = "{} cannot be used when streaming from stdin or to stdout"
+        parser.error(msg.format(", ".join(unsupported)))
+
+
+def _get_stream_formats(parser, namespace):
+    """
+    Returns the formats of the streamed input and output, defaulting to the
+    extensions of the files.
+
+    :param parser: command line interface
+    :type parser: argparse.ArgumentParser
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :return: input format, None to let ffmpeg probe it, and output format
+    :rtype: tuple[str, str]
+    """
+    output_format = namespace.output_format
+    if output_format is None:
+        output_format = os.path.splitext(namespace.output)[1]
+    if not output_format:
+        parser.error("--output-format is required when writing to stdout")
+
+    input_format = namespace.input_format
+    if input_format is None and namespace.input[0] != "-":
+        input_format = os.path.splitext(namespace.input[0])[1] or None
+    return input_format, output_format
+
+
+def _run_stream(parser, namespace):
+    """
+    Adds the watermark to media streamed from stdin and/or to stdout.
+
+    :param parser: command line interface
+    :type parser: argparse.ArgumentParser
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+    """
+    input_file = namespace.input[0]
+    output_file = namespace.output
+    _validate_stream_arguments(parser, namespace)
+    input_format, output_format = _get_stream_formats(parser, namespace)
+
+    options = _get_options(namespace)
+    stdin = getattr(sys.stdin, "buffer", sys.stdin)
+    stdout = getattr(sys.stdout, "buffer", sys.stdout)
+    input_stream = stdin if input_file == "-" else open(input_file, "rb")
+    output_stream = stdout if output_file == "-" else open(output_file, "wb")
+    try:
+        watermarkbuddy.add_watermark_stream(input_stream,
+                                            namespace.watermark,
+                                            output_stream,
+                                            input_format=input_format,
+                                            output_format=output_format,
+                                            autoscale=options["autoscale"],
+                                            position=options["position"],
+                                            offset_x=options["offset_x"],
+                                            offset_y=options["offset_y"],
+                                            blend_mode=options["blend_mode"])
+    finally:
+        for stream in (input_stream, output_stream):
+            if stream not in (stdin, stdout):
+                stream.close()
+
+
+def _run_segmented(parser, namespace):
+    """
+    Adds the watermark to a long video, encoding its segments concurrently.
+
+    :param parser: command line interface
+    :type parser: argparse.ArgumentParser
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+    """
+    from watermarkbuddy import segments
+    limits = _get_limits(namespace)
+    try:
+        segments.add_watermark_segmented(namespace.input[0],
+                                         namespace.watermark,
+                                         namespace.output,
+                                         segment_duration=namespace.segments or None,
+                                         workers=namespace.jobs,
+                                         timeout=limits["timeout"],
+                                         max_rss=limits["max_rss"],
+                                         **_get_options(namespace))
+    except ValueError as e:
+        parser.error(str(e))
+
+
+def _run_variants(parser, namespace):
+    """
+    Adds all watermark variants listed in a json file to a single input file.
+
+    :param parser: command line interface
+    :type parser: argparse.ArgumentParser
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+    """
+    if len(namespace.input) > 1 or not os.path.isfile(namespace.input[0]):
+        parser.error("variants require a single input file")
+
+    with open(namespace.variants) as fp:
+        variants = json.load(fp)
+
+    options = _get_options(namespace)
+    try:
+        watermarkbuddy.add_watermark_variants(namespace.input[0],
+                                              variants,
+                                              cache=options["cache"],
+                                              single_pass=options["single_pass"],
+                                              probe_cache=options["probe_cache"],
+                                              threads=options["threads"])
+    except ValueError as e:
+        parser.error(str(e))
+
+
+def _run_standalone(parser, namespace):
+    """
+    Runs the modes which do not watermark the input files right away, being
+    building an atlas, the job queue and job files.
+
+    :param parser: command line interface
+    :type parser: argparse.ArgumentParser
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+
+    :return: exit code, None if none of these modes was requested
+    :rtype: int
+    """
+    if namespace.build_atlas:
+        watermarkbuddy.validate_ffmpeg()
+        watermarkbuddy.validate_ffprobe()
+        _build_atlas(parser, namespace)
+        return 0
+
+    if namespace.queue_status:
+        _print_queue_status(parser, namespace)
+        return 0
+
+    if namespace.worker:
+        watermarkbuddy.validate_ffmpeg()
+        watermarkbuddy.validate_ffprobe()
+        return _run_worker(parser, namespace)
+
+    if namespace.job_file and namespace.queue:
+        _submit_jobs(parser, namespace)
+        return 0
+
+    if namespace.job_file:
+        watermarkbuddy.validate_ffmpeg()
+        watermarkbuddy.validate_ffprobe()
+        return _run_job_file(parser, namespace)
+    return None
+
+
+def _validate_arguments(parser, namespace):
+    """
+    Validates the arguments adding the watermark to the input files.
+
+    :param parser: command line interface
+    :type parser: argparse.ArgumentParser
+
+    :param namespace: parsed command line arguments
+    :type namespace: argparse.Namespace
+    """
+    if not namespace.watermark or not namespace.output:
+        parser.error("the following arguments are required: -w/--watermark, -o/--output")
+
+    # validate autoscale is not mixed with offset or position
+    if namespace.autoscale:
+        if (namespace.offsetx != 0) or (namespace.offsety != 0):
+            raise parser.error("offset cannot be used with autoscale")
+        elif namespace.position != "top-left":
+            raise parser.error("position cannot be used with autoscale")
+
+
+# =============================================================================
+# public
+# =============================================================================
+def main(argv=None):
+    """
+    Runs the command line interface.
+
+    :param argv: command line arguments, defaults to sys.argv
+    :type argv: list[str]
+
+    :return: exit code, 1 if a file failed to be watermarked
+    :rtype: int
+    """
+    parser = _build_parser()
+    namespace = parser.parse_args(argv)
+    _subscribe(namespace)
+    _load_atlas(parser, namespace)
+
+    code = _run_standalone(parser, namespace)
+    if code is not None:
+        return code
+
+    if not namespace.input:
+        parser.error("the following arguments are required: -i/--input")
+
+    if namespace.variants:
+        watermarkbuddy.validate_ffmpeg()
+        with process.limits(**_get_limits(namespace)):
+            _run_variants(parser, namespace)
+        return 0
+
+    _validate_arguments(parser, namespace)
+
+    if namespace.queue:
+        _submit_jobs(parser, namespace)
+        return 0
+
+    # validate ffmpeg/ffprobe
+    watermarkbuddy.validate_ffmpeg()
+    watermarkbuddy.validate_ffprobe()
+
+    if namespace.watch:
+        _run_watch(parser, namespace)
+        return 0
+
+    if "-" in (namespace.input[0], namespace.output):
+        with process.limits(**_get_limits(namespace)):
+            _run_stream(parser, namespace)
+        return 0
+
+    if _is_batch(namespace):
+        if namespace.segments is not None:
+            parser.error("--segments requires a single input file")
+        return _run_batch(parser, namespace)
+
+    if namespace.segments is not None:
+        _run_segmented(parser, namespace)
+        return 0
+
+    with process.limits(**_get_limits(namespace)):
+        watermarkbuddy.add_watermark(namespace.input[0],
+                                     namespace.watermark,
+                                     namespace.output,
+                                     **_get_options(namespace))
+    return 0
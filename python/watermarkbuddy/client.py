@@ -0,0 +1,199 @@
+# stdlib modules
+from __future__ import absolute_import
+import os
+import json
+import socket
+import tempfile
+
+# Client of the watermark server, see watermarkbuddy.server. Only depends on
+# the standard library, so submitting jobs does not pay for importing the
+# watermark pipeline.
+#
+# The protocol exchanges json documents, one per line, over a Unix socket.
+# Each request holds a command and its arguments, each response holds "ok"
+# and either the result of the command or an "error" message.
+
+
+# =============================================================================
+# classes
+# =============================================================================
+class Client(object):
+    """Connection to a watermark server."""
+
+    def __init__(self, path=None, timeout=None):
+        """
+        Initializes the object.
+
+        :param path: Unix socket the server listens on
+        :type path: str
+
+        :param timeout: maximum amount of seconds to wait for a response,
+                        None to wait forever
+        :type timeout: float
+        """
+        self.path = path or get_default_socket_path()
+        self.timeout = timeout
+        self._socket = None
+        self._reader = None
+
+    def __enter__(self):
+        """Returns the object, used as context manager."""
+        return self
+
+    def __exit__(self, *args):
+        """Closes the connection, used as context manager."""
+        self.close()
+
+    def _connect(self):
+        """
+        Connects to the server, if not connected yet.
+
+        :raises RuntimeError: if the server is not running
+        """
+        if self._socket is not None:
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            sock.close()
+            raise RuntimeError("no server listening on {}".format(self.path))
+        self._socket = sock
+        self._reader = sock.makefile("rb")
+
+    def request(self, command, **arguments):
+        """
+        Sends a request to the server and returns its response.
+
+        :param command: command to execute
+        :type command: str
+
+        :param arguments: arguments of the command
+        :type arguments: dict
+
+        :raises RuntimeError: if the server responded with an error
+
+        :rtype: dict
+        """
+        self._connect()
+        arguments["command"] = command
+        self._socket.sendall((json.dumps(arguments) + "\n").encode("utf-8"))
+        line = self._reader.readline()
+        if not line:
+            self.close()
+            raise RuntimeError("server closed the connection")
+
+        response = json.loads(line.decode("utf-8"))
+        if not response.pop("ok"):
+            raise RuntimeError(response["error"])
+        return response
+
+    def submit(self, input_file, watermark_file, output_file, block=None, **options):
+        """
+        Submits a watermark job to the server.
+
+        Relative paths are resolved against the current directory, as the
+        server may run in another one.
+
+        :param input_file: file to add watermark to
+        :type input_file: str
+
+        :param watermark_file: file to use as watermark
+        :type watermark_file: str
+
+        :param output_file: output file path
+        :type output_file: str
+
+        :param block: maximum amount of seconds to wait for room in the queue,
+                      None to fail right away if the queue is full
+        :type block: float
+
+        :param options: keyword arguments passed to add_watermark, except the
+                        caches which are owned by the server
+        :type options: dict
+
+        :raises RuntimeError: if the job is invalid or the queue is full
+
+        :return: id of the job
+        :rtype: str
+        """
+        response = self.request("submit",
+                                input_file=os.path.abspath(input_file),
+                                watermark_file=os.path.abspath(watermark_file),
+                                output_file=os.path.abspath(output_file),
+                                block=block,
+                                options=options)
+        return response["id"]
+
+    def status(self, job_id):
+        """
+        Returns the status of a job.
+
+        :param job_id: id of the job
+        :type job_id: str
+
+        :return: id, state (queued, running, succeeded, failed or cancelled),
+                 files, error and timestamps of the job
+        :rtype: dict
+        """
+        return self.request("status", id=job_id)["job"]
+
+    def wait(self, job_id, timeout=None):
+        """
+        Waits for a job to complete and returns its status.
+
+        :param job_id: id of the job
+        :type job_id: str
+
+        :param timeout: maximum amount of seconds to wait, None to wait forever
+        :type timeout: float
+
+        :return: status of the job, see status
+        :rtype: dict
+        """
+        return self.request("wait", id=job_id, timeout=timeout)["job"]
+
+    def stats(self):
+        """
+        Returns the statistics of the server.
+
+        :return: amount of workers, queue size and job counts per state
+        :rtype: dict
+        """
+        return self.request("stats")["stats"]
+
+    def shutdown(self):
+        """
+        Stops the server once the running jobs completed, cancelling the
+        queued ones.
+        """
+        self.request("shutdown")
+        self.close()
+
+    def close(self):
+        """Closes the connection to the server, if any."""
+        if self._socket is not None:
+            self._reader.close()
+            self._socket.close()
+            self._socket = None
+            self._reader = None
+
+
+# =============================================================================
+# public
+# =============================================================================
+def get_default_socket_path():
+    """
+    Returns the default Unix socket of the server.
+
+    Uses $XDG_RUNTIME_DIR, being private to the user, falling back to a file
+    in the temp directory holding the user id.
+
+    :rtype: str
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "watermarkbuddy.sock")
+    fname = "watermarkbuddy-{}.sock".format(os.getuid())
+    return os.path.join(tempfile.gettempdir(), fname)
@@ -0,0 +1,327 @@
+# stdlib modules
+from __future__ import absolute_import
+from __future__ import division
+import os
+
+# third party modules
+try:
+    import numpy
+    from PIL import Image
+except ImportError:
+    numpy = None
+    Image = None
+
+# maximum and half value of an 8-bit channel, as used by the ffmpeg blend filter
+_MAX = 255
+_HALF = 128
+
+# Pillow save options of each encoding profile, see watermarkbuddy.get_profiles
+_PROFILES = {
+    "fast": {"quality": 80, "compress_level": 1},
+    "balanced": {"quality": 90, "compress_level": 6},
+    "archive": {"quality": 97, "compress_level": 9}}
+
+# memoized decoded watermarks, see _load_watermark
+_WATERMARKS = {}
+_MAX_WATERMARKS = 32
+
+
+# =============================================================================
+# private
+# =============================================================================
+def _multiply(x, a, b):
+    """ffmpeg MULTIPLY macro."""
+    return x * ((a * b) // _MAX)
+
+
+def _screen(x, a, b):
+    """ffmpeg SCREEN macro."""
+    return _MAX - x * ((_MAX - a) * (_MAX - b) // _MAX)
+
+
+def _burn(a, b):
+    """ffmpeg BURN macro."""
+    burned = numpy.maximum(0, _MAX - ((_MAX - b) << 8) // numpy.maximum(a, 1))
+    return numpy.where(a == 0, a, burned)
+
+
+def _dodge(a, b):
+    """ffmpeg DODGE macro."""
+    dodged = numpy.minimum(_MAX, (b << 8) // numpy.maximum(_MAX - a, 1))
+    return numpy.where(a == _MAX, a, dodged)
+
+
+def _softlight(a, b):
+    """ffmpeg softlight blend mode, as defined since ffmpeg 5."""
+    a = a.astype(numpy.float32)
+    b = b.astype(numpy.float32)
+    return a * a / _MAX + 2 * (b * a / _MAX) * (_MAX - a) / _MAX
+
+
+# blend mode expressions of the ffmpeg blend filter, with A being the top
+# (watermarked) layer and B the bottom (source) layer as int32 arrays
+_BLEND_MODES = {
+    "addition": lambda A, B: numpy.minimum(_MAX, A + B),
+    "grainmerge": lambda A, B: A + B - _HALF,
+    "and": lambda A, B: A & B,
+    "average": lambda A, B: (A + B) // 2,
+    "burn": lambda A, B: _burn(A, B),
+    "darken": lambda A, B: numpy.minimum(A, B),
+    "difference": lambda A, B: numpy.abs(A - B),
+    "grainextract": lambda A, B: _HALF + A - B,
+    "divide": lambda A, B: numpy.where(B == 0, _MAX, _MAX * A // numpy.maximum(B, 1)),
+    "dodge": lambda A, B: _dodge(A, B),
+    "freeze": lambda A, B: numpy.where(B == 0, 0, _MAX - numpy.minimum((_MAX - A) ** 2 // numpy.maximum(B, 1), _MAX)),
+    "exclusion": lambda A, B: A + B - 2 * A * B // _MAX,
+    "extremity": lambda A, B: numpy.abs(_MAX - A - B),
+    "glow": lambda A, B: numpy.where(A == _MAX, A, numpy.minimum(_MAX, B * B // numpy.maximum(_MAX - A, 1))),
+    "hardlight": lambda A, B: numpy.where(B < _HALF, _multiply(2, B, A), _screen(2, B, A)),
+    "hardmix": lambda A, B: numpy.where(A < _MAX - B, 0, _MAX),
+    "heat": lambda A, B: numpy.where(A == 0, 0, _MAX - numpy.minimum((_MAX - B) ** 2 // numpy.maximum(A, 1), _MAX)),
+    "lighten": lambda A, B: numpy.maximum(A, B),
+    "linearlight": lambda A, B: numpy.where(B < _HALF, B + 2 * A - _MAX, B + 2 * (A - _HALF)),
+    "multiply": lambda A, B: _multiply(1, A, B),
+    "multiply128": lambda A, B: (A - _HALF) * B / 32.0 + _HALF,
+    "negation": lambda A, B: _MAX - numpy.abs(_MAX - A - B),
+    "normal": lambda A, B: A,
+    "or": lambda A, B: A | B,
+    "overlay": lambda A, B: numpy.where(A < _HALF, _multiply(2, A, B), _screen(2, A, B)),
+    "phoenix": lambda A, B: numpy.minimum(A, B) - numpy.maximum(A, B) + _MAX,
+    "pinlight": lambda A, B: numpy.where(B < _HALF, numpy.minimum(A, 2 * B), numpy.maximum(A, 2 * (B - _HALF))),
+    "reflect": lambda A, B: numpy.where(B == _MAX, B, numpy.minimum(_MAX, A * A // numpy.maximum(_MAX - B, 1))),
+    "screen": lambda A, B: _screen(1, A, B),
+    "softlight": _softlight,
+    "subtract": lambda A, B: numpy.maximum(0, A - B),
+    "vividlight": lambda A, B: numpy.where(A < _HALF, _burn(2 * A, B), _dodge(2 * (A - _HALF), B)),
+    "xor": lambda A, B: A ^ B}
+
+
+def _validate_dependencies():
+    """
+    Validates the third party modules of the compositor are installed.
+
+    :raises RuntimeError: if numpy or Pillow is not installed
+    """
+    if numpy is None:
+        raise RuntimeError("pillow backend requires numpy and Pillow to be installed")
+
+
+def _open_image(file_path):
+    """
+    Opens and decodes a still image.
+
+    :param file_path: image file to open
+    :type file_path: str
+
+    :raises ValueError: if the file is not a still image supported by Pillow
+
+    :rtype: PIL.Image.Image
+    """
+    try:
+        image = Image.open(file_path)
+        image.load()
+    except (IOError, OSError):
+        msg = "pillow backend only supports still images: {}"
+        raise ValueError(msg.format(file_path))
+    return image
+
+
+def _get_position(position, offset_x, offset_y, size, watermark_size):
+    """
+    Returns the top-left coordinate of the watermark, matching _get_overlay.
+
+    The overlay filter composites in 4:2:0 YUV, rounding the coordinate down
+    to even values so it aligns with the chroma planes, so this does too.
+
+    :param position: initial position of the watermark
+    :type position: str
+
+    :param offset_x: X-axis offset of the watermark
+    :type offset_x: int
+
+    :param offset_y: Y-axis offset of the watermark
+    :type offset_y: int
+
+    :param size: width and height of the input
+    :type size: tuple[int, int]
+
+    :param watermark_size: width and height of the watermark
+    :type watermark_size: tuple[int, int]
+
+    :rtype: tuple[int, int]
+    """
+    x, y = offset_x, offset_y
+    if position in ("top-right", "bottom-right"):
+        x = size[0] - watermark_size[0] - offset_x
+    if position in ("bottom-left", "bottom-right"):
+        y = size[1] - watermark_size[1] - offset_y
+    return x & ~1, y & ~1
+
+
+def _open_ycbcr_image(file_path):
+    """
+    Opens and decodes a still image in YCbCr.
+
+    JPEG images are decoded straight to YCbCr, skipping the RGB conversion.
+
+    :param file_path: image file to open
+    :type file_path: str
+
+    :rtype: PIL.Image.Image
+    """
+    try:
+        image = Image.open(file_path)
+        if image.format == "JPEG" and image.mode == "RGB":
+            image.draft("YCbCr", image.size)
+        image.load()
+    except (IOError, OSError):
+        msg = "pillow backend only supports still images: {}"
+        raise ValueError(msg.format(file_path))
+
+    if image.mode != "YCbCr":
+        image = image.convert("RGB").convert("YCbCr")
+    return image
+
+
+def _load_watermark(watermark_file, width=None):
+    """
+    Returns the decoded watermark in YCbCr and its alpha mask, optionally
+    scaled to a width keeping aspect ratio. Results are memoized, so a
+    watermark applied to many images is only decoded and scaled once.
+
+    :param watermark_file: image to use as watermark
+    :type watermark_file: str
+
+    :param width: width to scale the watermark to
+    :type width: int
+
+    :rtype: tuple[PIL.Image.Image, PIL.Image.Image]
+    """
+    stat = os.stat(watermark_file)
+    key = (os.path.abspath(watermark_file), stat.st_size, stat.st_mtime, width)
+    watermark = _WATERMARKS.get(key)
+    if watermark is not None:
+        return watermark
+
+    image = _open_image(watermark_file).convert("RGBA")
+    if width is not None:
+        height = int(round(width * image.size[1] / float(image.size[0])))
+        image = image.resize((width, height), Image.BICUBIC)
+    watermark = (image.convert("RGB").convert("YCbCr"), image.getchannel("A"))
+
+    if len(_WATERMARKS) >= _MAX_WATERMARKS:
+        _WATERMARKS.clear()
+    _WATERMARKS[key] = watermark
+    return watermark
+
+
+def _blend(top, bottom, blend_mode):
+    """
+    Blends two YCbCr images plane by plane, like ffmpeg blends YUV planes.
+
+    :param top: top layer, being the watermarked image
+    :type top: PIL.Image.Image
+
+    :param bottom: bottom layer, being the source image
+    :type bottom: PIL.Image.Image
+
+    :param blend_mode: blend mode to apply
+    :type blend_mode: str
+
+    :rtype: PIL.Image.Image
+    """
+    if blend_mode == "normal":
+        return top
+
+    a = numpy.asarray(top, dtype=numpy.int32)
+    b = numpy.asarray(bottom, dtype=numpy.int32)
+    blended = _BLEND_MODES[blend_mode](a, b)
+    blended = numpy.clip(blended, 0, _MAX).astype(numpy.uint8)
+    return Image.fromarray(blended, "YCbCr")
+
+
+# =============================================================================
+# public
+# =============================================================================
+def add_watermark(input_file,
+                  watermark_file,
+                  output_file,
+                  autoscale=False,
+                  position="top-left",
+                  offset_x=0,
+                  offset_y=0,
+                  blend_mode="normal",
+                  profile=None):
+    """
+    Add a watermark to a still image, composited in-process.
+
+    Mirrors the ffmpeg filter graph of watermarkbuddy.add_watermark: the
+    watermark is overlaid on the image and the result is blended with the
+    image. Results match ffmpeg up to rounding and chroma subsampling.
+
+    :param input_file: image to add watermark to
+    :type input_file: str
+
+    :param watermark_file: image to use as watermark
+    :type watermark_file: str
+
+    :param output_file: output file path
+    :type output_file: str
+
+    :param autoscale: set True to resize watermark to input file
+    :type autoscale: bool
+
+    :param position: initial position of the watermark
+    :type position: str
+
+    :param offset_x: X-axis offset of the watermark
+    :type offset_x: int
+
+    :param offset_y: Y-axis offset of the watermark
+    :type offset_y: int
+
+    :param blend_mode: blend mode to apply watermark with
+    :type blend_mode: str
+
+    :param profile: encoding profile setting the output quality, None to use
+                    the Pillow defaults
+    :type profile: str
+
+    :raises ValueError: if the blend mode is not supported by this backend
+    """
+    _validate_dependencies()
+    if blend_mode != "normal" and blend_mode not in _BLEND_MODES:
+        msg = "blend mode {!r} is not supported by the pillow backend"
+        raise ValueError(msg.format(blend_mode))
+
+    image = _open_ycbcr_image(input_file)
+
+    if autoscale:
+        # scale to input width keeping aspect ratio, overlay top-left
+        watermark, mask = _load_watermark(watermark_file, width=image.size[0])
+        x, y = 0, 0
+    else:
+        watermark, mask = _load_watermark(watermark_file)
+        x, y = _get_position(position,
+                             int(offset_x),
+                             int(offset_y),
+                             image.size,
+                             watermark.size)
+
+    # alpha composite watermark, clipped to the image
+    over = image.copy()
+    over.paste(watermark, (x, y), mask)
+
+    result = _blend(over, image, blend_mode)
+    if os.path.splitext(output_file)[1].lower() not in (".jpg", ".jpeg"):
+        result = result.convert("RGB")
+    result.save(output_file, **_PROFILES.get(profile, {}))
+
+
+def get_blend_modes():
+    """
+    Returns the blend modes supported by the pillow backend.
+
+    :rtype: list[str]
+    """
+    return sorted(_BLEND_MODES)
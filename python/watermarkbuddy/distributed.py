@@ -0,0 +1,622 @@
+# stdlib modules
+from __future__ import absolute_import
+import os
+import json
+import time
+import errno
+import random
+import socket
+import hashlib
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+# tool modules
+from watermarkbuddy import batch
+from watermarkbuddy import events
+from watermarkbuddy import incremental
+from watermarkbuddy import server
+
+# directories of a queue holding the jobs, their claims and their results
+_JOBS_DNAME = "jobs"
+_CLAIMS_DNAME = "claims"
+_RESULTS_DNAME = "results"
+
+# default amount of seconds after which a claim without heartbeat expires
+_DEFAULT_EXPIRY = 60.0
+
+# maximum amount of seconds between checking for jobs once all are claimed
+_POLL_INTERVAL = 1.0
+
+
+# =============================================================================
+# classes
+# =============================================================================
+class Worker(object):
+    """
+    Worker executing the jobs of a queue stored in a shared directory, see
+    submit_jobs.
+
+    Any amount of workers, on any amount of hosts mounting the directory at
+    the same path, can process a queue together. A job is claimed by creating
+    its claim file exclusively, which the worker touches while the job runs.
+    Claims which were not touched for longer than the expiry, e.g. as their
+    worker crashed or lost its host, are taken over by other workers. A job
+    can therefore run twice if a worker stalls for longer than the expiry,
+    outputs are replaced atomically so the last run wins.
+
+    Expiry compares modification times set by one host to the clock of
+    another, so the clocks of the hosts must be in sync.
+    """
+
+    def __init__(self,
+                 directory,
+                 workers=None,
+                 expiry=_DEFAULT_EXPIRY,
+                 heartbeat=None,
+                 callback=None,
+                 timeout=None,
+                 max_rss=None,
+                 **options):
+        """
+        Initializes the object.
+
+        :param directory: directory holding the queue
+        :type directory: str
+
+        :param workers: maximum amount of concurrent jobs, defaults to CPU count
+        :type workers: int
+
+        :param expiry: amount of seconds after which a claim without heartbeat
+                       is taken over by another worker
+        :type expiry: float
+
+        :param heartbeat: amount of seconds between touching the claims of the
+                          running jobs, defaults to a quarter of the expiry
+        :type heartbeat: float
+
+        :param callback: function called with each JobResult once it completes
+        :type callback: callable
+
+        :param timeout: maximum amount of seconds each job may run
+        :type timeout: float
+
+        :param max_rss: maximum resident memory of each ffmpeg process in bytes
+        :type max_rss: int
+
+        :param options: keyword arguments passed to add_watermark for all jobs,
+                        e.g. the caches of this host, overridden by the
+                        options of the jobs
+        :type options: dict
+
+        :raises ValueError: if the directory does not hold a queue or a value
+                            is invalid
+        """
+        if not os.path.isdir(os.path.join(directory, _JOBS_DNAME)):
+            raise ValueError("not a job queue: {}".format(directory))
+        if expiry <= 0:
+            raise ValueError("invalid claim expiry {!r}".format(expiry))
+
+        self.directory = directory
+        self.workers = workers or batch.get_default_workers()
+        self.expiry = expiry
+        self.heartbeat = heartbeat or expiry / 4.0
+        self.callback = callback
+        self.timeout = timeout
+        self.max_rss = max_rss
+        self.options = options
+        self.id = "{}:{}".format(socket.gethostname(), os.getpid())
+        if self.workers < 1:
+            raise ValueError("invalid amount of workers {!r}".format(self.workers))
+
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._claims = set()
+        self._candidates = []
+
+    def _get_path(self, dname, job_id):
+        """
+        Returns the path of the file of a job in one of the queue directories.
+
+        :param dname: name of the queue directory
+        :type dname: str
+
+        :param job_id: id of the job
+        :type job_id: str
+
+        :rtype: str
+        """
+        return os.path.join(self.directory, dname, job_id + ".json")
+
+    def _steal(self, claim_path):
+        """
+        Removes an expired claim, so it can be claimed again.
+
+        The claim is moved aside first, so only one of the workers racing for
+        it removes it. If the claim moved aside turns out to be fresh, being
+        claimed again in the meantime, it is put back.
+
+        :param claim_path: claim file to remove
+        :type claim_path: str
+
+        :return: whether the claim was removed
+        :rtype: bool
+        """
+        stale_path = "{}.{}.stale".format(claim_path, self.id)
+        try:
+            os.rename(claim_path, stale_path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+
+        try:
+            if not _is_expired(stale_path, self.expiry):
+                os.link(stale_path, claim_path)
+                return False
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        finally:
+            os.remove(stale_path)
+
+        events.emit("claim_expired", claim=os.path.basename(claim_path), worker=self.id)
+        return True
+
+    def _claim(self, job_id):
+        """
+        Claims a job, taking over an expired claim.
+
+        :param job_id: id of the job
+        :type job_id: str
+
+        :return: whether the job was claimed
+        :rtype: bool
+        """
+        claim_path = self._get_path(_CLAIMS_DNAME, job_id)
+        for _ in range(2):
+            try:
+                fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                if not _is_expired(claim_path, self.expiry) or not self._steal(claim_path):
+                    return False
+                continue
+
+            with os.fdopen(fd, "w") as fp:
+                json.dump({"worker": self.id, "claimed": time.time()}, fp)
+
+            # completed by another worker between listing and claiming
+            if os.path.exists(self._get_path(_RESULTS_DNAME, job_id)):
+                os.remove(claim_path)
+                return False
+
+            with self._lock:
+                self._claims.add(job_id)
+            return True
+        return False
+
+    def _release(self, job_id):
+        """
+        Removes the claim of a job, if it was not taken over.
+
+        :param job_id: id of the job
+        :type job_id: str
+        """
+        with self._lock:
+            self._claims.discard(job_id)
+        claim_path = self._get_path(_CLAIMS_DNAME, job_id)
+        try:
+            with open(claim_path) as fp:
+                owner = json.load(fp).get("worker")
+            if owner == self.id:
+                os.remove(claim_path)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def _touch_claims(self):
+        """Touches the claims of the running jobs until the worker stops."""
+        while not self._stop.wait(self.heartbeat):
+            with self._lock:
+                job_ids = list(self._claims)
+            for job_id in job_ids:
+                try:
+                    os.utime(self._get_path(_CLAIMS_DNAME, job_id), None)
+                except OSError:
+                    events.emit("claim_lost", job_id=job_id, worker=self.id)
+
+    def _scan(self):
+        """
+        Lists the jobs which have no result and no claim, or an expired one.
+
+        The jobs are shuffled, so workers starting together do not all race
+        for the same jobs.
+
+        :return: ids of the jobs to claim and whether jobs of other workers
+                 are still running
+        :rtype: tuple[list[str], bool]
+        """
+        job_ids = _list_ids(self.directory, _JOBS_DNAME)
+        job_ids.difference_update(_list_ids(self.directory, _RESULTS_DNAME))
+
+        running = False
+        candidates = []
+        claimed = _list_ids(self.directory, _CLAIMS_DNAME)
+        for job_id in job_ids:
+            if job_id not in claimed:
+                candidates.append(job_id)
+            elif _is_expired(self._get_path(_CLAIMS_DNAME, job_id), self.expiry):
+                candidates.append(job_id)
+            else:
+                running = True
+
+        random.shuffle(candidates)
+        return candidates, running
+
+    def _next_job(self):
+        """
+        Claims the next job, waiting for the jobs running on other workers in
+        case their claims expire.
+
+        :return: id of the claimed job, None once all jobs have a result
+        :rtype: str
+        """
+        while not self._stop.is_set():
+            with self._scan_lock:
+                if not self._candidates:
+                    self._candidates, running = self._scan()
+                    if not self._candidates and not running:
+                        return None
+
+                while self._candidates:
+                    job_id = self._candidates.pop()
+                    if self._claim(job_id):
+                        return job_id
+
+            # all jobs left are claimed, check again for completed or expired
+            # claims
+            self._stop.wait(min(self.heartbeat, _POLL_INTERVAL))
+        return None
+
+    def _load_job(self, job_id):
+        """
+        Loads a queued job, adding the options of the worker.
+
+        :param job_id: id of the job
+        :type job_id: str
+
+        :rtype: watermarkbuddy.batch.Job
+        """
+        with open(self._get_path(_JOBS_DNAME, job_id)) as fp:
+            data = json.load(fp)
+        options = dict(self.options)
+        options.update(data["options"])
+        return batch.Job(data["input_file"], data["watermark_file"], data["output_file"], **options)
+
+    def _finish(self, job_id, result):
+        """
+        Stores the result of a job in the queue and releases its claim.
+
+        :param job_id: id of the job
+        :type job_id: str
+
+        :param result: result of the job
+        :type result: watermarkbuddy.batch.JobResult
+        """
+        data = {"worker": self.id,
+                "elapsed": result.elapsed,
+                "error": result.error,
+                "finished": time.time()}
+        _write_json(self._get_path(_RESULTS_DNAME, job_id), data)
+        self._release(job_id)
+
+    def _work(self):
+        """
+        Executes jobs until all jobs have a result.
+
+        :return: results of the jobs executed by this thread
+        :rtype: list[watermarkbuddy.batch.JobResult]
+        """
+        results = []
+        while True:
+            job_id = self._next_job()
+            if job_id is None:
+                return results
+
+            try:
+                job = self._load_job(job_id)
+            except (IOError, OSError, ValueError, KeyError) as e:
+                job = batch.Job(job_id, None, None)
+                result = batch.JobResult(job, 0.0, error="invalid job: {}".format(e))
+            else:
+                with events.context(job_id=job_id, worker=self.id):
+                    result = batch.run_job(job, self.timeout, self.max_rss)
+
+            self._finish(job_id, result)
+            results.append(result)
+            if self.callback:
+                self.callback(result)
+
+    def run(self):
+        """
+        Executes jobs of the queue until all jobs have a result.
+
+        A failing job does not stop the worker, its error is stored as its
+        result.
+
+        :return: results of the jobs executed by this worker
+        :rtype: watermarkbuddy.batch.BatchResult
+        """
+        start = time.time()
+        self._stop.clear()
+        heartbeat = threading.Thread(target=self._touch_claims)
+        heartbeat.daemon = True
+        heartbeat.start()
+
+        pool = ThreadPool(self.workers)
+        try:
+            results = []
+            for thread_results in pool.map(lambda _: self._work(), range(self.workers)):
+                results.extend(thread_results)
+        finally:
+            self.stop()
+            pool.close()
+            pool.join()
+            heartbeat.join()
+            for job_id in list(self._claims):
+                self._release(job_id)
+        return batch.BatchResult(results, time.time() - start)
+
+    def stop(self):
+        """Stops claiming jobs, the running jobs complete."""
+        self._stop.set()
+
+
+# =============================================================================
+# private
+# =============================================================================
+def _list_ids(directory, dname):
+    """
+    Lists the ids of the jobs in one of the queue directories.
+
+    :param directory: directory holding the queue
+    :type directory: str
+
+    :param dname: name of the queue directory
+    :type dname: str
+
+    :rtype: set[str]
+    """
+    path = os.path.join(directory, dname)
+    return set(fname[:-5] for fname in os.listdir(path)
+               if fname.endswith(".json") and not fname.startswith("."))
+
+
+def _is_expired(claim_path, expiry):
+    """
+    Returns whether a claim was not touched for longer than the expiry.
+
+    :param claim_path: claim file
+    :type claim_path: str
+
+    :param expiry: amount of seconds after which a claim expires
+    :type expiry: float
+
+    :return: whether the claim expired, False if it does not exist
+    :rtype: bool
+    """
+    try:
+        return time.time() - os.stat(claim_path).st_mtime > expiry
+    except OSError:
+        return False
+
+
+def _write_json(path, data):
+    """
+    Writes a json file, replacing an existing file atomically.
+
+    :param path: file to write
+    :type path: str
+
+    :param data: content of the file
+    :type data: object
+    """
+    fp, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fp, "w") as f:
+            json.dump(data, f, sort_keys=True)
+        incremental.replace_file(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _get_job_id(job):
+    """
+    Returns the id of a job, derived from its output file so submitting the
+    same job twice queues it once.
+
+    :param job: job to get the id of
+    :type job: watermarkbuddy.batch.Job
+
+    :rtype: str
+    """
+    path = os.path.abspath(job.output_file)
+    return hashlib.sha1(path.encode("utf-8")).hexdigest()
+
+
+def _serialize_job(job):
+    """
+    Returns the queued representation of a job, with absolute paths and the
+    options a worker does not provide itself.
+
+    :param job: job to serialize
+    :type job: watermarkbuddy.batch.Job
+
+    :rtype: dict
+    """
+    options = dict((key, value) for key, value in job.options.items()
+                   if key in server._JOB_OPTIONS and value is not None)
+    return {"input_file": os.path.abspath(job.input_file),
+            "watermark_file": os.path.abspath(job.watermark_file),
+            "output_file": os.path.abspath(job.output_file),
+            "options": options}
+
+
+def _read_claims(directory, job_ids, expiry):
+    """
+    Reads the claims of jobs which did not expire.
+
+    :param directory: directory holding the queue
+    :type directory: str
+
+    :param job_ids: ids of the jobs to read the claims of
+    :type job_ids: set[str]
+
+    :param expiry: amount of seconds after which a claim expires
+    :type expiry: float
+
+    :return: content of the claims and the amount of expired claims
+    :rtype: tuple[list[dict], int]
+    """
+    claims = []
+    expired = 0
+    for job_id in _list_ids(directory, _CLAIMS_DNAME) & job_ids:
+        claim_path = os.path.join(directory, _CLAIMS_DNAME, job_id + ".json")
+        if _is_expired(claim_path, expiry):
+            expired += 1
+            continue
+        try:
+            with open(claim_path) as fp:
+                claims.append(json.load(fp))
+        except (IOError, OSError, ValueError):
+            # removed once complete or still being written
+            continue
+    return claims, expired
+
+
+def _get_worker_counts(counts, worker):
+    """
+    Returns the job counts of a worker, adding them if missing.
+
+    :param counts: counts of the workers, keyed by worker
+    :type counts: dict[str, dict]
+
+    :param worker: id of the worker
+    :type worker: str
+
+    :rtype: dict
+    """
+    return counts.setdefault(worker, {"succeeded": 0, "failed": 0, "running": 0, "elapsed": 0.0})
+
+
+# =============================================================================
+# public
+# =============================================================================
+def create_queue(directory):
+    """
+    Creates the directories of a queue, if they do not exist yet.
+
+    :param directory: directory to hold the queue
+    :type directory: str
+    """
+    for dname in (_JOBS_DNAME, _CLAIMS_DNAME, _RESULTS_DNAME):
+        path = os.path.join(directory, dname)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+
+def submit_jobs(directory, jobs):
+    """
+    Adds jobs to a queue stored in a shared directory, creating it if needed,
+    to be executed by workers on any host, see Worker.
+
+    Paths are stored absolute, so they must be the same on all hosts. Only
+    options which can be stored as json are queued, the caches are provided
+    by the workers. Jobs writing an output which is queued already are
+    skipped.
+
+    :param directory: directory holding the queue
+    :type directory: str
+
+    :param jobs: jobs to add
+    :type jobs: list[watermarkbuddy.batch.Job]
+
+    :return: ids of the added jobs
+    :rtype: list[str]
+    """
+    create_queue(directory)
+    queued = _list_ids(directory, _JOBS_DNAME)
+    job_ids = []
+    for job in jobs:
+        job_id = _get_job_id(job)
+        if job_id in queued:
+            continue
+        queued.add(job_id)
+        _write_json(os.path.join(directory, _JOBS_DNAME, job_id + ".json"), _serialize_job(job))
+        job_ids.append(job_id)
+    return job_ids
+
+
+def get_status(directory, expiry=_DEFAULT_EXPIRY):
+    """
+    Returns the progress of a queue, aggregated over all workers.
+
+    Jobs with an expired claim count as pending. The throughput is measured
+    from the first claim to the last result and the remaining time estimated
+    from it.
+
+    :param directory: directory holding the queue
+    :type directory: str
+
+    :param expiry: amount of seconds after which a claim without heartbeat
+                   expires
+    :type expiry: float
+
+    :raises ValueError: if the directory does not hold a queue
+
+    :return: amount of jobs per state, throughput in files per second,
+             estimated remaining seconds and counts per worker
+    :rtype: dict
+    """
+    if not os.path.isdir(os.path.join(directory, _JOBS_DNAME)):
+        raise ValueError("not a job queue: {}".format(directory))
+
+    job_ids = _list_ids(directory, _JOBS_DNAME)
+    result_ids = _list_ids(directory, _RESULTS_DNAME) & job_ids
+    workers = {}
+    started = []
+    finished = []
+    for job_id in result_ids:
+        with open(os.path.join(directory, _RESULTS_DNAME, job_id + ".json")) as fp:
+            data = json.load(fp)
+        worker = _get_worker_counts(workers, data["worker"])
+        worker["failed" if data["error"] else "succeeded"] += 1
+        worker["elapsed"] += data["elapsed"]
+        started.append(data["finished"] - data["elapsed"])
+        finished.append(data["finished"])
+
+    claims, expired = _read_claims(directory, job_ids - result_ids, expiry)
+    for data in claims:
+        started.append(data["claimed"])
+        _get_worker_counts(workers, data["worker"])["running"] += 1
+    running = len(claims)
+
+    failed = sum(worker["failed"] for worker in workers.values())
+    remaining = len(job_ids) - len(result_ids)
+    throughput = 0.0
+    if finished and max(finished) > min(started):
+        throughput = len(result_ids) / (max(finished) - min(started))
+
+    return {"total": len(job_ids),
+            "pending": remaining - running,
+            "running": running,
+            "expired": expired,
+            "succeeded": len(result_ids) - failed,
+            "failed": failed,
+            "throughput": throughput,
+            "eta": remaining / throughput if throughput else None,
+            "workers": workers}
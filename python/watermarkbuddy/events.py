@@ -0,0 +1,245 @@
+# stdlib modules
+from __future__ import absolute_import
+import sys
+import json
+import time
+import threading
+import contextlib
+
+# functions called with each emitted event
+_SUBSCRIBERS = []
+_SUBSCRIBERS_LOCK = threading.Lock()
+
+# fields added to the events emitted by the current thread, see context
+_LOCAL = threading.local()
+
+
+# =============================================================================
+# classes
+# =============================================================================
+class JsonLinesLogger(object):
+    """Subscriber writing each event as a line of json."""
+
+    def __init__(self, stream):
+        """
+        Initializes the object.
+
+        :param stream: file-like object to write the events to
+        :type stream: io.TextIOBase
+        """
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        """
+        Writes an event.
+
+        :param event: event to write
+        :type event: dict
+        """
+        line = json.dumps(event, sort_keys=True, default=str)
+        with self._lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+
+# =============================================================================
+# private
+# =============================================================================
+def _get_context():
+    """
+    Returns the fields added to the events emitted by the current thread.
+
+    :rtype: dict
+    """
+    fields = getattr(_LOCAL, "fields", None)
+    if fields is None:
+        fields = _LOCAL.fields = {}
+    return fields
+
+
+def _parse_number(value, cast):
+    """
+    Parses a number reported by ffmpeg, which may be N/A or have a unit suffix.
+
+    :param value: value to parse
+    :type value: str
+
+    :param cast: type to cast the value to
+    :type cast: type
+
+    :rtype: int or float
+    """
+    try:
+        return cast(value.rstrip("x"))
+    except (AttributeError, ValueError):
+        return None
+
+
+def _parse_progress(values):
+    """
+    Parses a block of key=value pairs written by ffmpeg -progress.
+
+    :param values: raw values keyed by name
+    :type values: dict[str, str]
+
+    :rtype: dict
+    """
+    # out_time_us is missing in ffmpeg releases before 4.1, where the
+    # misnamed out_time_ms holds microseconds too
+    out_time_us = values.get("out_time_us", values.get("out_time_ms"))
+    out_time_us = _parse_number(out_time_us, int)
+    out_time = values.get("out_time")
+    if out_time_us is None or out_time_us < 0:
+        # no frame was written yet
+        out_time_us = out_time = None
+    return {"frame": _parse_number(values.get("frame"), int),
+            "fps": _parse_number(values.get("fps"), float),
+            "speed": _parse_number(values.get("speed"), float),
+            "out_time": out_time,
+            "out_time_seconds": out_time_us / 1000000.0 if out_time_us is not None else None,
+            "done": values.get("progress") == "end"}
+
+
+# =============================================================================
+# public
+# =============================================================================
+def subscribe(callback):
+    """
+    Subscribes a function to all emitted events.
+
+    Events are dicts holding at least the event name and the epoch time it was
+    emitted at. Callbacks are called from the thread emitting the event.
+
+    :param callback: function called with each event
+    :type callback: callable
+    """
+    with _SUBSCRIBERS_LOCK:
+        if callback not in _SUBSCRIBERS:
+            _SUBSCRIBERS.append(callback)
+
+
+def unsubscribe(callback):
+    """
+    Unsubscribes a function from the emitted events.
+
+    :param callback: function previously subscribed
+    :type callback: callable
+    """
+    with _SUBSCRIBERS_LOCK:
+        if callback in _SUBSCRIBERS:
+            _SUBSCRIBERS.remove(callback)
+
+
+def is_enabled():
+    """
+    Returns whether any function is subscribed to the events.
+
+    :rtype: bool
+    """
+    return bool(_SUBSCRIBERS)
+
+
+def emit(name, **data):
+    """
+    Emits an event to all subscribers.
+
+    :param name: name of the event
+    :type name: str
+
+    :param data: data of the event
+    :type data: dict
+    """
+    if not _SUBSCRIBERS:
+        return
+
+    event = {"event": name, "time": time.time()}
+    event.update(_get_context())
+    event.update(data)
+    with _SUBSCRIBERS_LOCK:
+        callbacks = list(_SUBSCRIBERS)
+    for callback in callbacks:
+        callback(event)
+
+
+@contextlib.contextmanager
+def context(**fields):
+    """
+    Adds fields to all events emitted by the current thread within the block.
+
+    :param fields: fields to add to the events
+    :type fields: dict
+    """
+    current = _get_context()
+    previous = dict(current)
+    current.update(fields)
+    try:
+        yield
+    finally:
+        current.clear()
+        current.update(previous)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Times a stage of the pipeline, emitting the stage_started event on enter
+    and the stage_finished event holding its wall time on exit.
+
+    Events emitted within the block hold the name of the stage.
+
+    :param name: name of the stage
+    :type name: str
+    """
+    with context(stage=name):
+        emit("stage_started")
+        start = time.time()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = str(e) or e.__class__.__name__
+            raise
+        finally:
+            emit("stage_finished", elapsed=time.time() - start, error=error)
+
+
+def read_progress(stream):
+    """
+    Reads the output of ffmpeg -progress, emitting a progress event holding
+    the frame, fps, speed and out_time for each reported block.
+
+    :param stream: binary stream to read the progress from
+    :type stream: io.RawIOBase
+    """
+    values = {}
+    for line in iter(stream.readline, b""):
+        key, sep, value = line.decode("utf-8", "replace").strip().partition("=")
+        if not sep:
+            continue
+        values[key] = value
+        if key == "progress":
+            emit("progress", **_parse_progress(values))
+            values = {}
+
+
+def print_progress(event, stream=None):
+    """
+    Subscriber printing stage timings and progress in a human readable way.
+
+    :param event: event to print
+    :type event: dict
+
+    :param stream: file-like object to print to, defaults to stderr
+    :type stream: io.TextIOBase
+    """
+    stream = stream or sys.stderr
+    if event["event"] == "progress":
+        msg = "{input_file} frame={frame} fps={fps} speed={speed}x time={out_time}"
+    elif event["event"] == "stage_finished":
+        msg = "{input_file} {stage} {elapsed:.3f}s"
+    else:
+        return
+    fields = {"input_file": "-"}
+    fields.update((key, "N/A" if value is None else value) for key, value in event.items())
+    stream.write(msg.format(**fields) + "\n")
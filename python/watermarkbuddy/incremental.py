@@ -0,0 +1,232 @@
+# stdlib modules
+from __future__ import absolute_import
+import os
+import json
+import time
+import tempfile
+
+# tool modules
+from watermarkbuddy import cache
+from watermarkbuddy import watermarkbuddy
+
+# settings which do not change the output, e.g. threads is derived from the
+# number of files in a batch, so changing them never re-creates an output
+_UNTRACKED_SETTINGS = ("threads",)
+
+
+# =============================================================================
+# classes
+# =============================================================================
+class Manifest(object):
+    """
+    Record of the inputs and settings each output file was created from.
+
+    An output is up to date if it exists and its input file, watermark
+    content and settings did not change since it was recorded. The manifest
+    is saved atomically, so an interrupted run never leaves it corrupt.
+    """
+
+    def __init__(self, path, hash_inputs=False, save_interval=1.0):
+        """
+        Initializes the object.
+
+        :param path: json file to store the manifest in
+        :type path: str
+
+        :param hash_inputs: set True to compare the content of input files
+                            whose size or modification time changed, so
+                            touched but unchanged files are not processed
+        :type hash_inputs: bool
+
+        :param save_interval: minimum amount of seconds between saves
+        :type save_interval: float
+        """
+        self.path = path
+        self.hash_inputs = hash_inputs
+        self.save_interval = save_interval
+        self._entries = {}
+        self._digests = {}
+        self._dirty = False
+        self._last_save = 0.0
+        if os.path.exists(path):
+            with open(path) as fp:
+                self._entries = json.load(fp)
+
+    def _get_digest(self, file_path, stat):
+        """
+        Returns the content hash of a file, memoized on its size and mtime.
+
+        :param file_path: file to hash
+        :type file_path: str
+
+        :param stat: stat result of the file
+        :type stat: os.stat_result
+
+        :rtype: str
+        """
+        key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime)
+        digest = self._digests.get(key)
+        if digest is None:
+            digest = cache.hash_file(file_path)
+            self._digests[key] = digest
+        return digest
+
+    def _get_input_record(self, job, stat, entry=None):
+        """
+        Returns the record of the input file of a job.
+
+        The content hash is only computed if inputs are hashed and the size or
+        modification time differ from the recorded entry, or the entry was
+        recorded without hashing inputs.
+
+        :param job: job to get the input record of
+        :type job: watermarkbuddy.batch.Job
+
+        :param stat: stat result of the input file
+        :type stat: os.stat_result
+
+        :param entry: recorded entry of the job output
+        :type entry: dict
+
+        :rtype: dict
+        """
+        record = {"size": stat.st_size, "mtime": stat.st_mtime}
+        if not self.hash_inputs:
+            return record
+
+        previous = (entry or {}).get("input", {})
+        if previous.get("sha1") and previous.get("size") == stat.st_size and previous.get("mtime") == stat.st_mtime:
+            record["sha1"] = previous["sha1"]
+        else:
+            record["sha1"] = self._get_digest(job.input_file, stat)
+        return record
+
+    def _get_record(self, job, entry=None):
+        """
+        Returns the record describing how a job creates its output.
+
+        :param job: job to get the record of
+        :type job: watermarkbuddy.batch.Job
+
+        :param entry: recorded entry of the job output
+        :type entry: dict
+
+        :rtype: dict
+        """
+        input_stat = os.stat(job.input_file)
+        watermark_stat = os.stat(job.watermark_file)
+
+        # only keep plain settings affecting the output, caches do not, stored
+        # as json so tuples compare equal to the lists read back
+        settings = dict((key, json.loads(json.dumps(value))) for key, value in job.options.items()
+                        if key not in _UNTRACKED_SETTINGS and _is_plain(value))
+
+        return {"input": self._get_input_record(job, input_stat, entry),
+                "watermark": self._get_digest(job.watermark_file, watermark_stat),
+                "settings": settings}
+
+    @staticmethod
+    def _is_same_input(recorded, current):
+        """
+        Returns whether a recorded input matches the current input.
+
+        The content hashes are compared if both records hold one, else the
+        size and modification time.
+
+        :param recorded: recorded input record
+        :type recorded: dict
+
+        :param current: current input record
+        :type current: dict
+
+        :rtype: bool
+        """
+        if recorded.get("sha1") and current.get("sha1"):
+            return recorded["sha1"] == current["sha1"]
+        return (recorded.get("size"), recorded.get("mtime")) == (current["size"], current["mtime"])
+
+    def is_up_to_date(self, job):
+        """
+        Returns whether the output of a job is up to date.
+
+        :param job: job to check
+        :type job: watermarkbuddy.batch.Job
+
+        :rtype: bool
+        """
+        entry = self._entries.get(os.path.abspath(job.output_file))
+        if entry is None or not os.path.exists(job.output_file):
+            return False
+
+        record = self._get_record(job, entry)
+        if record["watermark"] != entry.get("watermark"):
+            return False
+        if record["settings"] != entry.get("settings"):
+            return False
+        return self._is_same_input(entry.get("input", {}), record["input"])
+
+    def update(self, job):
+        """
+        Records the output of a job as up to date.
+
+        :param job: job which successfully created its output
+        :type job: watermarkbuddy.batch.Job
+        """
+        key = os.path.abspath(job.output_file)
+        self._entries[key] = self._get_record(job, self._entries.get(key))
+        self._dirty = True
+        if time.time() - self._last_save >= self.save_interval:
+            self.save()
+
+    def save(self):
+        """Writes the manifest to disk, if it changed."""
+        if not self._dirty:
+            return
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fp, tmp_path = tempfile.mkstemp(prefix=".manifest.", dir=directory)
+        try:
+            with os.fdopen(fp, "w") as f:
+                json.dump(self._entries, f, indent=1, sort_keys=True)
+            replace_file(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        self._dirty = False
+        self._last_save = time.time()
+
+
+# =============================================================================
+# private
+# =============================================================================
+def _is_plain(value):
+    """
+    Returns whether a setting is a plain value, or a list or tuple of them,
+    which can be stored in the manifest.
+
+    :param value: value of the setting
+    :type value: object
+
+    :rtype: bool
+    """
+    if isinstance(value, (list, tuple)):
+        return all(_is_plain(item) for item in value)
+    return isinstance(value, (bool, int, float, watermarkbuddy.basestring, type(None)))
+
+
+# =============================================================================
+# public
+# =============================================================================
+def replace_file(src, dst):
+    """
+    Renames a file, atomically replacing the destination if it exists.
+
+    :param src: file to rename
+    :type src: str
+
+    :param dst: new file path
+    :type dst: str
+    """
+    replace = getattr(os, "replace", os.rename)
+    replace(src, dst)
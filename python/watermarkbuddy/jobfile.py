@@ -0,0 +1,437 @@
+# stdlib modules
+from __future__ import absolute_import
+import os
+import csv
+import json
+import time
+import functools
+from multiprocessing.pool import ThreadPool
+
+# tool modules
+from watermarkbuddy import batch
+from watermarkbuddy import incremental
+from watermarkbuddy import process
+from watermarkbuddy import watermarkbuddy
+
+# third party modules
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# keys of a job file row and the type of their value
+_ROW_TYPES = {"input_file": str,
+              "output_file": str,
+              "watermark_file": str,
+              "autoscale": bool,
+              "position": str,
+              "offset_x": int,
+              "offset_y": int,
+              "blend_mode": str,
+              "backend": str,
+              "profile": str,
+              "start": float,
+              "end": float,
+              "fade_in": float,
+              "fade_out": float,
+              "loop_watermark": bool}
+
+# keys holding file paths, resolved against the directory of the job file
+_PATH_KEYS = ("input_file", "output_file", "watermark_file")
+
+# options which may differ between the variants of a fan-out
+_VARIANT_KEYS = ("autoscale", "position", "offset_x", "offset_y", "blend_mode", "profile")
+
+# options add_watermark_variants does not support, keeping a job out of a
+# fan-out when set
+_TIMELINE_KEYS = ("start", "end", "windows", "fade_in", "fade_out", "loop_watermark")
+
+# values of a boolean cell in a csv job file
+_TRUE_VALUES = ("1", "true", "yes", "on")
+_FALSE_VALUES = ("0", "false", "no", "off")
+
+
+# =============================================================================
+# private
+# =============================================================================
+def _validate_yaml():
+    """
+    Validates the third party module to read yaml job files is installed.
+
+    :raises RuntimeError: if PyYAML is not installed
+    """
+    if yaml is None:
+        raise RuntimeError("yaml job files require PyYAML to be installed")
+
+
+def _convert_value(key, value):
+    """
+    Converts the value of a row to the type of its key.
+
+    :param key: key of the value
+    :type key: str
+
+    :param value: value to convert, possibly a string read from csv
+    :type value: object
+
+    :raises ValueError: if the value cannot be converted
+
+    :rtype: object
+    """
+    cast = _ROW_TYPES[key]
+    if cast is bool and not isinstance(value, bool):
+        text = str(value).strip().lower()
+        if text not in _TRUE_VALUES + _FALSE_VALUES:
+            raise ValueError("invalid {} {!r}".format(key, value))
+        return text in _TRUE_VALUES
+    if cast is str:
+        return value
+    return cast(value)
+
+
+def _convert_row(row, defaults, directory):
+    """
+    Converts a row of a job file to a job.
+
+    :param row: values of the row, empty values falling back to the defaults
+    :type row: dict
+
+    :param defaults: values of keys missing in the row
+    :type defaults: dict
+
+    :param directory: directory to resolve relative paths against
+    :type directory: str
+
+    :raises ValueError: if the row is invalid
+
+    :rtype: watermarkbuddy.batch.Job
+    """
+    values = dict(defaults)
+    values.update((key, value) for key, value in row.items() if value not in (None, ""))
+
+    # csv rows hold extra cells under None
+    unknown = sorted(str(key) for key in set(values) - set(_ROW_TYPES))
+    if unknown:
+        raise ValueError("unknown keys: {}".format(", ".join(unknown)))
+    missing = [key for key in _PATH_KEYS if not values.get(key)]
+    if missing:
+        raise ValueError("missing keys: {}".format(", ".join(missing)))
+
+    values = dict((key, _convert_value(key, value)) for key, value in values.items())
+    for key in _PATH_KEYS:
+        values[key] = os.path.join(directory, os.path.expanduser(values[key]))
+    return batch.Job(values.pop("input_file"),
+                     values.pop("watermark_file"),
+                     values.pop("output_file"),
+                     **values)
+
+
+def _read_rows(path):
+    """
+    Reads the rows of a json, yaml or csv job file.
+
+    Json and yaml job files hold a list of rows, or a mapping holding the rows
+    under "jobs" and the values shared by all rows under "defaults". Csv job
+    files hold a header naming the keys of the columns.
+
+    :param path: job file to read
+    :type path: str
+
+    :raises ValueError: if the format is unsupported or the content invalid
+
+    :return: rows and the defaults
+    :rtype: tuple[list[dict], dict]
+    """
+    ext = os.path.splitext(path)[1].lower()
+    with open(path) as fp:
+        if ext == ".csv":
+            return list(csv.DictReader(fp)), {}
+        if ext == ".json":
+            data = json.load(fp)
+        elif ext in (".yaml", ".yml"):
+            _validate_yaml()
+            data = yaml.safe_load(fp)
+        else:
+            raise ValueError("unsupported job file format {!r}".format(ext))
+
+    if isinstance(data, dict):
+        return data.get("jobs") or [], data.get("defaults") or {}
+    if not isinstance(data, list):
+        raise ValueError("job file must hold a list of jobs")
+    return data, {}
+
+
+def _get_fan_out_key(job):
+    """
+    Returns the key of the fan-out a job can be part of, being the jobs which
+    share the input file and all options but the variant ones.
+
+    :param job: job to get the key of
+    :type job: watermarkbuddy.batch.Job
+
+    :return: key, None if the job cannot be part of a fan-out
+    :rtype: tuple
+    """
+    options = job.options
+    if options.get("backend", "ffmpeg") != "ffmpeg":
+        return None
+    if any(options.get(key) not in (None, False, []) for key in _TIMELINE_KEYS):
+        return None
+    # caches compare by identity, as their default representation holds it
+    shared = sorted((key, repr(value)) for key, value in options.items() if key not in _VARIANT_KEYS)
+    return (os.path.abspath(job.input_file), tuple(shared))
+
+
+def _get_geometry_key(job):
+    """
+    Returns the key sorting jobs sharing a watermark and its geometry next to
+    each other, so scaled watermarks and probes are reused while still warm.
+
+    :param job: job to get the key of
+    :type job: watermarkbuddy.batch.Job
+
+    :rtype: tuple
+    """
+    options = job.options
+    return (os.path.abspath(job.watermark_file),
+            bool(options.get("autoscale")),
+            options.get("position") or "top-left",
+            int(options.get("offset_x") or 0),
+            int(options.get("offset_y") or 0),
+            options.get("blend_mode") or "normal",
+            job.input_file)
+
+
+def _get_variant(job, output_file):
+    """
+    Returns the variant creating the output of a job in a fan-out, see
+    watermarkbuddy.add_watermark_variants.
+
+    :param job: job to get the variant of
+    :type job: watermarkbuddy.batch.Job
+
+    :param output_file: output file path of the variant
+    :type output_file: str
+
+    :rtype: dict
+    """
+    variant = dict((key, job.options[key]) for key in _VARIANT_KEYS if key in job.options)
+    variant.update(watermark_file=job.watermark_file, output_file=output_file)
+    return variant
+
+
+def _run_fan_out(jobs, timeout=None, max_rss=None):
+    """
+    Executes jobs sharing an input file with a single ffmpeg command, decoding
+    the input only once, see watermarkbuddy.add_watermark_variants.
+
+    Outputs are written to tmp files next to them, renamed once all complete.
+
+    :param jobs: jobs sharing an input file
+    :type jobs: list[watermarkbuddy.batch.Job]
+
+    :param timeout: maximum amount of seconds the jobs may run
+    :type timeout: float
+
+    :param max_rss: maximum resident memory of each ffmpeg process in bytes
+    :type max_rss: int
+
+    :rtype: list[watermarkbuddy.batch.JobResult]
+    """
+    if len(jobs) == 1:
+        return [batch.run_job(jobs[0], timeout, max_rss)]
+
+    start = time.time()
+    error = None
+    tmp_outputs = []
+    options = jobs[0].options
+    try:
+        variants = []
+        for job in jobs:
+            tmp_outputs.append(batch.make_tmp_output(job.output_file))
+            variants.append(_get_variant(job, tmp_outputs[-1]))
+
+        with process.limits(timeout, max_rss):
+            watermarkbuddy.add_watermark_variants(jobs[0].input_file,
+                                                  variants,
+                                                  cache=options.get("cache"),
+                                                  single_pass=options.get("single_pass"),
+                                                  probe_cache=options.get("probe_cache"),
+                                                  threads=options.get("threads"))
+        for job, tmp_output in zip(jobs, tmp_outputs):
+            incremental.replace_file(tmp_output, job.output_file)
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+        for tmp_output in tmp_outputs:
+            if os.path.exists(tmp_output):
+                os.remove(tmp_output)
+
+    elapsed = time.time() - start
+    return [batch.JobResult(job, elapsed, error=error) for job in jobs]
+
+
+def _map_groups(groups, workers, callback=None, timeout=None, max_rss=None):
+    """
+    Executes groups of jobs on a pool of threads, see batch._map_jobs.
+
+    :param groups: groups of jobs to execute, see group_jobs
+    :type groups: list[list[watermarkbuddy.batch.Job]]
+
+    :param workers: maximum amount of concurrent groups
+    :type workers: int
+
+    :param callback: function called with each JobResult once it completes
+    :type callback: callable
+
+    :param timeout: maximum amount of seconds each group may run
+    :type timeout: float
+
+    :param max_rss: maximum resident memory of each ffmpeg process in bytes
+    :type max_rss: int
+
+    :rtype: list[watermarkbuddy.batch.JobResult]
+    """
+    results = []
+    if not groups:
+        return results
+
+    run_fan_out = functools.partial(_run_fan_out, timeout=timeout, max_rss=max_rss)
+    pool = ThreadPool(min(workers, len(groups)))
+    try:
+        for group_results in pool.imap_unordered(run_fan_out, groups):
+            for result in group_results:
+                results.append(result)
+                if callback:
+                    callback(result)
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return results
+
+
+# =============================================================================
+# public
+# =============================================================================
+def load_jobs(path, **options):
+    """
+    Loads the jobs listed in a json, yaml or csv job file.
+
+    Each row holds the input_file, output_file and watermark_file keys and
+    optionally the autoscale, position, offset_x, offset_y, blend_mode,
+    backend, profile, start and end keys, matching the arguments of
+    add_watermark. Relative paths are resolved against the directory of the
+    job file. Yaml job files require PyYAML.
+
+    :param path: job file to load
+    :type path: str
+
+    :param options: keyword arguments passed to add_watermark for all jobs,
+                    e.g. the caches, overridden by the values of the rows
+    :type options: dict
+
+    :raises ValueError: if the job file or one of its rows is invalid
+
+    :rtype: list[watermarkbuddy.batch.Job]
+    """
+    rows, defaults = _read_rows(path)
+    directory = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for index, row in enumerate(rows, 1):
+        try:
+            if not isinstance(row, dict):
+                raise ValueError("row must be a mapping")
+            job = _convert_row(row, defaults, directory)
+        except (ValueError, TypeError) as e:
+            raise ValueError("{}: job {}: {}".format(path, index, e))
+        merged = dict(options)
+        merged.update(job.options)
+        job.options = merged
+        jobs.append(job)
+    return jobs
+
+
+def group_jobs(jobs):
+    """
+    Groups jobs to execute together.
+
+    Jobs sharing an input file and all options but the variant ones form a
+    fan-out, decoding the input only once. Groups are ordered by watermark and
+    geometry, so jobs reusing the same scaled watermark and probes run close
+    to each other.
+
+    :param jobs: jobs to group
+    :type jobs: list[watermarkbuddy.batch.Job]
+
+    :rtype: list[list[watermarkbuddy.batch.Job]]
+    """
+    groups = []
+    fan_outs = {}
+    for job in sorted(jobs, key=_get_geometry_key):
+        key = _get_fan_out_key(job)
+        if key is None:
+            groups.append([job])
+        elif key in fan_outs:
+            fan_outs[key].append(job)
+        else:
+            fan_outs[key] = [job]
+            groups.append(fan_outs[key])
+    return groups
+
+
+def run_jobs(jobs, workers=None, callback=None, manifest=None, timeout=None, max_rss=None):
+    """
+    Executes jobs grouped by input file, watermark and geometry concurrently,
+    see group_jobs.
+
+    A failing job does not stop the run, its error is stored on its result.
+
+    :param jobs: jobs to execute
+    :type jobs: list[watermarkbuddy.batch.Job]
+
+    :param workers: maximum amount of concurrent groups, defaults to CPU count
+    :type workers: int
+
+    :param callback: function called with each JobResult once it completes
+    :type callback: callable
+
+    :param manifest: manifest to skip jobs with an up to date output with,
+                     updated with each succeeded job
+    :type manifest: watermarkbuddy.incremental.Manifest
+
+    :param timeout: maximum amount of seconds each group may run, None for no
+                    limit
+    :type timeout: float
+
+    :param max_rss: maximum resident memory of each ffmpeg process in bytes,
+                    None for no limit
+    :type max_rss: int
+
+    :rtype: watermarkbuddy.batch.BatchResult
+    """
+    workers = workers or batch.get_default_workers()
+    if workers < 1:
+        raise ValueError("invalid amount of workers {!r}".format(workers))
+
+    start = time.time()
+    results, jobs = batch._skip_up_to_date(list(jobs), manifest)
+    if callback:
+        for result in results:
+            callback(result)
+
+    def on_result(result):
+        if manifest is not None and result.succeeded:
+            manifest.update(result.job)
+        if callback:
+            callback(result)
+
+    try:
+        results.extend(_map_groups(group_jobs(jobs), workers, on_result, timeout, max_rss))
+    finally:
+        if manifest is not None:
+            manifest.save()
+
+    return batch.BatchResult(results, time.time() - start)
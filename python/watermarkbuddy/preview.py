@@ -0,0 +1,351 @@
+# stdlib modules
+from __future__ import absolute_import
+from __future__ import division
+import io
+import os
+import threading
+import collections
+
+# tool modules
+from watermarkbuddy import events
+from watermarkbuddy import process
+from watermarkbuddy import watermarkbuddy
+
+
+# =============================================================================
+# classes
+# =============================================================================
+class Frame(object):
+    """Decoded frame of a file to render previews on."""
+
+    def __init__(self, data, width, height, scale, input_args=None):
+        """
+        Initializes the object.
+
+        :param data: frame as raw video in a nut container, keeping the pixel
+                     format of the source
+        :type data: bytes
+
+        :param width: width of the frame
+        :type width: int
+
+        :param height: height of the frame
+        :type height: int
+
+        :param scale: ratio between the size of the frame and the source
+        :type scale: float
+
+        :param input_args: ffmpeg input arguments restoring the color
+                           properties of the source, not stored by nut
+        :type input_args: list[str]
+        """
+        self.data = data
+        self.width = width
+        self.height = height
+        self.scale = scale
+        self.input_args = list(input_args or [])
+
+
+class FrameCache(object):
+    """
+    In-memory cache of decoded frames, so previews of the same file only pay
+    for compositing the watermark.
+
+    Entries are keyed by the file path, size and modification time, the time
+    of the frame and the maximum size of the proxy. Once the total size
+    exceeds the maximum, the least recently used entries are evicted.
+    """
+
+    def __init__(self, max_size=64 * 1024 * 1024):
+        """
+        Initializes the object.
+
+        :param max_size: maximum total size of the cached frames in bytes
+        :type max_size: int
+        """
+        self.max_size = max_size
+        self._frames = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self):
+        """Evicts the least recently used frames exceeding the maximum size."""
+        size = sum(len(frame.data) for frame in self._frames.values())
+        while size > self.max_size and len(self._frames) > 1:
+            _, frame = self._frames.popitem(last=False)
+            size -= len(frame.data)
+
+    def get_frame(self, input_file, time=0.0, max_size=None, probe_cache=None):
+        """
+        Returns a frame of a file, decoding it if not cached yet.
+
+        :param input_file: image or video to decode a frame of
+        :type input_file: str
+
+        :param time: time in seconds of the frame, ignored for images
+        :type time: float
+
+        :param max_size: maximum width and height of the frame, larger frames
+                         are downscaled to a proxy, None to keep the source size
+        :type max_size: int
+
+        :param probe_cache: cache to reuse probed stream data from
+        :type probe_cache: watermarkbuddy.cache.ProbeCache
+
+        :rtype: Frame
+        """
+        stat = os.stat(input_file)
+        key = (os.path.abspath(input_file), stat.st_size, stat.st_mtime, time, max_size)
+        with self._lock:
+            frame = self._frames.pop(key, None)
+            if frame is not None:
+                self._frames[key] = frame
+                return frame
+
+        frame = _decode_frame(input_file, time, max_size, probe_cache)
+        with self._lock:
+            self._frames[key] = frame
+            self._evict()
+        return frame
+
+    def clear(self):
+        """Removes all cached frames."""
+        with self._lock:
+            self._frames.clear()
+
+
+# frames decoded by render_preview when no cache is given
+_FRAME_CACHE = FrameCache()
+
+
+# =============================================================================
+# private
+# =============================================================================
+def _get_proxy_size(width, height, max_size):
+    """
+    Returns the size of a proxy fitting a maximum size, keeping aspect ratio.
+
+    :param width: width of the source
+    :type width: int
+
+    :param height: height of the source
+    :type height: int
+
+    :param max_size: maximum width and height, None to keep the source size
+    :type max_size: int
+
+    :return: width and height of the proxy
+    :rtype: tuple[int, int]
+    """
+    if not max_size or max(width, height) <= max_size:
+        return width, height
+    scale = max_size / max(width, height)
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def _get_color_args(stream_data):
+    """
+    Returns the ffmpeg input arguments tagging a decoded frame with the color
+    range and space of its source.
+
+    :param stream_data: video stream data of the source
+    :type stream_data: dict
+
+    :rtype: list[str]
+    """
+    args = []
+    for key, option in (("color_range", "-color_range"), ("color_space", "-colorspace")):
+        value = stream_data.get(key)
+        if value and value != "unknown":
+            args.extend([option, value])
+    return args
+
+
+def _decode_frame(input_file, time, max_size, probe_cache=None):
+    """
+    Decodes a frame of a file, downscaled to a proxy if it exceeds a size.
+
+    :param input_file: image or video to decode a frame of
+    :type input_file: str
+
+    :param time: time in seconds of the frame, ignored for images
+    :type time: float
+
+    :param max_size: maximum width and height of the frame, None to keep the
+                     source size
+    :type max_size: int
+
+    :param probe_cache: cache to reuse probed stream data from
+    :type probe_cache: watermarkbuddy.cache.ProbeCache
+
+    :rtype: Frame
+    """
+    stream_data = watermarkbuddy.get_stream_data(input_file, probe_cache)
+    src_width = int(stream_data["width"])
+    width, height = _get_proxy_size(src_width, int(stream_data["height"]), max_size)
+
+    args = ["ffmpeg", "-hide_banner", "-v", "error"]
+    if time:
+        # seek the input, only decoding from the keyframe before the time
+        args.extend(["-ss", str(time)])
+    args.extend(["-i", input_file, "-map", "0:v:0", "-frames:v", "1"])
+    if width != src_width:
+        args.extend(["-vf", "scale={}:{}".format(width, height)])
+    # raw video keeps the pixel format of the source, so the preview matches
+    # the output of add_watermark
+    args.extend(["-c:v", "rawvideo", "-f", "nut", "pipe:1"])
+
+    with events.stage("decode"):
+        data = process.run(args, capture=True)
+    if not data:
+        raise RuntimeError("no frame at {}s: {}".format(time, input_file))
+    return Frame(data, width, height, width / src_width, _get_color_args(stream_data))
+
+
+def _get_filter_complex(frame, autoscale, position, offset_x, offset_y, blend_mode):
+    """
+    Builds the ffmpeg filter graph applying the watermark on a frame, being
+    the one of add_watermark with the watermark and offsets scaled to the
+    proxy size.
+
+    :param frame: frame to render the preview on
+    :type frame: Frame
+
+    :param autoscale: set True to resize watermark to the frame
+    :type autoscale: bool
+
+    :param position: initial position of the watermark
+    :type position: str
+
+    :param offset_x: X-axis offset of the watermark in source pixels
+    :type offset_x: int
+
+    :param offset_y: Y-axis offset of the watermark in source pixels
+    :type offset_y: int
+
+    :param blend_mode: video filter to apply watermark with
+    :type blend_mode: str
+
+    :rtype: str
+    """
+    scale2ref = None
+    watermark = "[1:v]"
+    scale = ""
+    if autoscale:
+        overlay = watermarkbuddy._get_overlay("top-left", offset_x=0, offset_y=0)
+        scale2ref = watermarkbuddy._get_scale2ref_expression(None)
+        if scale2ref is None:
+            # scale to the width of the frame, as the separate pass does
+            scale = "[1:v]scale={}:-1[wm];".format(frame.width)
+            watermark = "[wm]"
+    else:
+        overlay = watermarkbuddy._get_overlay(position,
+                                              offset_x=int(round(int(offset_x) * frame.scale)),
+                                              offset_y=int(round(int(offset_y) * frame.scale)))
+        if frame.scale != 1:
+            scale = "[1:v]scale=w='max(1,round(iw*{}))':h=-1[wm];".format(frame.scale)
+            watermark = "[wm]"
+
+    return scale + watermarkbuddy._get_filter_complex(overlay,
+                                                      blend_mode,
+                                                      scale2ref=scale2ref,
+                                                      watermark=watermark)
+
+
+# =============================================================================
+# public
+# =============================================================================
+def render_preview(input_file,
+                   watermark_file,
+                   autoscale=False,
+                   position="top-left",
+                   offset_x=0,
+                   offset_y=0,
+                   blend_mode="normal",
+                   time=0.0,
+                   max_size=None,
+                   output_format="png",
+                   frame_cache=None,
+                   probe_cache=None):
+    """
+    Renders a single frame of a file with a watermark, to iterate on the
+    watermark settings without encoding the whole file.
+
+    The frame is decoded once and cached, later previews of the same frame
+    only composite the watermark with the filter graph of add_watermark.
+    Large frames can be downscaled to a proxy, scaling the watermark and
+    offsets along.
+
+    :param input_file: image or video to preview the watermark on
+    :type input_file: str
+
+    :param watermark_file: file to use as watermark
+    :type watermark_file: str
+
+    :param autoscale: set True to resize watermark to input file
+    :type autoscale: bool
+
+    :param position: initial position of the watermark
+    :type position: str
+
+    :param offset_x: X-axis offset of the watermark
+    :type offset_x: int
+
+    :param offset_y: Y-axis offset of the watermark
+    :type offset_y: int
+
+    :param blend_mode: video filter to apply watermark with
+    :type blend_mode: str
+
+    :param time: time in seconds of the frame, ignored for images
+    :type time: float
+
+    :param max_size: maximum width and height of the preview, larger frames
+                     are downscaled, None to keep the source size
+    :type max_size: int
+
+    :param output_format: file extension or ffmpeg format name of the preview
+    :type output_format: str
+
+    :param frame_cache: cache to reuse decoded frames from, defaults to one
+                        shared by the process
+    :type frame_cache: FrameCache
+
+    :param probe_cache: cache to reuse probed stream data from
+    :type probe_cache: watermarkbuddy.cache.ProbeCache
+
+    :return: rendered preview
+    :rtype: bytes
+    """
+    # validate dirs/files exists
+    if not os.path.exists(input_file):
+        msg = "input file does not exist: {}"
+        raise ValueError(msg.format(input_file))
+    if not os.path.exists(watermark_file):
+        msg = "watermark file does not exist: {}"
+        raise ValueError(msg.format(watermark_file))
+
+    # validate values for ffmpeg
+    watermarkbuddy.validate_position(position)
+    watermarkbuddy.validate_offset(offset_x)
+    watermarkbuddy.validate_offset(offset_y)
+    watermarkbuddy.validate_blend_mode(blend_mode)
+
+    frame_cache = frame_cache or _FRAME_CACHE
+    with events.context(input_file=input_file):
+        frame = frame_cache.get_frame(input_file, time, max_size, probe_cache)
+        fitler_complex = _get_filter_complex(frame, autoscale, position, offset_x, offset_y, blend_mode)
+
+        # build arguments
+        args = ["ffmpeg",
+                "-hide_banner",  # hide ffmpeg version info
+                "-v", "error"]  # only report errors
+        args.extend(frame.input_args)
+        args.extend(["-f", "nut", "-i", "pipe:0",  # cached frame from stdin
+                     "-i", watermark_file,  # watermark
+                     "-filter_complex", fitler_complex])
+        args.extend(watermarkbuddy._get_pipe_format_args(output_format,
+                                                         watermarkbuddy._PIPE_OUTPUT_FORMATS))
+        args.append("pipe:1")  # write to stdout
+
+        with events.stage("preview"):
+            return process.run(args, capture=True, input_stream=io.BytesIO(frame.data))
@@ -0,0 +1,586 @@
+# stdlib modules
+from __future__ import absolute_import
+import io
+import os
+import time
+import functools
+import threading
+import contextlib
+import subprocess
+import collections
+
+# tool modules
+from watermarkbuddy import events
+
+# Streaming subprocess runner. Output is read incrementally as the process
+# writes it, only keeping the last lines of stderr to report errors with, so
+# the memory used per command stays flat no matter how long it runs.
+
+# maximum amount of stderr lines kept to report errors with
+_TAIL_LINES = 32
+
+# maximum amount of bytes kept per stderr line, longer lines are truncated
+_MAX_LINE_LENGTH = 4096
+
+# amount of bytes read or written at once
+_CHUNK_SIZE = 64 * 1024
+
+# seconds between two checks of the limits of a running process
+_WATCH_INTERVAL = 0.1
+
+# running subprocesses, see terminate_processes
+_PROCESSES = set()
+_PROCESSES_LOCK = threading.Lock()
+
+# limits of the commands executed by the current thread, see limits
+_LIMITS = threading.local()
+
+# process group of the commands executed by the current thread, see group
+_GROUP = threading.local()
+
+
+# =============================================================================
+# classes
+# =============================================================================
+class Tail(object):
+    """Bounded buffer keeping the last lines written to a stream."""
+
+    def __init__(self, max_lines=_TAIL_LINES, max_line_length=_MAX_LINE_LENGTH):
+        """
+        Initializes the object.
+
+        :param max_lines: maximum amount of lines to keep
+        :type max_lines: int
+
+        :param max_line_length: maximum amount of bytes to keep per line
+        :type max_line_length: int
+        """
+        self.max_line_length = max_line_length
+        self._lines = collections.deque(maxlen=max_lines)
+        self._partial = b""
+
+    def feed(self, data):
+        """
+        Adds data to the buffer, dropping the oldest lines.
+
+        Carriage returns end a line too, as ffmpeg rewrites its status line.
+
+        :param data: data to add
+        :type data: bytes
+        """
+        lines = (self._partial + data).replace(b"\r", b"\n").split(b"\n")
+        self._partial = lines.pop()[:self.max_line_length]
+        for line in lines:
+            if line.strip():
+                self._lines.append(line[:self.max_line_length])
+
+    def read(self, stream):
+        """
+        Feeds a stream to the buffer until it is exhausted.
+
+        :param stream: binary stream to read
+        :type stream: io.RawIOBase
+        """
+        # os.read returns what is available, rather than waiting for a chunk
+        fd = stream.fileno()
+        for chunk in iter(lambda: os.read(fd, _CHUNK_SIZE), b""):
+            self.feed(chunk)
+
+    def get_text(self):
+        """
+        Returns the kept lines.
+
+        :rtype: str
+        """
+        lines = list(self._lines)
+        if self._partial.strip():
+            lines.append(self._partial)
+        return b"\n".join(lines).decode("utf-8", "replace")
+
+
+class ProcessGroup(object):
+    """
+    Subprocesses started on behalf of an operation, to kill them at once
+    without affecting the ones of other operations, e.g. to cancel a batch.
+
+    Once terminated, the group refuses to start subprocesses, so a command
+    starting while the group is terminated cannot run to completion.
+    """
+
+    def __init__(self):
+        """Initializes the object."""
+        self._procs = set()
+        self._terminated = False
+        self._lock = threading.Lock()
+
+    def popen(self, args, **kwargs):
+        """
+        Starts a subprocess as part of the group, see subprocess.Popen.
+
+        :param args: arguments representing the command to execute
+        :type args: list
+
+        :raises RuntimeError: if the group was terminated
+
+        :rtype: subprocess.Popen
+        """
+        with self._lock:
+            if self._terminated:
+                raise RuntimeError("{} cancelled".format(os.path.basename(args[0])))
+            # forget the subprocesses which exited and were waited for
+            self._procs = set(proc for proc in self._procs if proc.returncode is None)
+            proc = subprocess.Popen(args, **kwargs)
+            self._procs.add(proc)
+        return proc
+
+    def is_terminated(self):
+        """
+        Returns whether the group was terminated.
+
+        :rtype: bool
+        """
+        return self._terminated
+
+    def terminate(self):
+        """
+        Kills the running subprocesses of the group and refuses new ones.
+
+        :return: amount of killed subprocesses
+        :rtype: int
+        """
+        with self._lock:
+            self._terminated = True
+            procs = [proc for proc in self._procs if proc.returncode is None]
+        for proc in procs:
+            _kill(proc)
+        return len(procs)
+
+
+class _Watchdog(object):
+    """Thread killing a process exceeding its time or memory limit."""
+
+    def __init__(self, proc, deadline=None, max_rss=None):
+        """
+        Initializes the object.
+
+        :param proc: process to watch
+        :type proc: subprocess.Popen
+
+        :param deadline: time the process must have exited by
+        :type deadline: float
+
+        :param max_rss: maximum resident memory of the process in bytes
+        :type max_rss: int
+        """
+        self.proc = proc
+        self.deadline = deadline
+        self.max_rss = max_rss
+        self.reason = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def _check(self):
+        """
+        Returns why the process exceeds its limits.
+
+        :return: reason, None if the process is within its limits
+        :rtype: str
+        """
+        if self.deadline is not None and time.time() > self.deadline:
+            return "exceeded time limit"
+        if self.max_rss is not None:
+            rss = get_rss(self.proc.pid)
+            if rss is not None and rss > self.max_rss:
+                return "exceeded memory limit of {} bytes".format(self.max_rss)
+        return None
+
+    def _run(self):
+        """Checks the limits of the process until it exits."""
+        while not self._stopped.wait(_WATCH_INTERVAL) and self.proc.poll() is None:
+            self.reason = self._check()
+            if self.reason is not None:
+                _kill(self.proc)
+                return
+
+    def start(self):
+        """Starts watching the process."""
+        self._thread.start()
+
+    def stop(self):
+        """Stops watching the process."""
+        self._stopped.set()
+        self._thread.join()
+
+
+# =============================================================================
+# private
+# =============================================================================
+def _kill(proc):
+    """
+    Kills a process, if still running.
+
+    :param proc: process to kill
+    :type proc: subprocess.Popen
+    """
+    try:
+        proc.kill()
+    except OSError:
+        # exited in the meantime
+        pass
+
+
+def _popen(args, **kwargs):
+    """
+    Starts a subprocess, as part of the process group of the current thread
+    if any, see group.
+
+    :param args: arguments representing the command to execute
+    :type args: list
+
+    :raises RuntimeError: if the process group was terminated
+
+    :rtype: subprocess.Popen
+    """
+    process_group = getattr(_GROUP, "group", None)
+    if process_group is not None:
+        return process_group.popen(args, **kwargs)
+    return subprocess.Popen(args, **kwargs)
+
+
+def _start_thread(target, *args):
+    """
+    Runs a function in a daemon thread.
+
+    :param target: function to run
+    :type target: callable
+
+    :rtype: threading.Thread
+    """
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _write_stream(src, dst, chunk_size):
+    """
+    Copies the content of a file-like object to another one, closing the
+    destination once done.
+
+    :param src: file-like object to read from
+    :type src: io.RawIOBase
+
+    :param dst: file-like object to write to
+    :type dst: io.RawIOBase
+
+    :param chunk_size: amount of bytes to copy at once
+    :type chunk_size: int
+    """
+    try:
+        for chunk in iter(lambda: src.read(chunk_size), b""):
+            dst.write(chunk)
+    except (IOError, OSError):
+        # process exited early, its exit code reports the error
+        pass
+    finally:
+        try:
+            dst.close()
+        except (IOError, OSError):
+            pass
+
+
+def _get_limits(timeout, max_rss):
+    """
+    Returns the limits of a command, the tightest of the given ones and the
+    ones of the current thread, see limits.
+
+    :param timeout: maximum amount of seconds the command may run
+    :type timeout: float
+
+    :param max_rss: maximum resident memory of the command in bytes
+    :type max_rss: int
+
+    :return: deadline and maximum resident memory, None if unlimited
+    :rtype: tuple[float, int]
+    """
+    deadline = time.time() + timeout if timeout is not None else None
+    thread_deadline, thread_max_rss = getattr(_LIMITS, "values", (None, None))
+    deadlines = [d for d in (deadline, thread_deadline) if d is not None]
+    max_rsses = [m for m in (max_rss, thread_max_rss) if m is not None]
+    return (min(deadlines) if deadlines else None,
+            min(max_rsses) if max_rsses else None)
+
+
+def _read_stdout(proc, progress, output_stream):
+    """
+    Reads the stdout of a process until it exits.
+
+    :param proc: process to read stdout of
+    :type proc: subprocess.Popen
+
+    :param progress: set True to parse its content as ffmpeg -progress output
+    :type progress: bool
+
+    :param output_stream: file-like object to write its content to
+    :type output_stream: io.RawIOBase
+    """
+    if progress:
+        events.read_progress(proc.stdout)
+        return
+    for chunk in iter(lambda: proc.stdout.read(_CHUNK_SIZE), b""):
+        output_stream.write(chunk)
+
+
+def _start(args, tail, progress, input_stream, output_stream):
+    """
+    Starts a command in a subprocess, along with the threads feeding and
+    reading it, see run.
+
+    :param args: arguments representing the command to execute
+    :type args: list
+
+    :param tail: buffer to read stderr to
+    :type tail: Tail
+
+    :param progress: set True to parse stdout as ffmpeg -progress output
+    :type progress: bool
+
+    :param input_stream: file-like object to feed to stdin, if any
+    :type input_stream: io.RawIOBase
+
+    :param output_stream: file-like object to write stdout to, if any
+    :type output_stream: io.RawIOBase
+
+    :return: process, function reading the output not read by the threads and
+             the started threads
+    :rtype: tuple[subprocess.Popen, callable, list[threading.Thread]]
+    """
+    piped = progress or output_stream is not None
+    # never let the subprocess consume stdin, which may be streamed media
+    with open(os.devnull, "r+b") as devnull:
+        proc = _popen(args,
+                      stdin=subprocess.PIPE if input_stream is not None else devnull,
+                      stdout=subprocess.PIPE if piped else devnull,
+                      stderr=subprocess.PIPE)
+
+    # drain stderr and feed stdin in threads to avoid pipe deadlocks
+    threads = []
+    if piped:
+        threads.append(_start_thread(tail.read, proc.stderr))
+        read = functools.partial(_read_stdout, proc, progress, output_stream)
+    else:
+        read = functools.partial(tail.read, proc.stderr)
+    if input_stream is not None:
+        threads.append(_start_thread(_write_stream, input_stream, proc.stdin, _CHUNK_SIZE))
+    return proc, read, threads
+
+
+def _wait(proc, read, threads, deadline, max_rss):
+    """
+    Reads the output of a running process until it exits, killing it once it
+    exceeds its limits.
+
+    :param proc: running process
+    :type proc: subprocess.Popen
+
+    :param read: function reading the output not read by the threads
+    :type read: callable
+
+    :param threads: threads feeding or reading the process
+    :type threads: list[threading.Thread]
+
+    :param deadline: time the process must have exited by, None for no limit
+    :type deadline: float
+
+    :param max_rss: maximum resident memory of the process in bytes, None for
+                    no limit
+    :type max_rss: int
+
+    :return: why the process was killed, None if it was not
+    :rtype: str
+    """
+    watchdog = None
+    if deadline is not None or max_rss is not None:
+        watchdog = _Watchdog(proc, deadline, max_rss)
+    try:
+        with track_process(proc):
+            if watchdog is not None:
+                watchdog.start()
+            read()
+    except BaseException:
+        _kill(proc)
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+        proc.wait()
+        if watchdog is not None:
+            watchdog.stop()
+    return watchdog.reason if watchdog is not None else None
+
+
+# =============================================================================
+# public
+# =============================================================================
+@contextlib.contextmanager
+def track_process(proc):
+    """
+    Registers a running subprocess within the block, so it can be terminated
+    by terminate_processes.
+
+    :param proc: running subprocess
+    :type proc: subprocess.Popen
+    """
+    with _PROCESSES_LOCK:
+        _PROCESSES.add(proc)
+    try:
+        yield
+    finally:
+        with _PROCESSES_LOCK:
+            _PROCESSES.discard(proc)
+
+
+def terminate_processes():
+    """
+    Kills all running subprocesses started by run.
+
+    :return: amount of killed subprocesses
+    :rtype: int
+    """
+    with _PROCESSES_LOCK:
+        procs = list(_PROCESSES)
+    for proc in procs:
+        _kill(proc)
+    return len(procs)
+
+
+@contextlib.contextmanager
+def limits(timeout=None, max_rss=None):
+    """
+    Limits the commands executed by the current thread within the block.
+
+    The timeout applies to the block as a whole, so a job running several
+    commands shares a single deadline. The memory limit applies to each
+    command. Nested blocks only tighten the limits.
+
+    :param timeout: maximum amount of seconds the block may run, None for no
+                    limit
+    :type timeout: float
+
+    :param max_rss: maximum resident memory of each command in bytes, None for
+                    no limit
+    :type max_rss: int
+    """
+    previous = getattr(_LIMITS, "values", (None, None))
+    _LIMITS.values = _get_limits(timeout, max_rss)
+    try:
+        yield
+    finally:
+        _LIMITS.values = previous
+
+
+@contextlib.contextmanager
+def group(process_group):
+    """
+    Starts the commands executed by the current thread within the block as
+    part of a process group.
+
+    :param process_group: group to start the commands in
+    :type process_group: ProcessGroup
+    """
+    previous = getattr(_GROUP, "group", None)
+    _GROUP.group = process_group
+    try:
+        yield
+    finally:
+        _GROUP.group = previous
+
+
+def get_rss(pid):
+    """
+    Returns the resident memory of a process, read from /proc.
+
+    :param pid: id of the process
+    :type pid: int
+
+    :return: resident memory in bytes, None if it cannot be read
+    :rtype: int
+    """
+    try:
+        with open("/proc/{}/status".format(pid)) as fp:
+            for line in fp:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def run(args,
+        capture=False,
+        progress=False,
+        input_stream=None,
+        output_stream=None,
+        tail=None,
+        timeout=None,
+        max_rss=None):
+    """
+    Executes a command in a subprocess, streaming its output.
+
+    Stderr is read as it is written, only keeping its last lines to report
+    errors with. Stdout is either captured, copied to a stream, parsed as
+    ffmpeg progress or discarded.
+
+    The command is killed once it exceeds its limits, the tightest of the given
+    ones and the ones of the current thread, see limits. The memory limit is
+    only enforced on platforms exposing /proc.
+
+    :param args: arguments representing the command to execute
+    :type args: list
+
+    :param capture: set True to return stdout, kept in memory as a whole
+    :type capture: bool
+
+    :param progress: set True to emit the progress of an ffmpeg command which
+                     does not write to stdout
+    :type progress: bool
+
+    :param input_stream: file-like object to feed to stdin, None to feed nothing
+    :type input_stream: io.RawIOBase
+
+    :param output_stream: file-like object to write stdout to
+    :type output_stream: io.RawIOBase
+
+    :param tail: buffer to keep the last lines of stderr in, e.g. to parse the
+                 summary ffmpeg prints on exit
+    :type tail: Tail
+
+    :param timeout: maximum amount of seconds the command may run
+    :type timeout: float
+
+    :param max_rss: maximum resident memory of the command in bytes
+    :type max_rss: int
+
+    :raises RuntimeError: if the command failed or exceeded its limits
+
+    :return: stdout if captured, else empty
+    :rtype: bytes
+    """
+    events.emit("command", args=list(args))
+    if progress:
+        # write progress to stdout, which is not used by file outputs
+        args = [args[0], "-progress", "pipe:1", "-nostats"] + list(args[1:])
+    if capture:
+        output_stream = io.BytesIO()
+    tail = tail if tail is not None else Tail()
+    deadline, max_rss = _get_limits(timeout, max_rss)
+
+    proc, read, threads = _start(args, tail, progress, input_stream, output_stream)
+    reason = _wait(proc, read, threads, deadline, max_rss)
+    if reason is not None:
+        raise RuntimeError("{} killed, {}".format(os.path.basename(args[0]), reason))
+    if proc.returncode != 0:
+        msg = tail.get_text() or "exited with code {}".format(proc.returncode)
+        raise RuntimeError(msg)
+    return output_stream.getvalue() if capture else b""
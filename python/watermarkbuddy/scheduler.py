@@ -0,0 +1,543 @@
+# stdlib modules
+from __future__ import absolute_import
+from __future__ import division
+import time
+import heapq
+import threading
+from multiprocessing.pool import ThreadPool
+
+# tool modules
+from watermarkbuddy import batch
+from watermarkbuddy import events
+
+# initial throughput of a single ffmpeg thread in pixels per second, refined
+# with the measured throughput as jobs complete
+_DEFAULT_RATES = {"image": 50e6, "video": 20e6}
+
+# initial amount of seconds each job takes regardless of its size, being the
+# ffmpeg startup and probing
+_DEFAULT_OVERHEAD = 0.1
+
+# rough decode cost of codecs relative to h264, others weigh 1
+_CODEC_WEIGHTS = {"hevc": 2.0,
+                  "vp9": 2.0,
+                  "av1": 3.0,
+                  "prores": 1.5,
+                  "dnxhd": 1.5}
+
+# exponent of the speedup of extra threads, as encoders do not scale linearly
+_THREAD_SCALING = 0.75
+
+
+# =============================================================================
+# classes
+# =============================================================================
+class CostModel(object):
+    """
+    Estimates the wall time of jobs from the probed stream data of their
+    input, being the amount of pixels to process divided by the throughput of
+    the threads ffmpeg may use.
+
+    Images and videos have a throughput of their own, which is updated with
+    the measured throughput of each completed job, so estimates adapt to the
+    machine, codecs and settings of a batch. A model can be reused between
+    batches to keep what it learned.
+    """
+
+    def __init__(self, rates=None, overhead=_DEFAULT_OVERHEAD, smoothing=0.3):
+        """
+        Initializes the object.
+
+        :param rates: initial throughput of a single thread in pixels per
+                      second, keyed by kind (image, video)
+        :type rates: dict[str, float]
+
+        :param overhead: amount of seconds each job takes regardless of its
+                         size
+        :type overhead: float
+
+        :param smoothing: weight of a measured throughput in the updated one,
+                          between 0 (never adapt) and 1 (last job only)
+        :type smoothing: float
+        """
+        self.rates = dict(_DEFAULT_RATES)
+        self.rates.update(rates or {})
+        self.overhead = overhead
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+
+    def estimate(self, task, threads):
+        """
+        Returns the estimated wall time of a job.
+
+        :param task: job to estimate
+        :type task: ScheduledJob
+
+        :param threads: amount of threads ffmpeg may use
+        :type threads: int
+
+        :rtype: float
+        """
+        speedup = max(1, threads) ** _THREAD_SCALING
+        return self.overhead + task.work / (self.rates[task.kind] * speedup)
+
+    def update(self, task, threads, elapsed):
+        """
+        Updates the throughput of the kind of a job with its measured wall
+        time.
+
+        :param task: completed job
+        :type task: ScheduledJob
+
+        :param threads: amount of threads ffmpeg could use
+        :type threads: int
+
+        :param elapsed: wall time of the job in seconds
+        :type elapsed: float
+        """
+        seconds = elapsed - self.overhead
+        if task.work <= 0 or seconds <= 0:
+            return
+        measured = task.work / (seconds * max(1, threads) ** _THREAD_SCALING)
+        with self._lock:
+            rate = self.rates[task.kind]
+            self.rates[task.kind] = rate + self.smoothing * (measured - rate)
+
+
+class ScheduledJob(object):
+    """Job along with the estimated amount of work it takes."""
+
+    def __init__(self, job, work, kind):
+        """
+        Initializes the object.
+
+        :param job: job to execute
+        :type job: watermarkbuddy.batch.Job
+
+        :param work: amount of pixels to process, 0 if unknown
+        :type work: float
+
+        :param kind: kind of input, image or video
+        :type kind: str
+        """
+        self.job = job
+        self.work = work
+        self.kind = kind
+        self.threads = None
+
+    def __repr__(self):
+        """Returns the representation of the object."""
+        return "ScheduledJob({!r}, {!r}, {!r})".format(self.job, self.work, self.kind)
+
+
+class Schedule(object):
+    """Order in which jobs run, along with the predicted makespan."""
+
+    def __init__(self, jobs, workers, thread_budget, predicted):
+        """
+        Initializes the object.
+
+        :param jobs: jobs in the order to start them, longest first
+        :type jobs: list[ScheduledJob]
+
+        :param workers: maximum amount of concurrent jobs
+        :type workers: int
+
+        :param thread_budget: maximum total amount of ffmpeg threads
+        :type thread_budget: int
+
+        :param predicted: predicted wall time of all jobs in seconds
+        :type predicted: float
+        """
+        self.jobs = jobs
+        self.workers = workers
+        self.thread_budget = thread_budget
+        self.predicted = predicted
+
+
+class ScheduleResult(batch.BatchResult):
+    """Outcome of a scheduled batch, along with its predicted makespan."""
+
+    def __init__(self, results, elapsed, predicted, makespan):
+        """
+        Initializes the object.
+
+        :param results: results of all executed jobs
+        :type results: list[watermarkbuddy.batch.JobResult]
+
+        :param elapsed: wall time of the whole batch in seconds, probing
+                        included
+        :type elapsed: float
+
+        :param predicted: predicted wall time of executing the jobs which were
+                          not skipped, in seconds
+        :type predicted: float
+
+        :param makespan: actual wall time of executing these jobs in seconds
+        :type makespan: float
+        """
+        super(ScheduleResult, self).__init__(results, elapsed)
+        self.predicted = predicted
+        self.makespan = makespan
+
+
+class _Dispatcher(object):
+    """Hands out scheduled jobs to workers, sharing the thread budget."""
+
+    def __init__(self, schedule, model, callback=None, timeout=None, max_rss=None):
+        """
+        Initializes the object.
+
+        :param schedule: jobs to execute
+        :type schedule: Schedule
+
+        :param model: model to update with the measured wall times
+        :type model: CostModel
+
+        :param callback: function called with each JobResult once it completes
+        :type callback: callable
+
+        :param timeout: maximum amount of seconds each job may run
+        :type timeout: float
+
+        :param max_rss: maximum resident memory of each ffmpeg process in bytes
+        :type max_rss: int
+        """
+        self.schedule = schedule
+        self.model = model
+        self.callback = callback
+        self.timeout = timeout
+        self.max_rss = max_rss
+        # jobs of a kind keep their order, as the model scales all of them
+        # alike, only the order between the kinds adapts
+        self._pending = {}
+        for task in reversed(schedule.jobs):
+            self._pending.setdefault(task.kind, []).append(task)
+        self._remaining = len(schedule.jobs)
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def _next(self):
+        """
+        Takes the longest pending job according to the current model,
+        assigning it its share of the threads which are not in use.
+
+        :return: job to execute, None if all jobs started
+        :rtype: ScheduledJob
+        """
+        with self._lock:
+            heads = [tasks[-1] for tasks in self._pending.values() if tasks]
+            if not heads:
+                return None
+            task = max(heads, key=lambda head: self.model.estimate(head, 1))
+            self._pending[task.kind].pop()
+            task.threads = task.job.options.get("threads") or _get_threads(self.schedule.thread_budget,
+                                                                           self._used,
+                                                                           self.schedule.workers,
+                                                                           self._remaining)
+            self._remaining -= 1
+            self._used += task.threads
+            return task
+
+    def _release(self, task):
+        """
+        Returns the threads of a completed job to the budget.
+
+        :param task: completed job
+        :type task: ScheduledJob
+        """
+        with self._lock:
+            self._used -= task.threads
+
+    def run(self):
+        """
+        Executes jobs until all jobs started.
+
+        :return: results of the executed jobs
+        :rtype: list[watermarkbuddy.batch.JobResult]
+        """
+        results = []
+        while True:
+            task = self._next()
+            if task is None:
+                return results
+
+            job = task.job
+            options = dict(job.options, threads=task.threads)
+            try:
+                job = batch.Job(job.input_file, job.watermark_file, job.output_file, **options)
+                result = batch.run_job(job, self.timeout, self.max_rss)
+            finally:
+                self._release(task)
+            # report the job as submitted, not the copy holding the threads
+            result.job = task.job
+
+            if result.succeeded:
+                self.model.update(task, task.threads, result.elapsed)
+            results.append(result)
+            if self.callback:
+                self.callback(result)
+
+
+# =============================================================================
+# private
+# =============================================================================
+def _parse_rate(value):
+    """
+    Parses a frame rate formatted as num/den.
+
+    :param value: frame rate to parse
+    :type value: str
+
+    :return: frame rate, 0 if invalid
+    :rtype: float
+    """
+    try:
+        num, _, den = str(value).partition("/")
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def _get_frames(stream_data):
+    """
+    Returns the amount of frames of a video stream, 1 for images.
+
+    :param stream_data: video stream data, see watermarkbuddy.get_stream_data
+    :type stream_data: dict
+
+    :rtype: int
+    """
+    try:
+        return max(1, int(stream_data["nb_frames"]))
+    except (KeyError, ValueError):
+        pass
+
+    try:
+        duration = float(stream_data.get("duration") or stream_data["tags"]["DURATION"])
+    except (KeyError, ValueError):
+        return 1
+    return max(1, int(round(duration * _parse_rate(stream_data.get("avg_frame_rate")))))
+
+
+def _get_threads(budget, used, workers, remaining):
+    """
+    Returns the amount of threads of a job about to start, being its share of
+    the budget among the jobs which can still run concurrently, limited to the
+    threads not in use. The last jobs of a batch therefore get more threads.
+
+    :param budget: maximum total amount of threads
+    :type budget: int
+
+    :param used: amount of threads of the running jobs
+    :type used: int
+
+    :param workers: maximum amount of concurrent jobs
+    :type workers: int
+
+    :param remaining: amount of jobs not started yet, including this one
+    :type remaining: int
+
+    :rtype: int
+    """
+    share = budget // max(1, min(workers, remaining))
+    return max(1, min(share, budget - used))
+
+
+def _simulate(tasks, workers, budget, model):
+    """
+    Predicts the wall time of executing jobs in order on a pool of workers,
+    handing out threads like the dispatcher does.
+
+    :param tasks: jobs in the order to start them
+    :type tasks: list[ScheduledJob]
+
+    :param workers: maximum amount of concurrent jobs
+    :type workers: int
+
+    :param budget: maximum total amount of ffmpeg threads
+    :type budget: int
+
+    :param model: model to estimate the wall time of the jobs with
+    :type model: CostModel
+
+    :return: predicted wall time in seconds
+    :rtype: float
+    """
+    now = 0.0
+    used = 0
+    running = []
+    for index, task in enumerate(tasks):
+        if len(running) >= workers:
+            now = running[0][0]
+        while running and running[0][0] <= now:
+            used -= heapq.heappop(running)[1]
+
+        threads = task.job.options.get("threads") or _get_threads(budget, used, workers, len(tasks) - index)
+        heapq.heappush(running, (now + model.estimate(task, threads), threads))
+        used += threads
+    return max([finish for finish, _ in running] or [0.0])
+
+
+# =============================================================================
+# public
+# =============================================================================
+def estimate_work(stream_data):
+    """
+    Returns the amount of work of adding a watermark to a file, being the
+    amount of pixels to decode and encode weighed by the decode cost of its
+    codec, along with its kind.
+
+    :param stream_data: video stream data, see watermarkbuddy.get_stream_data
+    :type stream_data: dict
+
+    :return: amount of work and kind of input (image or video)
+    :rtype: tuple[float, str]
+    """
+    frames = _get_frames(stream_data)
+    pixels = int(stream_data.get("width") or 0) * int(stream_data.get("height") or 0)
+    weight = _CODEC_WEIGHTS.get(stream_data.get("codec_name"), 1.0)
+    return pixels * frames * weight, "video" if frames > 1 else "image"
+
+
+def plan_jobs(jobs, workers=None, thread_budget=None, model=None, probe_cache=None):
+    """
+    Orders jobs longest first by their estimated wall time and predicts the
+    makespan of executing them, see add_watermarks_scheduled.
+
+    Inputs are probed concurrently, inputs which cannot be probed are
+    estimated to take no work and run last.
+
+    :param jobs: jobs to plan
+    :type jobs: list[watermarkbuddy.batch.Job]
+
+    :param workers: maximum amount of concurrent jobs, defaults to CPU count
+    :type workers: int
+
+    :param thread_budget: maximum total amount of ffmpeg threads, defaults to
+                          CPU count
+    :type thread_budget: int
+
+    :param model: model to estimate the wall time of the jobs with
+    :type model: CostModel
+
+    :param probe_cache: cache to store the probed stream data in
+    :type probe_cache: watermarkbuddy.cache.ProbeCache
+
+    :raises ValueError: if the amount of workers or threads is invalid
+
+    :rtype: Schedule
+    """
+    jobs = list(jobs)
+    workers = workers or batch.get_default_workers()
+    thread_budget = thread_budget or batch.get_default_workers()
+    if workers < 1:
+        raise ValueError("invalid amount of workers {!r}".format(workers))
+    if thread_budget < 1:
+        raise ValueError("invalid thread budget {!r}".format(thread_budget))
+    model = model or CostModel()
+
+    stream_data, _ = batch.probe_files(set(job.input_file for job in jobs), probe_cache, workers)
+    tasks = []
+    for job in jobs:
+        data = stream_data.get(job.input_file)
+        work, kind = estimate_work(data) if data else (0.0, "image")
+        tasks.append(ScheduledJob(job, work, kind))
+
+    # estimate with the threads of a job running alongside a full pool, as
+    # the threads are only known once the job starts
+    threads = max(1, thread_budget // min(workers, max(1, len(tasks))))
+    tasks.sort(key=lambda task: model.estimate(task, threads), reverse=True)
+    return Schedule(tasks, workers, thread_budget, _simulate(tasks, workers, thread_budget, model))
+
+
+def add_watermarks_scheduled(jobs,
+                             workers=None,
+                             thread_budget=None,
+                             model=None,
+                             probe_cache=None,
+                             callback=None,
+                             manifest=None,
+                             timeout=None,
+                             max_rss=None):
+    """
+    Executes watermark jobs concurrently, starting the longest jobs first so
+    no worker is left running a large file once all others are done, see
+    batch.add_watermarks.
+
+    The cost of each job is estimated from the resolution, frame count and
+    codec of its input, see plan_jobs. The ffmpeg threads of the running jobs
+    are kept within the thread budget, each job getting its share of the
+    budget once it starts, unless it sets its threads itself. The model
+    adapts to the measured wall time of the completed jobs.
+
+    :param jobs: jobs to execute
+    :type jobs: list[watermarkbuddy.batch.Job]
+
+    :param workers: maximum amount of concurrent jobs, defaults to CPU count
+    :type workers: int
+
+    :param thread_budget: maximum total amount of ffmpeg threads, defaults to
+                          CPU count
+    :type thread_budget: int
+
+    :param model: model to estimate the wall time of the jobs with, updated
+                  as jobs complete
+    :type model: CostModel
+
+    :param probe_cache: cache to store the probed stream data in, so the jobs
+                        do not probe their input again
+    :type probe_cache: watermarkbuddy.cache.ProbeCache
+
+    :param callback: function called with each JobResult once it completes
+    :type callback: callable
+
+    :param manifest: manifest to skip jobs with an up to date output with,
+                     updated with each succeeded job
+    :type manifest: watermarkbuddy.incremental.Manifest
+
+    :param timeout: maximum amount of seconds each job may run
+    :type timeout: float
+
+    :param max_rss: maximum resident memory of each ffmpeg process in bytes
+    :type max_rss: int
+
+    :return: results, along with the predicted and actual makespan of the
+             jobs which were not skipped
+    :rtype: ScheduleResult
+    """
+    start = time.time()
+    results, jobs = batch._skip_up_to_date(list(jobs), manifest)
+    if callback:
+        for result in results:
+            callback(result)
+
+    def on_result(result):
+        if manifest is not None and result.succeeded:
+            manifest.update(result.job)
+        if callback:
+            callback(result)
+
+    model = model or CostModel()
+    schedule = plan_jobs(jobs, workers, thread_budget, model, probe_cache)
+    events.emit("schedule",
+                jobs=len(schedule.jobs),
+                workers=schedule.workers,
+                thread_budget=schedule.thread_budget,
+                predicted=schedule.predicted)
+
+    dispatch_start = time.time()
+    dispatcher = _Dispatcher(schedule, model, on_result, timeout, max_rss)
+    count = max(1, min(schedule.workers, len(schedule.jobs)))
+    pool = ThreadPool(count)
+    try:
+        for worker_results in pool.map(lambda _: dispatcher.run(), range(count)):
+            results.extend(worker_results)
+    finally:
+        pool.close()
+        pool.join()
+        if manifest is not None:
+            manifest.save()
+
+    end = time.time()
+    return ScheduleResult(results, end - start, schedule.predicted, end - dispatch_start)
@@ -0,0 +1,378 @@
+# stdlib modules
+from __future__ import absolute_import
+from __future__ import division
+import os
+import csv
+import shutil
+import tempfile
+
+# tool modules
+from watermarkbuddy import batch
+from watermarkbuddy import events
+from watermarkbuddy import watermarkbuddy
+
+# minimum duration of a segment in seconds, shorter segments do not pay off
+# the cost of splitting and spawning an extra ffmpeg process
+_MIN_SEGMENT_DURATION = 10.0
+
+# container of the intermediate segments, supporting nearly any codec
+_SEGMENT_EXT = ".mkv"
+
+# codec and pixel format of the watermarked segments, as encoded by libx264
+# from the output of the overlay filter
+_ENCODED_CODEC = "h264"
+_ENCODED_PIX_FMT = "yuv420p"
+
+
+# =============================================================================
+# classes
+# =============================================================================
+class Segment(object):
+    """Part of a video, split at keyframes."""
+
+    def __init__(self, file_path, start, end):
+        """
+        Initializes the object.
+
+        :param file_path: file holding the segment
+        :type file_path: str
+
+        :param start: start time of the segment in the source, in seconds
+        :type start: float
+
+        :param end: end time of the segment in the source, in seconds
+        :type end: float
+        """
+        self.file_path = file_path
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        """Returns the representation of the object."""
+        return "Segment({!r}, {!r}, {!r})".format(self.file_path, self.start, self.end)
+
+    def overlaps(self, start=None, end=None):
+        """
+        Returns whether the segment overlaps a time range.
+
+        :param start: start time of the range, None for the start of the source
+        :type start: float
+
+        :param end: end time of the range, None for the end of the source
+        :type end: float
+
+        :rtype: bool
+        """
+        if start is not None and self.end <= start:
+            return False
+        if end is not None and self.start >= end:
+            return False
+        return True
+
+
+# =============================================================================
+# private
+# =============================================================================
+def _get_duration(stream_data):
+    """
+    Returns the duration of a video stream.
+
+    :param stream_data: video stream data, see watermarkbuddy.get_stream_data
+    :type stream_data: dict
+
+    :return: duration in seconds, 0 if unknown
+    :rtype: float
+    """
+    try:
+        return float(stream_data.get("duration", 0))
+    except ValueError:
+        return 0.0
+
+
+def _get_split_times(duration, segment_duration, start=None, end=None):
+    """
+    Returns the times to split a video at.
+
+    The times of the watermark range are included, so only the segments
+    overlapping the range need to be encoded.
+
+    :param duration: duration of the video in seconds
+    :type duration: float
+
+    :param segment_duration: target duration of a segment in seconds
+    :type segment_duration: float
+
+    :param start: start time of the watermark range
+    :type start: float
+
+    :param end: end time of the watermark range
+    :type end: float
+
+    :rtype: list[float]
+    """
+    times = set()
+    time = segment_duration
+    while time < duration:
+        times.add(round(time, 3))
+        time += segment_duration
+    times.update(t for t in (start, end) if t and t < duration)
+    return sorted(times)
+
+
+def _split(input_file, directory, times):
+    """
+    Splits the video stream of a file into segments without re-encoding.
+
+    The segment muxer cuts at the first keyframe at or after each time, so
+    each segment can be decoded on its own.
+
+    :param input_file: file to split
+    :type input_file: str
+
+    :param directory: directory to write the segments in
+    :type directory: str
+
+    :param times: times to split the video at, in seconds
+    :type times: list[float]
+
+    :rtype: list[Segment]
+    """
+    segment_list = os.path.join(directory, "segments.csv")
+    args = ["ffmpeg",
+            "-hide_banner",
+            "-y",
+            "-i", input_file,
+            "-map", "0:v:0",  # audio is copied from the source once concatenated
+            "-c", "copy",
+            "-f", "segment",
+            "-segment_list", segment_list,
+            "-segment_list_type", "csv",
+            "-reset_timestamps", "1"]
+    if times:
+        args.extend(["-segment_times", ",".join(str(t) for t in times)])
+    args.append(os.path.join(directory, "segment%05d" + _SEGMENT_EXT))
+
+    with events.stage("split"):
+        watermarkbuddy.execute_cmd(args)
+
+    segments = []
+    with open(segment_list) as fp:
+        for fname, start, end in csv.reader(fp):
+            segments.append(Segment(os.path.join(directory, fname), float(start), float(end)))
+    return segments
+
+
+def _concat(segment_files, input_file, output_file, directory):
+    """
+    Concatenates segments without re-encoding, adding the audio of the source.
+
+    :param segment_files: files of the segments, in order
+    :type segment_files: list[str]
+
+    :param input_file: source file to copy the audio from
+    :type input_file: str
+
+    :param output_file: output file path
+    :type output_file: str
+
+    :param directory: directory to write the concat list in
+    :type directory: str
+    """
+    concat_list = os.path.join(directory, "concat.txt")
+    with open(concat_list, "w") as fp:
+        for segment_file in segment_files:
+            fp.write("file '{}'\n".format(segment_file.replace("'", "'\\''")))
+
+    args = ["ffmpeg",
+            "-hide_banner",
+            "-y",
+            "-f", "concat",
+            "-safe", "0",
+            "-i", concat_list,
+            "-i", input_file,
+            "-map", "0:v",
+            "-map", "1:a?",
+            "-c", "copy",
+            output_file]
+    with events.stage("concat"):
+        watermarkbuddy.execute_cmd(args)
+
+
+def _can_copy_segments(stream_data):
+    """
+    Returns whether segments of a video stream can be stream copied next to
+    watermarked segments, which requires the source to use the codec and
+    pixel format the watermarked segments are encoded with.
+
+    :param stream_data: video stream data, see watermarkbuddy.get_stream_data
+    :type stream_data: dict
+
+    :rtype: bool
+    """
+    return (stream_data.get("codec_name"), stream_data.get("pix_fmt")) == (_ENCODED_CODEC, _ENCODED_PIX_FMT)
+
+
+def _get_segment_jobs(segments, watermark_file, start, end, options, copy=True):
+    """
+    Builds the jobs watermarking the segments overlapping the time range.
+
+    If segments cannot be stream copied, the segments outside of the range
+    are encoded too, without showing the watermark.
+
+    :param segments: segments of the source
+    :type segments: list[Segment]
+
+    :param watermark_file: file to use as watermark
+    :type watermark_file: str
+
+    :param start: start time of the watermark range
+    :type start: float
+
+    :param end: end time of the watermark range
+    :type end: float
+
+    :param options: keyword arguments passed to add_watermark
+    :type options: dict
+
+    :param copy: set False to encode the segments outside of the range too
+    :type copy: bool
+
+    :return: jobs and the files to concatenate, in order
+    :rtype: tuple[list[watermarkbuddy.batch.Job], list[str]]
+    """
+    jobs = []
+    segment_files = []
+    for segment in segments:
+        segment_options = dict(options)
+        if segment.overlaps(start, end):
+            # limit the range to the part within the segment, in segment time
+            if start is not None and start > segment.start:
+                segment_options["start"] = start - segment.start
+            if end is not None and end < segment.end:
+                segment_options["end"] = end - segment.start
+        elif copy:
+            # outside of the range, keep the stream as is
+            segment_files.append(segment.file_path)
+            continue
+        else:
+            # start the range at the end of the segment, so no frame shows it
+            segment_options["start"] = segment.end - segment.start
+
+        base = os.path.splitext(segment.file_path)[0]
+        output_file = base + "_watermarked" + _SEGMENT_EXT
+        jobs.append(batch.Job(segment.file_path, watermark_file, output_file, **segment_options))
+        segment_files.append(output_file)
+    return jobs, segment_files
+
+
+def _validate_options(options):
+    """
+    Validates the options passed to add_watermark for each segment.
+
+    :param options: keyword arguments passed to add_watermark
+    :type options: dict
+
+    :raises ValueError: if an option cannot be applied per segment
+    """
+    if options.get("backend", "ffmpeg") != "ffmpeg":
+        raise ValueError("segmented mode requires the ffmpeg backend")
+    # fades and loops would restart at every segment
+    if any(options.get(key) for key in ("windows", "fade_in", "fade_out", "loop_watermark")):
+        raise ValueError("segmented mode does not support time ranges, fades or loops")
+
+
+# =============================================================================
+# public
+# =============================================================================
+def add_watermark_segmented(input_file,
+                            watermark_file,
+                            output_file,
+                            segment_duration=None,
+                            workers=None,
+                            start=None,
+                            end=None,
+                            probe_cache=None,
+                            timeout=None,
+                            max_rss=None,
+                            **options):
+    """
+    Add a watermark to a long video, encoding keyframe aligned segments in
+    parallel ffmpeg processes.
+
+    The video stream is split without re-encoding, the segments are
+    watermarked concurrently and concatenated without re-encoding, with the
+    audio of the source copied as is. If a time range is given, only the
+    segments overlapping it are encoded, the others are stream copied.
+
+    Copied and encoded segments are joined as is, so segments are only
+    copied if the source uses the codec and pixel format of the encoded
+    segments, being 8-bit 4:2:0 H.264. Other sources, like ProRes, HEVC or
+    10-bit video, get every segment encoded.
+
+    :param input_file: video to add watermark to
+    :type input_file: str
+
+    :param watermark_file: file to use as watermark
+    :type watermark_file: str
+
+    :param output_file: output file path
+    :type output_file: str
+
+    :param segment_duration: target duration of a segment in seconds,
+                             defaults to the duration divided over the workers
+    :type segment_duration: float
+
+    :param workers: maximum amount of segments to encode concurrently,
+                    defaults to CPU count
+    :type workers: int
+
+    :param start: time in seconds to start applying the watermark from
+    :type start: float
+
+    :param end: time in seconds to stop applying the watermark at
+    :type end: float
+
+    :param probe_cache: cache to reuse probed stream data from
+    :type probe_cache: watermarkbuddy.cache.ProbeCache
+
+    :param timeout: maximum amount of seconds each segment may be encoded in
+    :type timeout: float
+
+    :param max_rss: maximum resident memory of each ffmpeg process in bytes
+    :type max_rss: int
+
+    :param options: keyword arguments passed to add_watermark
+    :type options: dict
+
+    :raises RuntimeError: if a segment failed to be watermarked
+    """
+    if not os.path.exists(input_file):
+        msg = "input file does not exist: {}"
+        raise ValueError(msg.format(input_file))
+    watermarkbuddy.validate_time_range(start, end)
+    _validate_options(options)
+
+    workers = workers or batch.get_default_workers()
+    stream_data = watermarkbuddy.get_stream_data(input_file, probe_cache)
+    duration = _get_duration(stream_data)
+    if segment_duration is None:
+        segment_duration = max(duration / workers, _MIN_SEGMENT_DURATION)
+    if segment_duration <= 0:
+        raise ValueError("invalid segment duration {!r}".format(segment_duration))
+
+    directory = tempfile.mkdtemp(prefix=".segments.", dir=os.path.dirname(os.path.abspath(output_file)))
+    try:
+        with events.context(input_file=input_file):
+            segments = _split(input_file, directory, _get_split_times(duration, segment_duration, start, end))
+            jobs, segment_files = _get_segment_jobs(segments, watermark_file, start, end, options,
+                                                    copy=_can_copy_segments(stream_data))
+
+            result = batch.add_watermarks(jobs, workers=workers, timeout=timeout, max_rss=max_rss)
+            if result.failed:
+                failed = result.failed[0]
+                msg = "failed to watermark segment {}: {}"
+                raise RuntimeError(msg.format(failed.job.input_file, failed.error))
+
+            _concat(segment_files, input_file, output_file, directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,477 @@
+# stdlib modules
+from __future__ import absolute_import
+import os
+import json
+import time
+import errno
+import socket
+import tempfile
+import itertools
+import threading
+import collections
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+# tool modules
+from watermarkbuddy import batch
+from watermarkbuddy import cache
+from watermarkbuddy import client
+from watermarkbuddy import events
+from watermarkbuddy import watermarkbuddy
+
+# options a submitted job may set, the caches are owned by the server
+_JOB_OPTIONS = ("autoscale",
+                "position",
+                "offset_x",
+                "offset_y",
+                "blend_mode",
+                "single_pass",
+                "backend",
+                "profile",
+                "threads",
+                "start",
+                "end",
+                "windows",
+                "fade_in",
+                "fade_out",
+                "loop_watermark")
+
+# states of a job which completed
+_FINISHED_STATES = ("succeeded", "failed", "cancelled")
+
+
+# =============================================================================
+# classes
+# =============================================================================
+class ServerJob(object):
+    """Job submitted to the server, tracking its state."""
+
+    def __init__(self, job_id, job):
+        """
+        Initializes the object.
+
+        :param job_id: id of the job
+        :type job_id: str
+
+        :param job: job to execute
+        :type job: watermarkbuddy.batch.Job
+        """
+        self.id = job_id
+        self.job = job
+        self.state = "queued"
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._done = threading.Event()
+
+    def start(self):
+        """Marks the job as running."""
+        self.state = "running"
+        self.started = time.time()
+
+    def finish(self, state, error=None):
+        """
+        Marks the job as completed, waking up the clients waiting for it.
+
+        :param state: final state of the job
+        :type state: str
+
+        :param error: error message if the job did not succeed
+        :type error: str
+        """
+        self.state = state
+        self.error = error
+        self.finished = time.time()
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the job completed.
+
+        :param timeout: maximum amount of seconds to wait, None to wait forever
+        :type timeout: float
+        """
+        self._done.wait(timeout)
+
+    def to_dict(self):
+        """
+        Returns the status of the job, as sent to clients.
+
+        :rtype: dict
+        """
+        return {"id": self.id,
+                "state": self.state,
+                "input_file": self.job.input_file,
+                "watermark_file": self.job.watermark_file,
+                "output_file": self.job.output_file,
+                "error": self.error,
+                "submitted": self.submitted,
+                "started": self.started,
+                "finished": self.finished}
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Handles the requests of a client connection, one json line each."""
+
+    def handle(self):
+        """Responds to each request until the client disconnects."""
+        for line in iter(self.rfile.readline, b""):
+            try:
+                request = json.loads(line.decode("utf-8"))
+                response = self.server.watermark_server.handle_request(request)
+                response["ok"] = True
+            except (ValueError, KeyError, TypeError, RuntimeError) as e:
+                response = {"ok": False, "error": str(e) or e.__class__.__name__}
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server handling each connection in a thread."""
+
+    daemon_threads = True
+
+
+class WatermarkServer(object):
+    """
+    Long-running server executing watermark jobs submitted over a Unix
+    socket, see watermarkbuddy.client.
+
+    The scaled watermark and probe caches, as well as the ffmpeg capabilities,
+    stay warm between jobs. Jobs are executed by a pool of worker threads,
+    reading from a bounded queue. Once the queue is full, submissions are
+    rejected or wait for room, pushing back on the clients.
+    """
+
+    def __init__(self,
+                 path=None,
+                 workers=None,
+                 queue_size=256,
+                 watermark_cache=None,
+                 probe_cache=None,
+                 max_history=1000,
+                 timeout=None,
+                 max_rss=None):
+        """
+        Initializes the object.
+
+        :param path: Unix socket to listen on
+        :type path: str
+
+        :param workers: maximum amount of concurrent jobs, defaults to CPU count
+        :type workers: int
+
+        :param queue_size: maximum amount of queued jobs
+        :type queue_size: int
+
+        :param watermark_cache: cache of scaled watermarks shared by all jobs,
+                                None to disable it
+        :type watermark_cache: watermarkbuddy.cache.WatermarkCache
+
+        :param probe_cache: cache of probed stream data shared by all jobs,
+                            defaults to an in-memory cache
+        :type probe_cache: watermarkbuddy.cache.ProbeCache
+
+        :param max_history: maximum amount of completed jobs to keep the
+                            status of
+        :type max_history: int
+
+        :param timeout: maximum amount of seconds each job may run
+        :type timeout: float
+
+        :param max_rss: maximum resident memory of each ffmpeg process in bytes
+        :type max_rss: int
+        """
+        self.path = path or client.get_default_socket_path()
+        self.workers = workers or batch.get_default_workers()
+        if self.workers < 1:
+            raise ValueError("invalid amount of workers {!r}".format(self.workers))
+        if queue_size < 1:
+            raise ValueError("invalid queue size {!r}".format(queue_size))
+
+        self.watermark_cache = watermark_cache
+        self.probe_cache = probe_cache or cache.ProbeCache()
+        self.max_history = max_history
+        self.timeout = timeout
+        self.max_rss = max_rss
+        self._queue = queue.Queue(queue_size)
+        self._jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._closing = False
+        self._start = time.time()
+        self._threads = []
+        self._server = None
+
+    def _remove_stale_socket(self):
+        """
+        Removes the socket left behind by a server which did not exit cleanly.
+
+        :raises RuntimeError: if another server is listening on the socket
+        """
+        if not os.path.exists(self.path):
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            os.remove(self.path)
+        else:
+            raise RuntimeError("server already listening on {}".format(self.path))
+        finally:
+            sock.close()
+
+    def _bind(self):
+        """
+        Creates the socket server, only the current user may submit jobs.
+
+        The socket is bound in a private directory and linked in place once
+        its permissions are restricted, so it is never reachable by others.
+
+        :raises RuntimeError: if another server is listening on the socket
+
+        :rtype: _UnixServer
+        """
+        directory = tempfile.mkdtemp(prefix=".watermarkbuddy-", dir=os.path.dirname(os.path.abspath(self.path)))
+        tmp_path = os.path.join(directory, "socket")
+        try:
+            server = _UnixServer(tmp_path, _RequestHandler)
+            os.chmod(tmp_path, 0o600)
+            try:
+                os.link(tmp_path, self.path)
+            except OSError as e:
+                server.server_close()
+                if e.errno == errno.EEXIST:
+                    raise RuntimeError("server already listening on {}".format(self.path))
+                raise
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            os.rmdir(directory)
+        return server
+
+    def _run_worker(self):
+        """Executes queued jobs until the server closes."""
+        while True:
+            server_job = self._queue.get()
+            if server_job is None:
+                return
+            if self._closing:
+                server_job.finish("cancelled", "server shut down")
+                continue
+
+            server_job.start()
+            with events.context(job_id=server_job.id):
+                result = batch.run_job(server_job.job, self.timeout, self.max_rss)
+            server_job.finish("succeeded" if result.succeeded else "failed", result.error)
+            self._evict()
+
+    def _evict(self):
+        """Forgets the oldest completed jobs exceeding the maximum history."""
+        with self._lock:
+            finished = [job_id for job_id, server_job in self._jobs.items()
+                        if server_job.state in _FINISHED_STATES]
+            for job_id in finished[:max(0, len(finished) - self.max_history)]:
+                del self._jobs[job_id]
+
+    def _build_job(self, request):
+        """
+        Builds the job described by a submit request, validating it upfront so
+        clients get errors right away.
+
+        :param request: submit request
+        :type request: dict
+
+        :raises ValueError: if the job is invalid
+
+        :rtype: watermarkbuddy.batch.Job
+        """
+        files = [request["input_file"], request["watermark_file"], request["output_file"]]
+        for file_path in files:
+            if not os.path.isabs(file_path):
+                raise ValueError("path must be absolute: {}".format(file_path))
+        if not os.path.exists(files[0]):
+            raise ValueError("input file does not exist: {}".format(files[0]))
+
+        options = request.get("options") or {}
+        unsupported = sorted(set(options) - set(_JOB_OPTIONS))
+        if unsupported:
+            raise ValueError("unsupported options: {}".format(", ".join(unsupported)))
+
+        watermarkbuddy.validate_watermark(files[1],
+                                          files[2],
+                                          options.get("position", "top-left"),
+                                          options.get("offset_x", 0),
+                                          options.get("offset_y", 0),
+                                          options.get("blend_mode", "normal"))
+        watermarkbuddy.validate_backend(options.get("backend", "ffmpeg"))
+        watermarkbuddy.validate_profile(options.get("profile"))
+        watermarkbuddy.validate_timeline(options.get("start"),
+                                         options.get("end"),
+                                         options.get("windows"),
+                                         options.get("fade_in"),
+                                         options.get("fade_out"),
+                                         options.get("loop_watermark", False),
+                                         options.get("backend", "ffmpeg"))
+
+        options["cache"] = self.watermark_cache
+        options["probe_cache"] = self.probe_cache
+        return batch.Job(*files, **options)
+
+    def _get_job(self, job_id):
+        """
+        Returns a submitted job.
+
+        :param job_id: id of the job
+        :type job_id: str
+
+        :raises ValueError: if the job is unknown
+
+        :rtype: ServerJob
+        """
+        with self._lock:
+            server_job = self._jobs.get(job_id)
+        if server_job is None:
+            raise ValueError("unknown job {!r}".format(job_id))
+        return server_job
+
+    def _handle_submit(self, request):
+        """Handles a submit request, see client.Client.submit."""
+        server_job = self.submit(self._build_job(request), request.get("block"))
+        return {"id": server_job.id}
+
+    def _handle_status(self, request):
+        """Handles a status request, see client.Client.status."""
+        return {"job": self._get_job(request["id"]).to_dict()}
+
+    def _handle_wait(self, request):
+        """Handles a wait request, see client.Client.wait."""
+        server_job = self._get_job(request["id"])
+        server_job.wait(request.get("timeout"))
+        return {"job": server_job.to_dict()}
+
+    def _handle_stats(self, request):
+        """Handles a stats request, see client.Client.stats."""
+        return {"stats": self.get_stats()}
+
+    def _handle_shutdown(self, request):
+        """Handles a shutdown request, see client.Client.shutdown."""
+        # shutdown blocks until serve_forever returns, which runs elsewhere
+        thread = threading.Thread(target=self.shutdown)
+        thread.daemon = True
+        thread.start()
+        return {}
+
+    def handle_request(self, request):
+        """
+        Executes a request of a client.
+
+        :param request: command and its arguments
+        :type request: dict
+
+        :raises ValueError: if the request is invalid
+
+        :return: response to the request
+        :rtype: dict
+        """
+        command = request.get("command")
+        handler = getattr(self, "_handle_{}".format(command), None)
+        if handler is None:
+            raise ValueError("unknown command {!r}".format(command))
+        return handler(request)
+
+    def submit(self, job, block=None):
+        """
+        Queues a job.
+
+        :param job: job to execute
+        :type job: watermarkbuddy.batch.Job
+
+        :param block: maximum amount of seconds to wait for room in the queue,
+                      None to fail right away if the queue is full
+        :type block: float
+
+        :raises RuntimeError: if the queue is full or the server is closing
+
+        :rtype: ServerJob
+        """
+        if self._closing:
+            raise RuntimeError("server is shutting down")
+
+        server_job = ServerJob(str(next(self._ids)), job)
+        with self._lock:
+            self._jobs[server_job.id] = server_job
+        try:
+            self._queue.put(server_job, block is not None, block)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[server_job.id]
+            raise RuntimeError("queue full")
+        events.emit("job_queued", job_id=server_job.id, input_file=job.input_file)
+        return server_job
+
+    def get_stats(self):
+        """
+        Returns the statistics of the server.
+
+        :rtype: dict
+        """
+        with self._lock:
+            states = collections.Counter(j.state for j in self._jobs.values())
+        stats = {"workers": self.workers,
+                 "queue_size": self._queue.maxsize,
+                 "uptime": time.time() - self._start}
+        for state in ("queued", "running") + _FINISHED_STATES:
+            stats[state] = states.get(state, 0)
+        return stats
+
+    def start(self):
+        """
+        Starts the worker threads and listens on the socket.
+
+        :raises RuntimeError: if another server is listening on the socket
+        """
+        self._remove_stale_socket()
+        self._server = self._bind()
+        self._server.watermark_server = self
+
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._run_worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def serve_forever(self):
+        """Handles client requests until shutdown is called."""
+        self._server.serve_forever()
+
+    def shutdown(self):
+        """Stops serve_forever, from another thread."""
+        self._server.shutdown()
+
+    def close(self):
+        """
+        Stops listening, cancels the queued jobs and waits for the running
+        ones to complete.
+        """
+        self._closing = True
+        if self._server is not None:
+            self._server.server_close()
+            self._server = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
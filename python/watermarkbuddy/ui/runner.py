@@ -0,0 +1,305 @@
+# stdlib modules
+from __future__ import absolute_import
+import time
+
+# tool modules
+from watermarkbuddy import batch
+from watermarkbuddy import events
+from watermarkbuddy import preview
+from watermarkbuddy import process
+from watermarkbuddy import watermarkbuddy
+
+# third party modules
+from PySide2 import QtCore
+
+
+class JobRunnable(QtCore.QRunnable):
+    """Runs a single watermark job in a thread pool."""
+
+    def __init__(self, job, runner):
+        """
+        Initializes the object.
+
+        :param job: job to execute
+        :type job: watermarkbuddy.batch.Job
+
+        :param runner: runner to report to
+        :type runner: BatchRunner
+        """
+        super(JobRunnable, self).__init__()
+        self._job = job
+        self._runner = runner
+
+    def _get_duration(self):
+        """
+        Returns the duration of the input file, to compute the progress with.
+
+        :return: duration in seconds, 0 if unknown
+        :rtype: float
+        """
+        try:
+            stream_data = watermarkbuddy.get_stream_data(self._job.input_file,
+                                                         self._runner.probe_cache)
+            return float(stream_data.get("duration", 0))
+        except (RuntimeError, ValueError, OSError, KeyError, IndexError):
+            return 0.0
+
+    def run(self):
+        """Executes the job, unless the run was cancelled."""
+        if self._runner.is_cancelled():
+            result = batch.JobResult(self._job, 0.0, error="cancelled")
+        else:
+            self._runner.job_started.emit(self._job.input_file, self._get_duration())
+            # cancelling only kills the ffmpeg subprocesses of this run
+            with process.group(self._runner._process_group):
+                result = batch.run_job(self._job)
+            if not result.succeeded and self._runner.is_cancelled():
+                result.error = "cancelled"
+        self._runner.job_finished.emit(result)
+
+
+class PreviewRunnable(QtCore.QRunnable):
+    """Renders a single preview in a thread pool."""
+
+    def __init__(self, settings, runner):
+        """
+        Initializes the object.
+
+        :param settings: keyword arguments passed to preview.render_preview
+        :type settings: dict
+
+        :param runner: runner to report to
+        :type runner: PreviewRunner
+        """
+        super(PreviewRunnable, self).__init__()
+        self._settings = settings
+        self._runner = runner
+
+    def run(self):
+        """Renders the preview, reporting the image or the error."""
+        try:
+            data = preview.render_preview(max_size=self._runner.max_size,
+                                          frame_cache=self._runner.frame_cache,
+                                          probe_cache=self._runner.probe_cache,
+                                          **self._settings)
+        except (ValueError, RuntimeError, OSError) as e:
+            self._runner._done.emit(None, str(e) or e.__class__.__name__)
+        else:
+            self._runner._done.emit(data, "")
+
+
+class PreviewRunner(QtCore.QObject):
+    """
+    Renders previews of watermark settings in a thread, without blocking the
+    Qt event loop.
+
+    A single preview renders at once. Requests made meanwhile replace each
+    other, so only the latest settings are rendered once the running preview
+    completes, and outdated previews are dropped.
+    """
+
+    # png image of the preview of the latest settings
+    rendered = QtCore.Signal(object)
+
+    # error message if the preview of the latest settings failed
+    failed = QtCore.Signal(str)
+
+    # image or None and error message of a completed preview, internal
+    _done = QtCore.Signal(object, str)
+
+    def __init__(self, max_size=480, probe_cache=None, parent=None):
+        """
+        Initializes the object.
+
+        :param max_size: maximum width and height of the previews
+        :type max_size: int
+
+        :param probe_cache: cache to reuse probed stream data from
+        :type probe_cache: watermarkbuddy.cache.ProbeCache
+
+        :param parent: parent object
+        :type parent: QtCore.QObject
+        """
+        super(PreviewRunner, self).__init__(parent)
+        self.max_size = max_size
+        self.probe_cache = probe_cache
+        self.frame_cache = preview.FrameCache()
+        self._thread_pool = QtCore.QThreadPool(self)
+        self._thread_pool.setMaxThreadCount(1)
+        self._pending = None
+        self._busy = False
+        self._done.connect(self._on_done)
+
+    def _start_pending(self):
+        """Starts rendering the latest requested settings, if any."""
+        if self._pending is None:
+            return
+        settings, self._pending = self._pending, None
+        self._busy = True
+        self._thread_pool.start(PreviewRunnable(settings, self))
+
+    def _on_done(self, data, error):
+        """
+        Reports a completed preview, unless newer settings were requested.
+
+        :param data: png image of the preview, None if it failed
+        :type data: bytes
+
+        :param error: error message if the preview failed
+        :type error: str
+        """
+        self._busy = False
+        if self._pending is not None:
+            self._start_pending()
+        elif data is None:
+            self.failed.emit(error)
+        else:
+            self.rendered.emit(data)
+
+    def request(self, **settings):
+        """
+        Requests a preview, see preview.render_preview for the settings.
+
+        :param settings: keyword arguments passed to preview.render_preview
+        :type settings: dict
+        """
+        self._pending = settings
+        if not self._busy:
+            self._start_pending()
+
+    def wait(self):
+        """Drops the requested previews and blocks until the running one completed."""
+        self._pending = None
+        self._thread_pool.waitForDone()
+
+
+class BatchRunner(QtCore.QObject):
+    """
+    Runs watermark jobs concurrently in a thread pool, without blocking the
+    Qt event loop.
+
+    Signals are emitted from the worker threads and delivered in the thread
+    the runner lives in. A failing job does not stop the batch, its error is
+    stored on its result.
+    """
+
+    # input file and its duration in seconds, 0 if unknown
+    job_started = QtCore.Signal(str, float)
+
+    # input file and the amount of seconds processed by ffmpeg
+    job_progress = QtCore.Signal(str, float)
+
+    # input file and the name of the stage it entered
+    job_stage = QtCore.Signal(str, str)
+
+    # watermarkbuddy.batch.JobResult of each job once it completes
+    job_finished = QtCore.Signal(object)
+
+    # watermarkbuddy.batch.BatchResult once all jobs completed
+    finished = QtCore.Signal(object)
+
+    def __init__(self, workers=None, probe_cache=None, parent=None):
+        """
+        Initializes the object.
+
+        :param workers: maximum amount of concurrent jobs, defaults to CPU count
+        :type workers: int
+
+        :param probe_cache: cache to reuse probed durations from
+        :type probe_cache: watermarkbuddy.cache.ProbeCache
+
+        :param parent: parent object
+        :type parent: QtCore.QObject
+        """
+        super(BatchRunner, self).__init__(parent)
+        self.probe_cache = probe_cache
+        self._thread_pool = QtCore.QThreadPool(self)
+        self._thread_pool.setMaxThreadCount(workers or batch.get_default_workers())
+        self._process_group = process.ProcessGroup()
+        self._results = []
+        self._pending = 0
+        self._start = 0.0
+        self.job_finished.connect(self._on_job_finished)
+
+    def _on_event(self, event):
+        """
+        Forwards the instrumentation events of the jobs as signals.
+
+        :param event: instrumentation event, see watermarkbuddy.events
+        :type event: dict
+        """
+        input_file = event.get("input_file")
+        if input_file is None:
+            return
+        if event["event"] == "stage_started":
+            self.job_stage.emit(input_file, event["stage"])
+        elif event["event"] == "progress" and event["out_time_seconds"] is not None:
+            self.job_progress.emit(input_file, event["out_time_seconds"])
+
+    def _on_job_finished(self, result):
+        """
+        Collects the result of a job, emitting finished once all completed.
+
+        :param result: result of the completed job
+        :type result: watermarkbuddy.batch.JobResult
+        """
+        self._results.append(result)
+        self._pending -= 1
+        if self._pending == 0:
+            events.unsubscribe(self._on_event)
+            self.finished.emit(batch.BatchResult(self._results, time.time() - self._start))
+
+    def is_running(self):
+        """
+        Returns whether jobs are still running.
+
+        :rtype: bool
+        """
+        return self._pending > 0
+
+    def is_cancelled(self):
+        """
+        Returns whether the current run was cancelled.
+
+        :rtype: bool
+        """
+        return self._process_group.is_terminated()
+
+    def start(self, jobs):
+        """
+        Starts running jobs.
+
+        :param jobs: jobs to execute
+        :type jobs: list[watermarkbuddy.batch.Job]
+
+        :raises RuntimeError: if jobs are still running
+        """
+        if self.is_running():
+            raise RuntimeError("jobs are still running")
+
+        jobs = list(jobs)
+        self._process_group = process.ProcessGroup()
+        self._results = []
+        self._pending = len(jobs)
+        self._start = time.time()
+        if not jobs:
+            self.finished.emit(batch.BatchResult([], 0.0))
+            return
+
+        events.subscribe(self._on_event)
+        for job in jobs:
+            self._thread_pool.start(JobRunnable(job, self))
+
+    def cancel(self):
+        """
+        Cancels the current run, killing the running ffmpeg subprocesses of
+        its jobs. Jobs which did not start yet complete right away as
+        cancelled, as do jobs about to start a subprocess.
+        """
+        if not self.is_running():
+            return
+        self._process_group.terminate()
+
+    def wait(self):
+        """Blocks until all started jobs completed."""
+        self._thread_pool.waitForDone()
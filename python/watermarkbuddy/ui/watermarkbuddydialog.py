@@ -4,9 +4,12 @@ import os
 
 # tool modules
 from watermarkbuddy import watermarkbuddy
+from watermarkbuddy import batch
+from watermarkbuddy import cache
+from watermarkbuddy.ui import runner
 
 # third party modules
-from PySide2 import QtWidgets, QtCore
+from PySide2 import QtWidgets, QtCore, QtGui
 
 
 class WatermarkBuddyDialog(QtWidgets.QDialog):
@@ -15,6 +18,12 @@ class WatermarkBuddyDialog(QtWidgets.QDialog):
     def __init__(self):
         """Initializes the object."""
         super(WatermarkBuddyDialog, self).__init__()
+        self._cache = cache.WatermarkCache()
+        self._probe_cache = cache.ProbeCache()
+        self._runner = runner.BatchRunner(probe_cache=self._probe_cache, parent=self)
+        self._preview_runner = runner.PreviewRunner(probe_cache=self._probe_cache, parent=self)
+        self._durations = {}
+        self._progress = {}
         self._build_ui()
         self._set_default_settings()
         self._connect_signals()
@@ -78,6 +87,11 @@ class WatermarkBuddyDialog(QtWidgets.QDialog):
         self._combo_blend_mode.addItems(watermarkbuddy.get_blend_modes())
         self._combo_blend_mode.setToolTip("Video filter to blend the watermark file with.")
 
+        lbl_profile = QtWidgets.QLabel("Profile:")
+        self._combo_profile = QtWidgets.QComboBox()
+        self._combo_profile.addItems(["default"] + watermarkbuddy.get_profiles())
+        self._combo_profile.setToolTip("Encoding profile trading output quality for speed.")
+
         self._btn_reset_settings = QtWidgets.QPushButton("Reset")
         self._btn_reset_settings.setToolTip("Resets all settings to default settings.")
 
@@ -94,7 +108,9 @@ class WatermarkBuddyDialog(QtWidgets.QDialog):
         group_box_settings_layout.addWidget(self._cb_auto_scale, 2, 1, 1, 3)
         group_box_settings_layout.addWidget(lbl_blend_mode, 3, 0)
         group_box_settings_layout.addWidget(self._combo_blend_mode, 3, 1, 1, 2)
-        group_box_settings_layout.addWidget(self._btn_reset_settings, 4, 0, 1, 3)
+        group_box_settings_layout.addWidget(lbl_profile, 4, 0)
+        group_box_settings_layout.addWidget(self._combo_profile, 4, 1, 1, 2)
+        group_box_settings_layout.addWidget(self._btn_reset_settings, 5, 0, 1, 3)
         group_box_settings.setLayout(group_box_settings_layout)
 
         # output directory
@@ -114,22 +130,48 @@ class WatermarkBuddyDialog(QtWidgets.QDialog):
         # buttons
         self._btn_run = QtWidgets.QPushButton("Run")
         self._btn_run.setToolTip("Button to start the watermark adding process.")
+        self._btn_cancel = QtWidgets.QPushButton("Cancel")
+        self._btn_cancel.setToolTip("Button to cancel the watermark adding process.")
+        self._btn_cancel.setEnabled(False)
         button_layout = QtWidgets.QHBoxLayout()
         button_layout.addWidget(self._btn_run)
+        button_layout.addWidget(self._btn_cancel)
 
         # progress bar
         self._progress_bar = QtWidgets.QProgressBar()
         self._progress_bar.setTextVisible(False)
         self._progress_bar.setFixedHeight(10)
 
+        # status
+        self._lbl_status = QtWidgets.QLabel()
+        self._lbl_status.setToolTip("Current stage and progress of the watermarking process.")
+
+        # preview
+        self._lbl_preview = QtWidgets.QLabel()
+        self._lbl_preview.setAlignment(QtCore.Qt.AlignCenter)
+        self._lbl_preview.setMinimumSize(480, 360)
+        self._lbl_preview.setToolTip("Preview of the watermark on the selected file.")
+        self._preview_timer = QtCore.QTimer(self)
+        self._preview_timer.setSingleShot(True)
+        self._preview_timer.setInterval(50)
+
+        group_box_preview = QtWidgets.QGroupBox("Preview:")
+        group_box_preview_layout = QtWidgets.QVBoxLayout()
+        group_box_preview_layout.addWidget(self._lbl_preview)
+        group_box_preview.setLayout(group_box_preview_layout)
+
         # main layout
-        main_layout = QtWidgets.QVBoxLayout()
-        main_layout.addWidget(group_box_list)
-        main_layout.addWidget(group_box_watermark)
-        main_layout.addWidget(group_box_settings)
-        main_layout.addWidget(group_box_output)
-        main_layout.addLayout(button_layout)
-        main_layout.addWidget(self._progress_bar)
+        settings_layout = QtWidgets.QVBoxLayout()
+        settings_layout.addWidget(group_box_list)
+        settings_layout.addWidget(group_box_watermark)
+        settings_layout.addWidget(group_box_settings)
+        settings_layout.addWidget(group_box_output)
+        settings_layout.addLayout(button_layout)
+        settings_layout.addWidget(self._progress_bar)
+        settings_layout.addWidget(self._lbl_status)
+        main_layout = QtWidgets.QHBoxLayout()
+        main_layout.addLayout(settings_layout)
+        main_layout.addWidget(group_box_preview)
         self.setLayout(main_layout)
 
         # window settings
@@ -142,6 +184,7 @@ class WatermarkBuddyDialog(QtWidgets.QDialog):
         self._cb_auto_scale.setChecked(False)
         self._combo_position.setCurrentText("top-left")
         self._combo_blend_mode.setCurrentText("normal")
+        self._combo_profile.setCurrentText("default")
         self._le_output_dir.setText("/tmp")
 
     def _connect_signals(self):
@@ -153,6 +196,25 @@ class WatermarkBuddyDialog(QtWidgets.QDialog):
         self._btn_reset_settings.clicked.connect(self._signal_reset_settings)
         self._btn_browse_output.clicked.connect(self._signal_browse_output)
         self._btn_run.clicked.connect(self._signal_run)
+        self._btn_cancel.clicked.connect(self._signal_cancel)
+        self._runner.job_started.connect(self._signal_job_started)
+        self._runner.job_stage.connect(self._signal_job_stage)
+        self._runner.job_progress.connect(self._signal_job_progress)
+        self._runner.job_finished.connect(self._signal_job_finished)
+        self._runner.finished.connect(self._signal_run_finished)
+
+        # preview the settings as they change
+        self._list_model.modelReset.connect(self._signal_settings_changed)
+        self._list_view.selectionModel().selectionChanged.connect(self._signal_settings_changed)
+        self._le_watermark.textChanged.connect(self._signal_settings_changed)
+        self._le_offset_x.textChanged.connect(self._signal_settings_changed)
+        self._le_offset_y.textChanged.connect(self._signal_settings_changed)
+        self._combo_position.currentTextChanged.connect(self._signal_settings_changed)
+        self._cb_auto_scale.stateChanged.connect(self._signal_settings_changed)
+        self._combo_blend_mode.currentTextChanged.connect(self._signal_settings_changed)
+        self._preview_timer.timeout.connect(self._signal_update_preview)
+        self._preview_runner.rendered.connect(self._signal_preview_rendered)
+        self._preview_runner.failed.connect(self._signal_preview_failed)
 
     def _signal_add_files(self):
         """Handles adding files."""
@@ -212,42 +274,148 @@ class WatermarkBuddyDialog(QtWidgets.QDialog):
         offset_x = self._le_offset_x.text()
         offset_y = self._le_offset_y.text()
         blend_mode = self._combo_blend_mode.currentText()
+        profile = self._combo_profile.currentText()
+        if profile == "default":
+            profile = None
+
+        try:
+            jobs = batch.build_jobs(src_files,
+                                    watermark_file,
+                                    dst_dir,
+                                    autoscale=autoscale,
+                                    position=position,
+                                    offset_x=int(offset_x),
+                                    offset_y=int(offset_y),
+                                    blend_mode=blend_mode,
+                                    profile=profile,
+                                    cache=self._cache,
+                                    probe_cache=self._probe_cache)
+        except ValueError as e:
+            self._show_error("ERROR: WatermarkBuddy", str(e))
+            return
+
+        # set progress range, a hundred steps per file
+        self._durations = {}
+        self._progress = dict((src_file, 0.0) for src_file in src_files)
+        self._progress_bar.setRange(0, max(len(src_files), 1) * 100)
+        self._progress_bar.setValue(0)
 
-        # set progress range
-        self._progress_bar.setRange(0, len(src_files) - 1)
-
-        dst_files = []
-        for i, src_file in enumerate(src_files):
-            # update bar
-            self._progress_bar.setValue(i)
-
-            # build output file path
-            fname = os.path.basename(src_file)
-            dst_file = os.path.join(dst_dir, fname)
-
-            # add watermark
-            try:
-                watermarkbuddy.add_watermark(src_file,
-                                             watermark_file,
-                                             dst_file,
-                                             autoscale=autoscale,
-                                             position=position,
-                                             offset_x=int(offset_x),
-                                             offset_y=int(offset_y),
-                                             blend_mode=blend_mode)
-            except Exception as e:
-                # show error and stop process
-                self._show_error("ERROR: WatermarkBuddy", str(e))
-                return
-
-            dst_files.append(dst_file)
-
-        # show success messagebox
-        self._show_success("COMPLETE: WatermarkBuddy", dst_files)
+        self._set_running(True)
+        self._runner.start(jobs)
+
+    def _signal_cancel(self):
+        """Handles cancelling the watermarking process."""
+        self._lbl_status.setText("Cancelling...")
+        self._runner.cancel()
+
+    def _signal_job_started(self, src_file, duration):
+        """Handles a file starting to be processed."""
+        self._durations[src_file] = duration
+
+    def _signal_job_stage(self, src_file, stage):
+        """Handles a file entering a stage of the watermarking process."""
+        self._lbl_status.setText("{}: {}".format(os.path.basename(src_file), stage))
+
+    def _signal_job_progress(self, src_file, seconds):
+        """Handles the ffmpeg progress of a file."""
+        duration = self._durations.get(src_file)
+        if not duration:
+            return
+        self._set_progress(src_file, min(seconds / duration, 1.0))
+        text = "{}: {:.1f}s / {:.1f}s".format(os.path.basename(src_file), seconds, duration)
+        self._lbl_status.setText(text)
+
+    def _signal_job_finished(self, result):
+        """Handles a file being processed."""
+        self._set_progress(result.job.input_file, 1.0)
+
+    def _signal_settings_changed(self, *args):
+        """Handles a change of the files or settings, previewing them once settled."""
+        self._preview_timer.start()
+
+    def _signal_update_preview(self):
+        """Handles requesting a preview of the current settings."""
+        selected = self._get_selected_files() or self._list_model.stringList()
+        watermark_file = self._le_watermark.text()
+        if not selected or not watermark_file:
+            self._lbl_preview.clear()
+            return
+
+        try:
+            offset_x = int(self._le_offset_x.text())
+            offset_y = int(self._le_offset_y.text())
+        except ValueError:
+            # keep the last preview while an offset is being typed
+            return
+
+        self._preview_runner.request(input_file=selected[0],
+                                     watermark_file=watermark_file,
+                                     autoscale=self._cb_auto_scale.isChecked(),
+                                     position=self._combo_position.currentText(),
+                                     offset_x=offset_x,
+                                     offset_y=offset_y,
+                                     blend_mode=self._combo_blend_mode.currentText())
+
+    def _signal_preview_rendered(self, data):
+        """Handles a preview being rendered."""
+        pixmap = QtGui.QPixmap()
+        pixmap.loadFromData(data)
+        self._lbl_preview.setPixmap(pixmap)
+        self._lbl_preview.setToolTip("Preview of the watermark on the selected file.")
+
+    def _signal_preview_failed(self, message):
+        """Handles a preview failing to render."""
+        self._lbl_preview.setText("No preview available.")
+        self._lbl_preview.setToolTip(message)
+
+    def _signal_run_finished(self, result):
+        """Handles all files being processed."""
+        self._set_running(False)
 
         # reset progress
         self._progress_bar.setRange(0, 1)
         self._progress_bar.setValue(0)
+        self._lbl_status.clear()
+
+        if result.failed:
+            self._show_failures("ERROR: WatermarkBuddy", result)
+            return
+
+        # show success messagebox
+        self._show_success("COMPLETE: WatermarkBuddy",
+                           [r.job.output_file for r in result.succeeded])
+
+    def _set_progress(self, src_file, fraction):
+        """
+        Sets the progress of a file and updates the progress bar.
+
+        :param src_file: file being processed
+        :type src_file: str
+
+        :param fraction: processed part of the file, between 0 and 1
+        :type fraction: float
+        """
+        self._progress[src_file] = fraction
+        self._progress_bar.setValue(int(sum(self._progress.values()) * 100))
+
+    def _set_running(self, running):
+        """
+        Enables the buttons matching whether the watermarking process runs.
+
+        :param running: whether the watermarking process runs
+        :type running: bool
+        """
+        self._btn_run.setEnabled(not running)
+        self._btn_cancel.setEnabled(running)
+
+    def reject(self):
+        """Cancels the watermarking process, if running, and closes the dialog."""
+        if self._runner.is_running():
+            self._runner.cancel()
+            self._runner.wait()
+        self._preview_timer.stop()
+        self._preview_runner.wait()
+        super(WatermarkBuddyDialog, self).reject()
 
     def _show_error(self, title, message):
         """
@@ -278,6 +446,25 @@ class WatermarkBuddyDialog(QtWidgets.QDialog):
         msg_box.setDetailedText("\n".join(files))
         msg_box.exec_()
 
+    def _show_failures(self, title, result):
+        """
+        Shows a message box listing the files which failed to be processed.
+
+        :param title: error dialog window title
+        :type title: str
+
+        :param result: result of the watermarking process
+        :type result: watermarkbuddy.batch.BatchResult
+        """
+        msg_box = QtWidgets.QMessageBox()
+        msg_box.setIcon(QtWidgets.QMessageBox.Critical)
+        msg_box.setWindowTitle(title)
+        msg = "Failed to create {} of {} files."
+        msg_box.setText(msg.format(len(result.failed), len(result.results)))
+        msg_box.setDetailedText("\n".join("{}: {}".format(r.job.input_file, r.error)
+                                          for r in result.failed))
+        msg_box.exec_()
+
     def _get_selected_files(self):
         """
         Returns the selected files.
@@ -0,0 +1,602 @@
+# stdlib modules
+from __future__ import absolute_import
+import os
+import sys
+import time
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+import threading
+from multiprocessing.pool import ThreadPool
+
+# tool modules
+from watermarkbuddy import batch
+from watermarkbuddy import events
+
+# inotify event masks, see inotify(7)
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_WATCH_MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE_SELF
+
+# header of an inotify event: wd, mask, cookie and name length
+_IN_EVENT = struct.Struct("iIII")
+
+
+# =============================================================================
+# classes
+# =============================================================================
+class _Watcher(object):
+    """Base of the watchers reporting files of directory trees."""
+
+    def __init__(self, directories, exclude=None):
+        """
+        Initializes the object.
+
+        :param directories: directories to watch, including subdirectories
+        :type directories: list[str]
+
+        :param exclude: directories not to watch, e.g. an output directory
+                        within a watched directory
+        :type exclude: list[str]
+        """
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.exclude = [os.path.abspath(d) for d in exclude or []]
+
+    def _is_excluded(self, directory):
+        """
+        Returns whether a directory, or one of its parents, is excluded.
+
+        :param directory: absolute directory path
+        :type directory: str
+
+        :rtype: bool
+        """
+        return any(directory == d or directory.startswith(d + os.sep) for d in self.exclude)
+
+    def _walk(self, directory):
+        """
+        Lists the subdirectories and files of a directory tree, skipping
+        hidden and excluded entries.
+
+        :param directory: directory to list
+        :type directory: str
+
+        :return: subdirectories, including the directory itself, and files
+        :rtype: tuple[list[str], list[str]]
+        """
+        directories = []
+        files = []
+        for root, dirnames, fnames in os.walk(directory):
+            dirnames[:] = [d for d in dirnames
+                           if not d.startswith(".") and not self._is_excluded(os.path.join(root, d))]
+            directories.append(root)
+            files.extend(os.path.join(root, f) for f in fnames if not f.startswith("."))
+        return directories, files
+
+    def poll(self, timeout):
+        """
+        Waits for changes, returning the files which were created or written.
+
+        The first call returns all existing files.
+
+        :param timeout: maximum amount of seconds to wait
+        :type timeout: float
+
+        :rtype: list[str]
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Stops watching."""
+
+
+class _InotifyWatcher(_Watcher):
+    """Watcher reporting changes as they happen, using Linux inotify."""
+
+    def __init__(self, directories, exclude=None):
+        """
+        Initializes the object.
+
+        :param directories: directories to watch, including subdirectories
+        :type directories: list[str]
+
+        :param exclude: directories not to watch
+        :type exclude: list[str]
+
+        :raises OSError: if inotify is not available
+        """
+        super(_InotifyWatcher, self).__init__(directories, exclude)
+        self._libc = _load_libc()
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC if hasattr(os, "O_CLOEXEC") else 0)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watches = {}
+        self._started = False
+
+    def _add_tree(self, directory):
+        """
+        Watches a directory tree, returning the files it holds already.
+
+        :param directory: directory to watch
+        :type directory: str
+
+        :rtype: list[str]
+        """
+        directories, files = self._walk(directory)
+        for d in directories:
+            path = d.encode(sys.getfilesystemencoding())
+            wd = self._libc.inotify_add_watch(self._fd, path, _IN_WATCH_MASK)
+            if wd < 0:
+                # removed in the meantime or out of watches
+                events.emit("watch_failed", directory=d, error=os.strerror(ctypes.get_errno()))
+                continue
+            self._watches[wd] = d
+        return files
+
+    def _rescan(self):
+        """
+        Watches all directories from scratch, after the kernel dropped events.
+
+        :rtype: list[str]
+        """
+        for wd in list(self._watches):
+            self._libc.inotify_rm_watch(self._fd, wd)
+        self._watches = {}
+        files = []
+        for directory in self.directories:
+            files.extend(self._add_tree(directory))
+        return files
+
+    def _read_events(self):
+        """
+        Reads the pending inotify events.
+
+        :return: watch, mask and name of each event
+        :rtype: list[tuple[int, int, str]]
+        """
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError as e:
+            if e.errno in (errno.EINTR, errno.EAGAIN):
+                return []
+            raise
+
+        result = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _IN_EVENT.unpack_from(data, offset)
+            offset += _IN_EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            result.append((wd, mask, name.decode(sys.getfilesystemencoding(), "replace")))
+        return result
+
+    def _handle_event(self, wd, mask, name):
+        """
+        Handles an inotify event, returning the files it reports.
+
+        :param wd: watch the event belongs to
+        :type wd: int
+
+        :param mask: mask of the event
+        :type mask: int
+
+        :param name: name of the file or directory within the watched one
+        :type name: str
+
+        :rtype: list[str]
+        """
+        if mask & _IN_IGNORED:
+            self._watches.pop(wd, None)
+            return []
+
+        directory = self._watches.get(wd)
+        if directory is None or not name or name.startswith("."):
+            return []
+        path = os.path.join(directory, name)
+        if mask & _IN_ISDIR:
+            # created or moved in, may hold files already
+            return [] if self._is_excluded(path) else self._add_tree(path)
+        return [path]
+
+    def poll(self, timeout):
+        """Waits for inotify events, see _Watcher.poll."""
+        if not self._started:
+            self._started = True
+            return self._rescan()
+
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+
+        files = []
+        for wd, mask, name in self._read_events():
+            if mask & _IN_Q_OVERFLOW:
+                return self._rescan()
+            files.extend(self._handle_event(wd, mask, name))
+        return files
+
+    def close(self):
+        """Stops watching, see _Watcher.close."""
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class _PollingWatcher(_Watcher):
+    """
+    Watcher reporting changes by polling, for systems or file systems which
+    do not support inotify, e.g. network shares.
+
+    Only directories whose modification time changed are listed again, so the
+    cost of a poll grows with the amount of directories, not files. Files
+    overwritten in place do not change the directory, so are not reported.
+    """
+
+    def __init__(self, directories, exclude=None):
+        """
+        Initializes the object.
+
+        :param directories: directories to watch, including subdirectories
+        :type directories: list[str]
+
+        :param exclude: directories not to watch
+        :type exclude: list[str]
+        """
+        super(_PollingWatcher, self).__init__(directories, exclude)
+        self._mtimes = {}
+        self._started = False
+
+    def _add_tree(self, directory):
+        """
+        Tracks a directory tree, returning the files it holds.
+
+        :param directory: directory to track
+        :type directory: str
+
+        :rtype: list[str]
+        """
+        directories, files = self._walk(directory)
+        for d in directories:
+            try:
+                self._mtimes[d] = os.stat(d).st_mtime
+            except OSError:
+                pass
+        return files
+
+    def _list_changed(self, directory):
+        """
+        Lists a directory whose modification time changed, tracking the
+        subdirectories which were added.
+
+        :param directory: changed directory
+        :type directory: str
+
+        :rtype: list[str]
+        """
+        files = []
+        for fname in os.listdir(directory):
+            path = os.path.join(directory, fname)
+            if fname.startswith("."):
+                continue
+            if os.path.isdir(path):
+                if path not in self._mtimes and not self._is_excluded(path):
+                    files.extend(self._add_tree(path))
+            else:
+                files.append(path)
+        return files
+
+    def poll(self, timeout):
+        """Lists the directories which changed, see _Watcher.poll."""
+        if not self._started:
+            self._started = True
+            files = []
+            for directory in self.directories:
+                files.extend(self._add_tree(directory))
+            return files
+
+        time.sleep(timeout)
+        files = []
+        for directory, mtime in list(self._mtimes.items()):
+            try:
+                current = os.stat(directory).st_mtime
+            except OSError:
+                # removed
+                del self._mtimes[directory]
+                continue
+            if current != mtime:
+                self._mtimes[directory] = current
+                files.extend(self._list_changed(directory))
+        return files
+
+
+class HotFolder(object):
+    """
+    Watches directories, adding the watermark to each file once it is
+    completely written. Outputs mirror the directory structure of the inputs
+    in the output directory.
+
+    A file is considered completely written once its size and modification
+    time did not change for a settle time. Up to date outputs are skipped,
+    being outputs newer than their input or, if a manifest is given, outputs
+    recorded as up to date.
+    """
+
+    def __init__(self,
+                 directories,
+                 watermark_file,
+                 output_dir,
+                 workers=None,
+                 settle=2.0,
+                 manifest=None,
+                 callback=None,
+                 timeout=None,
+                 max_rss=None,
+                 **options):
+        """
+        Initializes the object.
+
+        :param directories: directories to watch, including subdirectories
+        :type directories: list[str]
+
+        :param watermark_file: file to use as watermark
+        :type watermark_file: str
+
+        :param output_dir: directory to write outputs to
+        :type output_dir: str
+
+        :param workers: maximum amount of concurrent jobs, defaults to CPU count
+        :type workers: int
+
+        :param settle: amount of seconds a file must remain unchanged before
+                       it is processed
+        :type settle: float
+
+        :param manifest: manifest to skip jobs with an up to date output with,
+                         updated with each succeeded job
+        :type manifest: watermarkbuddy.incremental.Manifest
+
+        :param callback: function called with each JobResult once it completes
+        :type callback: callable
+
+        :param timeout: maximum amount of seconds each job may run
+        :type timeout: float
+
+        :param max_rss: maximum resident memory of each ffmpeg process in bytes
+        :type max_rss: int
+
+        :param options: keyword arguments passed to add_watermark
+        :type options: dict
+        """
+        for directory in directories:
+            if not os.path.isdir(directory):
+                raise ValueError("directory does not exist: {}".format(directory))
+        if not os.path.isdir(output_dir):
+            raise ValueError("output directory does not exist: {}".format(output_dir))
+
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.watermark_file = watermark_file
+        self.output_dir = os.path.abspath(output_dir)
+        self.workers = workers or batch.get_default_workers()
+        if self.workers < 1:
+            raise ValueError("invalid amount of workers {!r}".format(self.workers))
+        self.settle = settle
+        self.manifest = manifest
+        self.callback = callback
+        self.timeout = timeout
+        self.max_rss = max_rss
+        self.options = options
+
+        # files waiting to settle: path -> (size, mtime, time of last change)
+        self._pending = {}
+        # processed or running files: path -> (size, mtime)
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def _get_root(self, path):
+        """
+        Returns the watched directory holding a file.
+
+        :param path: absolute file path
+        :type path: str
+
+        :rtype: str
+        """
+        for directory in self.directories:
+            if path.startswith(directory + os.sep):
+                return directory
+        return os.path.dirname(path)
+
+    def _get_job(self, path):
+        """
+        Builds the job of a file, writing to the mirrored output path.
+
+        :param path: absolute file path
+        :type path: str
+
+        :rtype: watermarkbuddy.batch.Job
+        """
+        relpath = os.path.relpath(path, self._get_root(path))
+        output_file = os.path.join(self.output_dir, relpath)
+        return batch.Job(path, self.watermark_file, output_file, **self.options)
+
+    def _is_up_to_date(self, job):
+        """
+        Returns whether the output of a job is up to date.
+
+        :param job: job to check
+        :type job: watermarkbuddy.batch.Job
+
+        :rtype: bool
+        """
+        if self.manifest is not None:
+            with self._lock:
+                return self.manifest.is_up_to_date(job)
+        try:
+            return os.path.getmtime(job.output_file) >= os.path.getmtime(job.input_file)
+        except OSError:
+            return False
+
+    def _add_candidate(self, path):
+        """
+        Starts tracking a created or written file until it settled.
+
+        :param path: absolute file path
+        :type path: str
+        """
+        if path not in self._pending:
+            self._pending[path] = (None, None, None)
+
+    def _pop_settled(self, now):
+        """
+        Returns the tracked files which did not change for the settle time,
+        no longer tracking them.
+
+        :param now: current time
+        :type now: float
+
+        :rtype: list[tuple[str, tuple[int, float]]]
+        """
+        settled = []
+        for path, (size, mtime, changed) in list(self._pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # removed or renamed before it settled
+                del self._pending[path]
+                continue
+
+            current = (stat.st_size, stat.st_mtime)
+            if current != (size, mtime):
+                # on first sight, the modification time is the last change
+                changed = min(now, stat.st_mtime) if size is None else now
+                self._pending[path] = current + (changed,)
+            if now - changed >= self.settle:
+                del self._pending[path]
+                if self._seen.get(path) != current:
+                    settled.append((path, current))
+        return settled
+
+    def _on_result(self, result):
+        """
+        Records the result of a job, called from the pool.
+
+        :param result: result of the completed job
+        :type result: watermarkbuddy.batch.JobResult
+        """
+        if self.manifest is not None and result.succeeded:
+            with self._lock:
+                self.manifest.update(result.job)
+        if self.callback:
+            self.callback(result)
+
+    def _submit(self, pool, path, stat):
+        """
+        Adds the watermark to a settled file on the pool, unless its output is
+        up to date.
+
+        :param pool: pool executing the jobs
+        :type pool: multiprocessing.pool.ThreadPool
+
+        :param path: absolute file path
+        :type path: str
+
+        :param stat: size and modification time of the file
+        :type stat: tuple[int, float]
+        """
+        self._seen[path] = stat
+        job = self._get_job(path)
+        if self._is_up_to_date(job):
+            return
+
+        output_dir = os.path.dirname(job.output_file)
+        if not os.path.isdir(output_dir):
+            try:
+                os.makedirs(output_dir)
+            except OSError:
+                # created concurrently, or reported by the job
+                pass
+        events.emit("file_detected", input_file=path)
+        pool.apply_async(batch.run_job,
+                         (job, self.timeout, self.max_rss),
+                         callback=self._on_result)
+
+    def run(self, stop_event=None, polling=False, interval=1.0):
+        """
+        Watches the directories until stopped, processing existing files
+        first.
+
+        :param stop_event: event to set to stop watching, None to watch until
+                           interrupted
+        :type stop_event: threading.Event
+
+        :param polling: set True to poll instead of using inotify, which is
+                        also used if inotify is not available
+        :type polling: bool
+
+        :param interval: maximum amount of seconds between checks for changes
+        :type interval: float
+        """
+        watcher = _create_watcher(self.directories, [self.output_dir], polling)
+        pool = ThreadPool(self.workers)
+        try:
+            while stop_event is None or not stop_event.is_set():
+                for path in watcher.poll(interval):
+                    self._add_candidate(path)
+                for path, stat in self._pop_settled(time.time()):
+                    self._submit(pool, path, stat)
+        finally:
+            watcher.close()
+            pool.close()
+            pool.join()
+            if self.manifest is not None:
+                self.manifest.save()
+
+
+# =============================================================================
+# private
+# =============================================================================
+def _load_libc():
+    """
+    Loads the C library exposing the inotify functions.
+
+    :raises OSError: if inotify is not available
+
+    :rtype: ctypes.CDLL
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    for name in ("inotify_init1", "inotify_add_watch", "inotify_rm_watch"):
+        if not hasattr(libc, name):
+            raise OSError("inotify is not available")
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+def _create_watcher(directories, exclude, polling=False):
+    """
+    Creates a watcher, using inotify if available.
+
+    :param directories: directories to watch
+    :type directories: list[str]
+
+    :param exclude: directories not to watch
+    :type exclude: list[str]
+
+    :param polling: set True to poll instead of using inotify
+    :type polling: bool
+
+    :rtype: _Watcher
+    """
+    if not polling:
+        try:
+            return _InotifyWatcher(directories, exclude)
+        except (OSError, AttributeError):
+            pass
+    return _PollingWatcher(directories, exclude)
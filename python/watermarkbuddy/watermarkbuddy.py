@@ -1,14 +1,120 @@
 # stdlib modules
+from __future__ import absolute_import
+import io
 import os
 import json
 import tempfile
-import subprocess
+
+# tool modules
+from watermarkbuddy import events
+from watermarkbuddy import capabilities
+from watermarkbuddy import process
 
 try:
     basestring
 except NameError:
     basestring = str
 
+# scale2ref expressions scaling the watermark to the width of the reference,
+# keyed by the variable naming of the installed ffmpeg
+_SCALE2REF_EXPRESSIONS = {
+    "default": "w=main_w:h=round(main_w*ih/iw)",
+    "swapped": "w=iw:h=round(iw*main_h/main_w)"}
+
+# default settings of a watermark variant, see add_watermark_variants
+_VARIANT_DEFAULTS = {"autoscale": False,
+                     "position": "top-left",
+                     "offset_x": 0,
+                     "offset_y": 0,
+                     "blend_mode": "normal",
+                     "profile": None}
+
+# frame counts of watermarks, keyed by path, size and modification time
+_FRAME_COUNTS = {}
+
+# ffmpeg arguments forcing the format of piped input, keyed by format hint
+_PIPE_INPUT_FORMATS = {
+    "jpg": ["-f", "image2pipe"],
+    "jpeg": ["-f", "image2pipe"],
+    "png": ["-f", "image2pipe"],
+    "mkv": ["-f", "matroska"],
+    "mov": ["-f", "mov"],
+    "mp4": ["-f", "mp4"]}
+
+# ffmpeg arguments to write a format to a pipe, keyed by format hint
+_PIPE_OUTPUT_FORMATS = {
+    "jpg": ["-f", "image2pipe", "-c:v", "mjpeg"],
+    "jpeg": ["-f", "image2pipe", "-c:v", "mjpeg"],
+    "png": ["-f", "image2pipe", "-c:v", "png"],
+    "mkv": ["-f", "matroska"],
+    # mp4/mov muxers need a seekable output unless fragmented
+    "mov": ["-f", "mov", "-movflags", "frag_keyframe+empty_moov"],
+    "mp4": ["-f", "mp4", "-movflags", "frag_keyframe+empty_moov"]}
+
+# ffmpeg encoding arguments of each encoding profile, keyed by output type
+_PROFILES = {
+    "fast": {
+        "video": ["-c:v", "libx264", "-preset", "veryfast", "-crf", "26"],
+        "webm": ["-c:v", "libvpx-vp9", "-deadline", "realtime", "-cpu-used", "8", "-crf", "36", "-b:v", "0"],
+        "jpg": ["-q:v", "7"],
+        "png": ["-compression_level", "1"]},
+    "balanced": {
+        "video": ["-c:v", "libx264", "-preset", "fast", "-crf", "23"],
+        "webm": ["-c:v", "libvpx-vp9", "-deadline", "good", "-cpu-used", "4", "-crf", "32", "-b:v", "0"],
+        "jpg": ["-q:v", "3"],
+        "png": ["-compression_level", "6"]},
+    "archive": {
+        "video": ["-c:v", "libx264", "-preset", "slow", "-crf", "18"],
+        "webm": ["-c:v", "libvpx-vp9", "-deadline", "good", "-cpu-used", "1", "-crf", "24", "-b:v", "0"],
+        "jpg": ["-q:v", "2"],
+        "png": ["-compression_level", "9"]}}
+
+# output types of the encoding profiles, keyed by file extension
+_PROFILE_OUTPUT_TYPES = {
+    ".jpg": "jpg",
+    ".jpeg": "jpg",
+    ".png": "png",
+    ".mp4": "video",
+    ".m4v": "video",
+    ".mov": "video",
+    ".mkv": "video",
+    ".webm": "webm"}
+
+# blend modes of recent ffmpeg releases, used if ffmpeg is not found
+_BLEND_MODES = ["addition",
+                "grainmerge",
+                "and",
+                "average",
+                "burn",
+                "darken",
+                "difference",
+                "grainextract",
+                "divide",
+                "dodge",
+                "freeze",
+                "exclusion",
+                "extremity",
+                "glow",
+                "hardlight",
+                "hardmix",
+                "heat",
+                "lighten",
+                "linearlight",
+                "multiply",
+                "multiply128",
+                "negation",
+                "normal",
+                "or",
+                "overlay",
+                "phoenix",
+                "pinlight",
+                "reflect",
+                "screen",
+                "softlight",
+                "subtract",
+                "vividlight",
+                "xor"]
+
 
 # =============================================================================
 # private
@@ -34,47 +140,780 @@ def _get_overlay(position, offset_x, offset_y):
     return overlay.format(offset_x=offset_x, offset_y=offset_y)
 
 
-def _get_stream_data(file_path):
+def _probe_stream_data(file_path):
     """
-    Gets the video stream data of a file.
+    Probes the video stream data of a file with ffprobe.
 
     :param file_path: file to read
     :type file_path: str
 
     :rtype: dict
     """
-    args = ["ffprobe",
+    stdout = execute_cmd(_get_probe_args(file_path))
+    src_data = json.loads(stdout)
+    return src_data["streams"][0]
+
+
+def _get_probe_args(file_path):
+    """
+    Builds the ffprobe command reading the video stream data of a file.
+
+    :param file_path: file to read
+    :type file_path: str
+
+    :rtype: list[str]
+    """
+    return ["ffprobe",
             "-show_streams",  # display stream information
             "-print_format", "json",  # json string format
             "-v", "quiet",  # ensure no lib data gets printed
             "-hide_banner",  # ensure no banner gets printed
             "-select_streams", "v:0",  # read first video stream
             file_path]
-    stdout = _execute_cmd(args)
-    src_data = json.loads(stdout)
-    return src_data["streams"][0]
 
 
-def _execute_cmd(args):
+def _scale_watermark(watermark_file, output_file, width, sar):
+    """
+    Writes a version of the watermark scaled to a width, keeping aspect ratio.
+
+    :param watermark_file: file to use as watermark
+    :type watermark_file: str
+
+    :param output_file: file path to write the scaled watermark to
+    :type output_file: str
+
+    :param width: width to scale the watermark to
+    :type width: int
+
+    :param sar: sample aspect ratio to set, formatted as num/den
+    :type sar: str
     """
-    Executes a command in a subprocess.
+    vf = "scale={width}:{height},setsar={sar}"
+    vf = vf.format(width=width, height=-1, sar=sar)
+
+    # build arguments
+    args = ["ffmpeg",
+            "-hide_banner",
+            "-y",
+            "-i", watermark_file,
+            "-vf", vf,
+            output_file]
+    with events.stage("scale"):
+        execute_cmd(args)
+
+
+def _prescale_watermark(stream_data, watermark_file, cache=None):
+    """
+    Creates a version of the watermark scaled to the width of the input file.
+
+    :param stream_data: video stream data of the input file
+    :type stream_data: dict
+
+    :param watermark_file: file to use as watermark
+    :type watermark_file: str
+
+    :param cache: cache to reuse scaled watermarks from
+    :type cache: watermarkbuddy.cache.WatermarkCache
+
+    :return: scaled watermark, a tmp file to delete later if no cache is given
+    :rtype: str
+    """
+    width = stream_data["width"]
+    sar = stream_data["sample_aspect_ratio"]
+    sar = sar.replace(":", "/")
+
+    if cache is not None:
+        # reuse previously scaled version of watermark
+        return cache.get_scaled(watermark_file, width, sar)
+
+    # create tmp scaled version of watermark
+    ext = os.path.splitext(watermark_file)[1]
+    fp, tmp_watermark = tempfile.mkstemp(suffix=ext)
+    os.close(fp)
+    try:
+        _scale_watermark(watermark_file, tmp_watermark, width, sar)
+    except RuntimeError:
+        os.remove(tmp_watermark)
+        raise
+    return tmp_watermark
+
+
+def _get_variant(variant):
+    """
+    Returns a watermark variant completed with the default settings.
+
+    :param variant: watermark variant, see add_watermark_variants
+    :type variant: dict
+
+    :raises ValueError: if a required key is missing or a key is unknown
+
+    :rtype: dict
+    """
+    required = set(["watermark_file", "output_file"])
+    missing = required - set(variant)
+    if missing:
+        msg = "variant is missing keys: {}"
+        raise ValueError(msg.format(", ".join(sorted(missing))))
+
+    unknown = set(variant) - required - set(_VARIANT_DEFAULTS)
+    if unknown:
+        msg = "variant has unknown keys: {}"
+        raise ValueError(msg.format(", ".join(sorted(unknown))))
+
+    result = dict(_VARIANT_DEFAULTS)
+    result.update(variant)
+    return result
+
+
+def _get_variants(variants):
+    """
+    Returns the validated watermark variants completed with default settings.
+
+    :param variants: watermark variants, see add_watermark_variants
+    :type variants: list[dict]
+
+    :raises ValueError: if a variant is invalid or multiple variants share
+                        the same output file
+
+    :rtype: list[dict]
+    """
+    variants = [_get_variant(variant) for variant in variants]
+    output_files = set()
+    for variant in variants:
+        validate_watermark(variant["watermark_file"],
+                           variant["output_file"],
+                           variant["position"],
+                           variant["offset_x"],
+                           variant["offset_y"],
+                           variant["blend_mode"])
+        validate_profile(variant["profile"])
+        if variant["output_file"] in output_files:
+            msg = "multiple variants write to: {}"
+            raise ValueError(msg.format(variant["output_file"]))
+        output_files.add(variant["output_file"])
+    return variants
+
+
+def _get_variants_filter_complex(variants, watermarks, inputs, scale2ref=None):
+    """
+    Builds the ffmpeg filter graph applying all watermark variants.
+
+    The decoded input is split once, feeding one filter chain per variant.
+
+    :param variants: watermark variants, see add_watermark_variants
+    :type variants: list[dict]
+
+    :param watermarks: watermark file to use for each variant
+    :type watermarks: list[str]
+
+    :param inputs: watermark files in order of their ffmpeg input index
+    :type inputs: list[str]
+
+    :param scale2ref: scale2ref expression to scale watermarks with
+    :type scale2ref: str
+
+    :rtype: str
+    """
+    # split decoded input to overlay and blend with per variant
+    labels = "".join("[main{0}][base{0}]".format(i) for i in range(len(variants)))
+    filters = ["[0:v]split={}{}".format(len(variants) * 2, labels)]
+    for i, variant in enumerate(variants):
+        if variant["autoscale"]:
+            overlay = _get_overlay("top-left", offset_x=0, offset_y=0)
+        else:
+            overlay = _get_overlay(variant["position"],
+                                   offset_x=variant["offset_x"],
+                                   offset_y=variant["offset_y"])
+        watermark = "[{}:v]".format(inputs.index(watermarks[i]) + 1)
+        filters.append(_get_filter_complex(overlay,
+                                           variant["blend_mode"],
+                                           scale2ref=scale2ref if variant["autoscale"] else None,
+                                           main="[main{}]".format(i),
+                                           watermark=watermark,
+                                           base="[base{}]".format(i),
+                                           output="[out{}]".format(i),
+                                           suffix=str(i)))
+    return ";".join(filters)
+
+
+def _get_variant_watermarks(input_file, variants, scale2ref, cache=None, probe_cache=None):
+    """
+    Returns the watermark file to use as input for each variant.
+
+    Autoscaled variants get a scaled version of their watermark if the
+    watermark cannot be scaled within the filter graph.
+
+    :param input_file: file to add watermarks to
+    :type input_file: str
+
+    :param variants: watermark variants, see add_watermark_variants
+    :type variants: list[dict]
+
+    :param scale2ref: scale2ref expression to scale watermarks with
+    :type scale2ref: str
+
+    :param cache: cache to reuse scaled watermarks from
+    :type cache: watermarkbuddy.cache.WatermarkCache
+
+    :param probe_cache: cache to reuse probed stream data from
+    :type probe_cache: watermarkbuddy.cache.ProbeCache
+
+    :return: watermark file of each variant and tmp files to delete later
+    :rtype: tuple[list[str], list[str]]
+    """
+    watermarks = []
+    scaled = {}
+    stream_data = None
+    for variant in variants:
+        watermark = variant["watermark_file"]
+        if variant["autoscale"] and not scale2ref:
+            if watermark not in scaled:
+                # probe input once for all variants
+                if stream_data is None:
+                    stream_data = get_stream_data(input_file, probe_cache)
+                scaled[watermark] = _prescale_watermark(stream_data, watermark, cache)
+            watermark = scaled[watermark]
+        watermarks.append(watermark)
+
+    tmp_watermarks = list(scaled.values()) if cache is None else []
+    return watermarks, tmp_watermarks
+
+
+def _detect_scale2ref():
+    """
+    Returns how the installed ffmpeg names the scale2ref expression variables,
+    see capabilities.get_capabilities.
+
+    :return: key of _SCALE2REF_EXPRESSIONS, None if scale2ref is unsupported
+    :rtype: str
+    """
+    try:
+        return capabilities.get_capabilities()["scale2ref"]
+    except RuntimeError:
+        return None
+
+
+def _get_filter_complex(overlay,
+                        blend_mode,
+                        scale2ref=None,
+                        main="[0:v]",
+                        watermark="[1:v]",
+                        base="[0:v]",
+                        output="",
+                        suffix="",
+                        enable=None):
+    """
+    Builds the ffmpeg filter graph applying the watermark on the input.
+
+    :param overlay: ffmpeg overlay syntax, see _get_overlay
+    :type overlay: str
+
+    :param blend_mode: video filter to apply watermark with
+    :type blend_mode: str
+
+    :param scale2ref: scale2ref expression to scale the watermark with
+    :type scale2ref: str
+
+    :param main: link label of the input to overlay the watermark on
+    :type main: str
+
+    :param watermark: link label of the watermark
+    :type watermark: str
+
+    :param base: link label of the input to blend the overlaid result with
+    :type base: str
+
+    :param output: link label of the graph output, empty for an unlabeled one
+    :type output: str
+
+    :param suffix: suffix of the intermediate link labels, to keep them unique
+    :type suffix: str
+
+    :param enable: timeline expression limiting when the watermark is applied,
+                   see _get_enable
+    :type enable: str
+
+    :rtype: str
+    """
+    if enable:
+        # outside the expression, overlay and blend pass the input through
+        overlay = "{}:enable='{}'".format(overlay, enable)
+        blend_mode = "{}:enable='{}'".format(blend_mode, enable)
+
+    if scale2ref:
+        fitler_complex = ("{watermark}{main}scale2ref={scale2ref}[wm{suffix}][ref{suffix}];"
+                          "[ref{suffix}][wm{suffix}]overlay={overlay}[over{suffix}];"
+                          "[over{suffix}]{base}blend=all_mode={blend_mode}{output}")
+    else:
+        fitler_complex = ("{main}{watermark}overlay={overlay}[over{suffix}];"
+                          "[over{suffix}]{base}blend=all_mode={blend_mode}{output}")
+    return fitler_complex.format(overlay=overlay,
+                                 blend_mode=blend_mode,
+                                 scale2ref=scale2ref,
+                                 main=main,
+                                 watermark=watermark,
+                                 base=base,
+                                 output=output,
+                                 suffix=suffix)
+
+
+def _get_enable(start=None, end=None):
+    """
+    Builds the ffmpeg timeline expression enabling a filter between two times.
+
+    :param start: time in seconds to start applying the filter from
+    :type start: float
+
+    :param end: time in seconds to stop applying the filter at
+    :type end: float
+
+    :return: timeline expression, None if the filter is always enabled
+    :rtype: str
+    """
+    if start is None and end is None:
+        return None
+    if end is None:
+        return "gte(t,{})".format(start)
+    if start is None:
+        return "lte(t,{})".format(end)
+    return "between(t,{},{})".format(start, end)
+
+
+def _get_windows(start=None, end=None, windows=None):
+    """
+    Returns the time windows to apply the watermark in.
+
+    :param start: time in seconds to start applying the watermark from
+    :type start: float
+
+    :param end: time in seconds to stop applying the watermark at
+    :type end: float
+
+    :param windows: start and end times of multiple windows, see add_watermark
+    :type windows: list[tuple[float, float]]
+
+    :return: start and end time of each window, empty if the watermark is
+             always applied
+    :rtype: list[tuple[float, float]]
+    """
+    if windows:
+        return [tuple(window) for window in windows]
+    if start is None and end is None:
+        return []
+    return [(start, end)]
+
+
+def _get_windows_enable(windows):
+    """
+    Builds the ffmpeg timeline expression enabling a filter within any of
+    multiple time windows.
+
+    :param windows: start and end time of each window
+    :type windows: list[tuple[float, float]]
+
+    :return: timeline expression, None if the filter is always enabled
+    :rtype: str
+    """
+    expressions = [_get_enable(start, end) for start, end in windows]
+    if not expressions or None in expressions:
+        return None
+    return "+".join(expressions)
+
+
+def _get_frame_count(file_path):
+    """
+    Returns the amount of frames of a watermark, counting them by decoding it
+    once as animated formats rarely store it. Counts are memoized on the
+    size and modification time of the file.
+
+    :param file_path: file to count the frames of
+    :type file_path: str
+
+    :rtype: int
+    """
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime)
+    if key not in _FRAME_COUNTS:
+        args = ["ffprobe",
+                "-v", "quiet",  # ensure no lib data gets printed
+                "-hide_banner",  # ensure no banner gets printed
+                "-select_streams", "v:0",  # read first video stream
+                "-count_frames",  # decode all frames to count them
+                "-show_entries", "stream=nb_read_frames",
+                "-print_format", "json",  # json string format
+                file_path]
+        with events.stage("probe"):
+            stream_data = json.loads(execute_cmd(args))["streams"][0]
+        _FRAME_COUNTS[key] = max(1, int(stream_data.get("nb_read_frames") or 1))
+    return _FRAME_COUNTS[key]
+
+
+def _get_fades(windows, fade_in, fade_out, duration):
+    """
+    Builds the ffmpeg filters fading the watermark in and out at the start and
+    end of each time window.
+
+    Each fade is only enabled within its window, as the fade filter hides the
+    frames before a fade in and after a fade out.
+
+    :param windows: start and end time of each window, empty for the whole
+                    input
+    :type windows: list[tuple[float, float]]
+
+    :param fade_in: duration of the fade in, in seconds
+    :type fade_in: float
+
+    :param fade_out: duration of the fade out, in seconds
+    :type fade_out: float
+
+    :param duration: duration of the input in seconds, None if unknown
+    :type duration: float
+
+    :raises ValueError: if fading out at the end of an input whose duration is
+                        unknown
+
+    :rtype: list[str]
+    """
+    filters = []
+    for start, end in windows or [(None, None)]:
+        start = start or 0
+        if end is None:
+            if fade_out and duration is None:
+                raise ValueError("fade out requires an end time or an input with a known duration")
+            end = duration
+        enable = _get_enable(start, end)
+        if fade_in:
+            filters.append("fade=t=in:st={}:d={}:alpha=1:enable='{}'".format(start, fade_in, enable))
+        if fade_out:
+            filters.append("fade=t=out:st={}:d={}:alpha=1:enable='{}'".format(end - fade_out, fade_out, enable))
+    return filters
+
+
+def _get_watermark_filters(frames, windows=None, fade_in=None, fade_out=None, duration=None):
+    """
+    Builds the ffmpeg filters looping the watermark for the duration of the
+    input, fading it in and out if requested.
+
+    The loop filter keeps the decoded frames of the watermark in memory and
+    replays them, so the watermark is decoded once however long the input is,
+    unlike the -stream_loop input option which decodes it again each loop.
+
+    :param frames: amount of frames of the watermark, see _get_frame_count
+    :type frames: int
+
+    :param windows: start and end time of each window, see _get_windows
+    :type windows: list[tuple[float, float]]
+
+    :param fade_in: duration of the fade in, in seconds
+    :type fade_in: float
+
+    :param fade_out: duration of the fade out, in seconds
+    :type fade_out: float
+
+    :param duration: duration of the input in seconds, None if unknown
+    :type duration: float
+
+    :rtype: str
+    """
+    filters = ["loop=loop=-1:size={}".format(frames)]
+    if fade_in or fade_out:
+        # fade the alpha channel only, keeping the colors of the watermark
+        filters.append("format=rgba")
+        filters.extend(_get_fades(windows, fade_in, fade_out, duration))
+    return ",".join(filters)
+
+
+def _get_animation(input_file,
+                   watermark_file,
+                   windows,
+                   fade_in=None,
+                   fade_out=None,
+                   loop_watermark=False,
+                   probe_cache=None):
+    """
+    Returns the filters looping and fading the watermark, if requested. Fades
+    loop the watermark, so a still image has frames to fade.
+
+    :param input_file: file to add watermark to
+    :type input_file: str
+
+    :param watermark_file: file to use as watermark, before scaling
+    :type watermark_file: str
+
+    :param windows: start and end time of each window, see _get_windows
+    :type windows: list[tuple[float, float]]
+
+    :param fade_in: see add_watermark
+    :type fade_in: float
+
+    :param fade_out: see add_watermark
+    :type fade_out: float
+
+    :param loop_watermark: see add_watermark
+    :type loop_watermark: bool
+
+    :param probe_cache: cache to reuse probed stream data from
+    :type probe_cache: watermarkbuddy.cache.ProbeCache
+
+    :return: filters, see _get_watermark_filters, None to apply the watermark
+             as is
+    :rtype: str
+    """
+    if not (loop_watermark or fade_in or fade_out):
+        return None
+
+    duration = None
+    if fade_out and any(end is None for _, end in windows or [(None, None)]):
+        duration = get_stream_data(input_file, probe_cache).get("duration")
+        duration = float(duration) if duration else None
+    return _get_watermark_filters(_get_frame_count(watermark_file), windows, fade_in, fade_out, duration)
+
+
+def _get_scale2ref_expression(single_pass):
+    """
+    Returns the scale2ref expression to autoscale the watermark in one pass.
+
+    :param single_pass: True to require single pass, False to disable it,
+                        None to use it when supported by ffmpeg
+    :type single_pass: bool
+
+    :raises RuntimeError: if single pass is required but unsupported
+
+    :return: scale2ref expression, None if scaling requires a separate pass
+    :rtype: str
+    """
+    if single_pass is False:
+        return None
+
+    variables = _detect_scale2ref()
+    if variables is None:
+        if single_pass:
+            raise RuntimeError("ffmpeg does not support scale2ref")
+        return None
+    return _SCALE2REF_EXPRESSIONS[variables]
+
+
+def _get_watermark_args(input_file,
+                        watermark,
+                        output_file,
+                        autoscale,
+                        position,
+                        offset_x,
+                        offset_y,
+                        blend_mode,
+                        scale2ref=None,
+                        encode_args=None,
+                        enable=None,
+                        watermark_filters=None):
+    """
+    Builds the ffmpeg command adding a watermark to a file.
+
+    :param input_file: file to add watermark to
+    :type input_file: str
+
+    :param watermark: file to use as watermark, already scaled if autoscaling
+                      without scale2ref
+    :type watermark: str
+
+    :param output_file: output file path
+    :type output_file: str
+
+    :param autoscale: set True to resize watermark to input file
+    :type autoscale: bool
+
+    :param position: initial position of the watermark
+    :type position: str
+
+    :param offset_x: X-axis offset of the watermark
+    :type offset_x: int
+
+    :param offset_y: Y-axis offset of the watermark
+    :type offset_y: int
+
+    :param blend_mode: video filter to apply watermark with
+    :type blend_mode: str
+
+    :param scale2ref: scale2ref expression to scale the watermark with
+    :type scale2ref: str
+
+    :param encode_args: ffmpeg arguments encoding the output, see
+                        _get_encode_args
+    :type encode_args: list[str]
+
+    :param enable: timeline expression limiting when the watermark is applied,
+                   see _get_enable
+    :type enable: str
+
+    :param watermark_filters: filters looping the watermark, see
+                              _get_watermark_filters
+    :type watermark_filters: str
+
+    :rtype: list[str]
+    """
+    if autoscale:
+        # build overlay top-left without offset
+        overlay = _get_overlay("top-left", offset_x=0, offset_y=0)
+    else:
+        # build overlay from position and offset
+        overlay = _get_overlay(position, offset_x=offset_x, offset_y=offset_y)
+
+    if watermark_filters:
+        # the looped watermark never ends, end with the input instead
+        overlay += ":shortest=1"
+        fitler_complex = "[1:v]{}[loop];".format(watermark_filters)
+        fitler_complex += _get_filter_complex(overlay,
+                                              blend_mode,
+                                              scale2ref=scale2ref,
+                                              watermark="[loop]",
+                                              enable=enable)
+    else:
+        fitler_complex = _get_filter_complex(overlay, blend_mode, scale2ref=scale2ref, enable=enable)
+
+    # build arguments
+    return (["ffmpeg",
+             "-hide_banner",  # hide ffmpeg version info
+             "-y",  # overwrite output without asking
+             "-i", input_file,  # source media
+             "-i", watermark,  # watermark
+             "-filter_complex", fitler_complex] +
+            list(encode_args or []) +
+            [output_file])
+
+
+def _get_encode_args(profile, input_file, output_file, threads=None):
+    """
+    Builds the ffmpeg arguments encoding the output with an encoding profile.
+
+    Audio is passed through unchanged when the input and output share their
+    container format, as the audio codec is known to fit the output.
+
+    :param profile: encoding profile, None to use the ffmpeg defaults
+    :type profile: str
+
+    :param input_file: file to add watermark to
+    :type input_file: str
+
+    :param output_file: output file path
+    :type output_file: str
+
+    :param threads: amount of threads ffmpeg may use, None or 0 for automatic
+    :type threads: int
+
+    :rtype: list[str]
+    """
+    if profile is None:
+        return ["-threads", str(threads)] if threads else []
+
+    ext = os.path.splitext(output_file)[1].lower()
+    output_type = _PROFILE_OUTPUT_TYPES.get(ext)
+    args = list(_PROFILES[profile].get(output_type, []))
+    args.extend(["-threads", str(threads or 0)])
+    if output_type in ("video", "webm") and os.path.splitext(input_file)[1].lower() == ext:
+        args.extend(["-c:a", "copy"])
+    return args
+
+
+def _add_watermark_ffmpeg(input_file,
+                          watermark_file,
+                          output_file,
+                          autoscale=False,
+                          position="top-left",
+                          offset_x=0,
+                          offset_y=0,
+                          blend_mode="normal",
+                          cache=None,
+                          single_pass=None,
+                          probe_cache=None,
+                          profile=None,
+                          threads=None,
+                          start=None,
+                          end=None,
+                          windows=None,
+                          fade_in=None,
+                          fade_out=None,
+                          loop_watermark=False):
+    """
+    Add a watermark to a file using ffmpeg, see add_watermark for the
+    arguments.
+    """
+    # to delete later
+    watermark = watermark_file
+    tmp_watermark = None
+    scale2ref = None
+    windows = _get_windows(start, end, windows)
+
+    if autoscale:
+        # scale watermark inside the filter graph if supported, otherwise
+        # create scaled version of watermark in a separate pass
+        scale2ref = _get_scale2ref_expression(single_pass)
+        if not scale2ref:
+            stream_data = get_stream_data(input_file, probe_cache)
+            watermark = _prescale_watermark(stream_data, watermark_file, cache)
+            if cache is None:
+                tmp_watermark = watermark
+
+    args = _get_watermark_args(input_file,
+                               watermark,
+                               output_file,
+                               autoscale,
+                               position,
+                               offset_x,
+                               offset_y,
+                               blend_mode,
+                               scale2ref,
+                               _get_encode_args(profile, input_file, output_file, threads),
+                               _get_windows_enable(windows),
+                               _get_animation(input_file,
+                                              watermark_file,
+                                              windows,
+                                              fade_in,
+                                              fade_out,
+                                              loop_watermark,
+                                              probe_cache))
+
+    # execute command
+    try:
+        with events.stage("encode"):
+            execute_cmd(args, progress=True)
+    finally:
+        # remove tmp scaled watermark
+        if tmp_watermark:
+            os.remove(tmp_watermark)
+
+
+def _get_pipe_format_args(format_hint, formats):
+    """
+    Returns the ffmpeg arguments to force the format of a piped stream.
+
+    :param format_hint: file extension or ffmpeg format name
+    :type format_hint: str
+
+    :param formats: ffmpeg arguments keyed by file extension
+    :type formats: dict[str, list[str]]
+
+    :rtype: list[str]
+    """
+    format_hint = format_hint.lower().lstrip(".")
+    return list(formats.get(format_hint, ["-f", format_hint]))
+
+
+def _execute_stream_cmd(args, input_stream, output_stream):
+    """
+    Executes a command in a subprocess, streaming data to its stdin and from
+    its stdout, see process.run.
 
     :param args: arguments representing the command to execute
     :type args: list
 
-    :raises RuntimeError: if an error occurred during the execution
+    :param input_stream: file-like object to feed to stdin
+    :type input_stream: io.RawIOBase
 
-    :return: stdout of the executed process
-    :rtype: str
+    :param output_stream: file-like object to write stdout to
+    :type output_stream: io.RawIOBase
+
+    :raises RuntimeError: if an error occurred during the execution
     """
-    proc = subprocess.Popen(args,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT)
-    stdout, _ = proc.communicate()
-    if proc.returncode != 0:
-        msg = stdout.rstrip("\n")
-        raise RuntimeError(msg)
-    return stdout
+    process.run(args, input_stream=input_stream, output_stream=output_stream)
 
 
 # =============================================================================
@@ -124,71 +963,213 @@ def validate_blend_mode(blend_mode):
         raise ValueError("invalid blend mode {!r}".format(blend_mode))
 
 
+def validate_time_range(start=None, end=None):
+    """
+    Validates the time range to apply the watermark in.
+
+    :param start: time in seconds to start applying the watermark from
+    :type start: float
+
+    :param end: time in seconds to stop applying the watermark at
+    :type end: float
+
+    :raises ValueError: if a time is negative or the range is empty
+    """
+    for value in (start, end):
+        if value is not None and (not isinstance(value, (int, float)) or value < 0):
+            raise ValueError("invalid time {!r}".format(value))
+    if start is not None and end is not None and end <= start:
+        raise ValueError("end time {!r} must be after start time {!r}".format(end, start))
+
+
+def validate_windows(windows):
+    """
+    Validates the time windows to apply the watermark in.
+
+    :param windows: start and end time of each window
+    :type windows: list[tuple[float, float]]
+
+    :raises ValueError: if a window is invalid
+    """
+    for window in windows:
+        if not isinstance(window, (tuple, list)) or len(window) != 2:
+            raise ValueError("invalid time window {!r}".format(window))
+        validate_time_range(*window)
+
+
+def validate_fade(fade):
+    """
+    Validates the duration of a fade.
+
+    :param fade: duration of the fade in seconds
+    :type fade: float
+
+    :raises ValueError: if the duration is not positive
+    """
+    if fade is not None and (not isinstance(fade, (int, float)) or fade <= 0):
+        raise ValueError("invalid fade duration {!r}".format(fade))
+
+
+def validate_timeline(start=None,
+                      end=None,
+                      windows=None,
+                      fade_in=None,
+                      fade_out=None,
+                      loop_watermark=False,
+                      backend="ffmpeg"):
+    """
+    Validates when and how the watermark is shown, see add_watermark for the
+    arguments.
+
+    :raises ValueError: if a time range or fade is invalid, or if the backend
+                        does not support them
+    """
+    validate_time_range(start, end)
+    validate_windows(windows or [])
+    validate_fade(fade_in)
+    validate_fade(fade_out)
+    if backend == "pillow" and (_get_windows(start, end, windows) or fade_in or fade_out or loop_watermark):
+        raise ValueError("time ranges, fades and loops require the ffmpeg backend")
+
+
+def validate_watermark(watermark_file, output_file, position, offset_x, offset_y, blend_mode):
+    """
+    Validates the watermark file, output path and settings of a watermark.
+
+    :param watermark_file: file to use as watermark
+    :type watermark_file: str
+
+    :param output_file: output file path
+    :type output_file: str
+
+    :param position: initial position of the watermark
+    :type position: str
+
+    :param offset_x: X-axis offset of the watermark
+    :type offset_x: int
+
+    :param offset_y: Y-axis offset of the watermark
+    :type offset_y: int
+
+    :param blend_mode: video filter to apply watermark with
+    :type blend_mode: str
+
+    :raises ValueError: if a file or directory does not exist or a setting
+                        is not supported
+    """
+    # validate dirs/files exists
+    if not os.path.exists(watermark_file):
+        msg = "watermark file does not exist: {}"
+        raise ValueError(msg.format(watermark_file))
+
+    output_dir = os.path.dirname(output_file)
+    if not os.path.exists(output_dir):
+        msg = "output directory does not exist: {}"
+        raise ValueError(msg.format(output_dir))
+
+    # validate values for ffmpeg
+    validate_position(position)
+    validate_offset(offset_x)
+    validate_offset(offset_y)
+    validate_blend_mode(blend_mode)
+
+
 def validate_ffmpeg():
     """
-    Validates ffmpeg is installed.
+    Validates ffmpeg is installed, using the cached capabilities of the
+    installed binaries, see capabilities.get_capabilities.
 
     :raises RuntimeError: if ffmpeg is not installed
     """
-    try:
-        _execute_cmd(["ffmpeg", "-version"])
-    except RuntimeError:
-        raise RuntimeError("ffmpeg not found")
+    capabilities.get_capabilities()
 
 
 def validate_ffprobe():
     """
-    Validates ffprobe is installed.
+    Validates ffprobe is installed, using the cached capabilities of the
+    installed binaries, see capabilities.get_capabilities.
 
     :raises RuntimeError: if ffprobe is not installed
     """
-    try:
-        _execute_cmd(["ffprobe", "-version"])
-    except RuntimeError:
+    if capabilities.get_capabilities()["ffprobe_version"] is None:
         raise RuntimeError("ffprobe not found")
 
 
+def terminate_processes():
+    """
+    Kills all running ffmpeg and ffprobe subprocesses, making the operations
+    which started them raise a RuntimeError. Used to cancel running jobs.
+
+    :return: amount of killed subprocesses
+    :rtype: int
+    """
+    return process.terminate_processes()
+
+
 def get_blend_modes():
     """
-    Returns the ffmpeg supported blend modes.
+    Returns the blend modes supported by the installed ffmpeg, falling back to
+    the ones of recent ffmpeg releases if ffmpeg is not found.
 
     More details: https://ffmpeg.org/ffmpeg-filters.html#blend_002c-tblend
 
     :rtype: list[str]
     """
-    return ["addition",
-            "grainmerge",
-            "and",
-            "average",
-            "burn",
-            "darken",
-            "difference",
-            "grainextract",
-            "divide",
-            "dodge",
-            "freeze",
-            "exclusion",
-            "extremity",
-            "glow",
-            "hardlight",
-            "hardmix",
-            "heat",
-            "lighten",
-            "linearlight",
-            "multiply",
-            "multiply128",
-            "negation",
-            "normal",
-            "or",
-            "overlay",
-            "phoenix",
-            "pinlight",
-            "reflect",
-            "screen",
-            "softlight",
-            "subtract",
-            "vividlight",
-            "xor"]
+    try:
+        blend_modes = capabilities.get_capabilities()["blend_modes"]
+    except RuntimeError:
+        blend_modes = None
+    return list(blend_modes or _BLEND_MODES)
+
+
+def validate_backend(backend):
+    """
+    Validates the backend used to composite the watermark.
+
+    :param backend: backend to validate
+    :type backend: str
+
+    :raises ValueError: if backend is not defined in supported list
+    """
+    if backend not in get_backends():
+        raise ValueError("invalid backend {!r}".format(backend))
+
+
+def validate_profile(profile):
+    """
+    Validates the encoding profile used to encode the output.
+
+    :param profile: encoding profile to validate, None for the ffmpeg defaults
+    :type profile: str
+
+    :raises ValueError: if profile is not defined in supported list
+    """
+    if profile is not None and profile not in get_profiles():
+        raise ValueError("invalid profile {!r}".format(profile))
+
+
+def get_profiles():
+    """
+    Returns the supported encoding profiles, from fastest to highest quality.
+
+    Profiles set the codec, preset and quality of video outputs, the quality
+    of still image outputs and pass audio through unchanged.
+
+    :rtype: list[str]
+    """
+    return ["fast", "balanced", "archive"]
+
+
+def get_backends():
+    """
+    Returns the supported backends to composite the watermark with.
+
+    ffmpeg supports any media, pillow composites still images in-process
+    using Pillow and numpy.
+
+    :rtype: list[str]
+    """
+    return ["ffmpeg", "pillow"]
 
 
 def get_positions():
@@ -200,6 +1181,45 @@ def get_positions():
     return ["top-left", "top-right", "bottom-left", "bottom-right"]
 
 
+def get_stream_data(file_path, cache=None):
+    """
+    Gets the video stream data of a file.
+
+    :param file_path: file to read
+    :type file_path: str
+
+    :param cache: cache to reuse probed stream data from
+    :type cache: watermarkbuddy.cache.ProbeCache
+
+    :rtype: dict
+    """
+    with events.stage("probe"):
+        if cache is not None:
+            return cache.get_stream_data(file_path)
+        return _probe_stream_data(file_path)
+
+
+def execute_cmd(args, progress=False):
+    """
+    Executes a command in a subprocess, see process.run.
+
+    :param args: arguments representing the command to execute
+    :type args: list
+
+    :param progress: set True to emit the progress of an ffmpeg command which
+                     does not write to stdout, if any event subscriber exists
+    :type progress: bool
+
+    :raises RuntimeError: if an error occurred during the execution
+
+    :return: stdout of the executed process
+    :rtype: bytes
+    """
+    if progress and events.is_enabled():
+        return process.run(args, progress=True)
+    return process.run(args, capture=True)
+
+
 def add_watermark(input_file,
                   watermark_file,
                   output_file,
@@ -207,7 +1227,19 @@ def add_watermark(input_file,
                   position="top-left",
                   offset_x=0,
                   offset_y=0,
-                  blend_mode="normal"):
+                  blend_mode="normal",
+                  cache=None,
+                  single_pass=None,
+                  probe_cache=None,
+                  backend="ffmpeg",
+                  profile=None,
+                  threads=None,
+                  start=None,
+                  end=None,
+                  windows=None,
+                  fade_in=None,
+                  fade_out=None,
+                  loop_watermark=False):
     """
     Add a watermark to a file.
 
@@ -234,83 +1266,268 @@ def add_watermark(input_file,
 
     :param blend_mode: video filter to apply watermark with
     :type blend_mode: str
+
+    :param cache: cache to reuse scaled watermarks from when autoscaling
+    :type cache: watermarkbuddy.cache.WatermarkCache
+
+    :param single_pass: set True to scale the watermark within the main ffmpeg
+                        filter graph, False to scale it in a separate pass
+                        first, None to pick single pass when ffmpeg supports it
+    :type single_pass: bool
+
+    :param probe_cache: cache to reuse probed stream data from when
+                        autoscaling in a separate pass
+    :type probe_cache: watermarkbuddy.cache.ProbeCache
+
+    :param backend: backend to composite with, see get_backends
+    :type backend: str
+
+    :param profile: encoding profile of the output, see get_profiles, None to
+                    use the ffmpeg defaults
+    :type profile: str
+
+    :param threads: amount of threads ffmpeg may use to encode, None for
+                    automatic
+    :type threads: int
+
+    :param start: time in seconds to start applying the watermark from, None
+                  to apply it from the start
+    :type start: float
+
+    :param end: time in seconds to stop applying the watermark at, None to
+                apply it until the end
+    :type end: float
+
+    :param windows: start and end times of multiple windows to apply the
+                    watermark in, either time None for the start or end of
+                    the input, replacing start and end
+    :type windows: list[tuple[float, float]]
+
+    :param fade_in: duration in seconds of fading the watermark in at the
+                    start of each window, None to show it right away
+    :type fade_in: float
+
+    :param fade_out: duration in seconds of fading the watermark out at the
+                     end of each window, None to hide it right away
+    :type fade_out: float
+
+    :param loop_watermark: set True to loop an animated watermark for the
+                           duration of the input, instead of holding its last
+                           frame, its frames are decoded once and kept in
+                           memory
+    :type loop_watermark: bool
+    """
+    # validate dirs/files exists
+    if not os.path.exists(input_file):
+        msg = "input file does not exist: {}"
+        raise ValueError(msg.format(input_file))
+
+    validate_watermark(watermark_file, output_file, position, offset_x, offset_y, blend_mode)
+    validate_backend(backend)
+    validate_profile(profile)
+    validate_timeline(start, end, windows, fade_in, fade_out, loop_watermark, backend)
+
+    with events.context(input_file=input_file):
+        if backend == "pillow":
+            # imported on demand as it depends on optional third party modules
+            from watermarkbuddy import compositor
+            with events.stage("composite"):
+                compositor.add_watermark(input_file,
+                                         watermark_file,
+                                         output_file,
+                                         autoscale=autoscale,
+                                         position=position,
+                                         offset_x=offset_x,
+                                         offset_y=offset_y,
+                                         blend_mode=blend_mode,
+                                         profile=profile)
+            return
+
+        _add_watermark_ffmpeg(input_file,
+                              watermark_file,
+                              output_file,
+                              autoscale=autoscale,
+                              position=position,
+                              offset_x=offset_x,
+                              offset_y=offset_y,
+                              blend_mode=blend_mode,
+                              cache=cache,
+                              single_pass=single_pass,
+                              probe_cache=probe_cache,
+                              profile=profile,
+                              threads=threads,
+                              start=start,
+                              end=end,
+                              windows=windows,
+                              fade_in=fade_in,
+                              fade_out=fade_out,
+                              loop_watermark=loop_watermark)
+
+
+def add_watermark_variants(input_file, variants, cache=None, single_pass=None, probe_cache=None, threads=None):
+    """
+    Add several watermark variants to a file, decoding it only once.
+
+    A single ffmpeg command splits the decoded input over one filter chain and
+    output per variant. Each variant is a dict holding the watermark_file and
+    output_file keys and optionally the autoscale, position, offset_x,
+    offset_y, blend_mode and profile keys, matching the arguments of
+    add_watermark.
+
+    :param input_file: file to add watermarks to
+    :type input_file: str
+
+    :param variants: watermark variants to create
+    :type variants: list[dict]
+
+    :param cache: cache to reuse scaled watermarks from when autoscaling
+    :type cache: watermarkbuddy.cache.WatermarkCache
+
+    :param single_pass: see add_watermark
+    :type single_pass: bool
+
+    :param probe_cache: see add_watermark
+    :type probe_cache: watermarkbuddy.cache.ProbeCache
+
+    :param threads: see add_watermark
+    :type threads: int
     """
     # validate dirs/files exists
     if not os.path.exists(input_file):
         msg = "input file does not exist: {}"
         raise ValueError(msg.format(input_file))
 
+    if not variants:
+        raise ValueError("no variants given")
+
+    variants = _get_variants(variants)
+
+    scale2ref = None
+    if any(variant["autoscale"] for variant in variants):
+        scale2ref = _get_scale2ref_expression(single_pass)
+
+    watermarks, tmp_watermarks = _get_variant_watermarks(input_file, variants, scale2ref, cache, probe_cache)
+    inputs = sorted(set(watermarks), key=watermarks.index)
+
+    fitler_complex = _get_variants_filter_complex(variants, watermarks, inputs, scale2ref)
+
+    # build arguments
+    args = ["ffmpeg",
+            "-hide_banner",  # hide ffmpeg version info
+            "-y",  # overwrite output without asking
+            "-i", input_file]  # source media
+    for watermark in inputs:
+        args.extend(["-i", watermark])
+    args.extend(["-filter_complex", fitler_complex])
+    for i, variant in enumerate(variants):
+        # keep audio of source media, if any
+        args.extend(["-map", "[out{}]".format(i), "-map", "0:a?"])
+        args.extend(_get_encode_args(variant["profile"], input_file, variant["output_file"], threads))
+        args.append(variant["output_file"])
+
+    # execute command
+    try:
+        with events.context(input_file=input_file), events.stage("encode"):
+            execute_cmd(args, progress=True)
+    finally:
+        # remove tmp scaled watermarks
+        for tmp_watermark in tmp_watermarks:
+            os.remove(tmp_watermark)
+
+
+def add_watermark_stream(input_stream,
+                         watermark_file,
+                         output_stream=None,
+                         input_format=None,
+                         output_format="png",
+                         autoscale=False,
+                         position="top-left",
+                         offset_x=0,
+                         offset_y=0,
+                         blend_mode="normal"):
+    """
+    Add a watermark to in-memory or piped media, streamed through ffmpeg.
+
+    No file is written to disk, the input is fed to ffmpeg's stdin and the
+    result is read from its stdout. As piped input cannot be probed upfront,
+    autoscale requires ffmpeg to support scale2ref.
+
+    :param input_stream: media to add watermark to
+    :type input_stream: bytes or io.RawIOBase
+
+    :param watermark_file: file to use as watermark
+    :type watermark_file: str
+
+    :param output_stream: file-like object to write the result to, if not
+                          given the result is returned
+    :type output_stream: io.RawIOBase
+
+    :param input_format: file extension or ffmpeg format name of the input,
+                         probed by ffmpeg if not given
+    :type input_format: str
+
+    :param output_format: file extension or ffmpeg format name of the output
+    :type output_format: str
+
+    :param autoscale: set True to resize watermark to input file
+    :type autoscale: bool
+
+    :param position: initial position of the watermark
+    :type position: str
+
+    :param offset_x: X-axis offset of the watermark
+    :type offset_x: int
+
+    :param offset_y: Y-axis offset of the watermark
+    :type offset_y: int
+
+    :param blend_mode: video filter to apply watermark with
+    :type blend_mode: str
+
+    :return: watermarked media if no output stream is given
+    :rtype: bytes
+    """
+    # validate watermark exists
     if not os.path.exists(watermark_file):
         msg = "watermark file does not exist: {}"
         raise ValueError(msg.format(watermark_file))
 
-    output_dir = os.path.dirname(output_file)
-    if not os.path.exists(output_dir):
-        msg = "output directory does not exist: {}"
-        raise ValueError(msg.format(output_dir))
-
     # validate values for ffmpeg
     validate_position(position)
     validate_offset(offset_x)
     validate_offset(offset_y)
     validate_blend_mode(blend_mode)
 
-    # set filters template
-    fitler_complex = ("[0:v]overlay={overlay}[over];"
-                      "[over][0:v]blend=all_mode={blend_mode}")
-    fitler_data = {"blend_mode": blend_mode}
-
-    # to delete later
-    watermark = watermark_file
-    tmp_watermark = None
-
+    scale2ref = None
     if autoscale:
-        # create tmp watermark file
-        ext = os.path.splitext(watermark_file)[1]
-        fp, tmp_watermark = tempfile.mkstemp(suffix=ext)
-
-        # create tmp scaled version of watermark
-        stream_data = _get_stream_data(input_file)
-        width = stream_data["width"]
-        sar = stream_data["sample_aspect_ratio"]
-        sar = sar.replace(":", "/")
-
-        tmp_filter = "scale={width}:{height},setsar={sar}"
-        tmp_filter = tmp_filter.format(width=width,
-                                       height=-1,
-                                       sar=sar)
-
-        # build arguments
-        args = ["ffmpeg",
-                "-hide_banner",
-                "-y",
-                "-i", watermark_file,
-                "-vf", tmp_filter,
-                tmp_watermark]
-        _execute_cmd(args)
-        watermark = tmp_watermark
-
-        # build overlay top-left without offset
+        scale2ref = _get_scale2ref_expression(True)
         overlay = _get_overlay("top-left", offset_x=0, offset_y=0)
     else:
-        # build overlay from position and offset
         overlay = _get_overlay(position, offset_x=offset_x, offset_y=offset_y)
-
-    fitler_data["overlay"] = overlay
-    fitler_complex = fitler_complex.format(**fitler_data)
+    fitler_complex = _get_filter_complex(overlay, blend_mode, scale2ref=scale2ref)
 
     # build arguments
     args = ["ffmpeg",
             "-hide_banner",  # hide ffmpeg version info
-            "-y",  # overwrite output without asking
-            "-i", input_file,  # source media
-            "-i", watermark,  # watermark
-            "-filter_complex", fitler_complex,
-            output_file]
+            "-v", "error"]  # only report errors
+    if input_format:
+        args.extend(_get_pipe_format_args(input_format, _PIPE_INPUT_FORMATS))
+    args.extend(["-i", "pipe:0",  # source media from stdin
+                 "-i", watermark_file,  # watermark
+                 "-filter_complex", fitler_complex])
+    args.extend(_get_pipe_format_args(output_format, _PIPE_OUTPUT_FORMATS))
+    args.append("pipe:1")  # write to stdout
+
+    if isinstance(input_stream, bytes):
+        input_stream = io.BytesIO(input_stream)
 
     # execute command
-    _execute_cmd(args)
+    if output_stream is not None:
+        with events.stage("encode"):
+            _execute_stream_cmd(args, input_stream, output_stream)
+        return None
 
-    # remove tmp scaled watermark
-    if tmp_watermark:
-        os.remove(tmp_watermark)
+    output_stream = io.BytesIO()
+    with events.stage("encode"):
+        _execute_stream_cmd(args, input_stream, output_stream)
+    return output_stream.getvalue()
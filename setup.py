@@ -3,6 +3,7 @@ import os
 import sys
 from setuptools import setup
 from setuptools import find_packages
+from setuptools.command.build_py import build_py
 
 # tool modules
 f = os.path.abspath(__file__)
@@ -11,7 +12,20 @@ sys.path.insert(0, package_dir)
 from watermarkbuddy import __version__  # noqa
 
 requirements_dev = ["flake8", "radon"]
-requirements_install = ["PySide2"]
+requirements_gui = ["PySide2"]
+requirements_image = ["numpy", "Pillow"]
+requirements_yaml = ["PyYAML"]
+requirements_install = []
+
+
+class BuildPy(build_py):
+    """Leaves out the asyncio api on Python versions unable to compile it."""
+
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info >= (3, 5):
+            return modules
+        return [module for module in modules if module[:2] != ("watermarkbuddy", "aio")]
 
 
 setup(name="watermarkbuddy",
@@ -23,6 +37,14 @@ setup(name="watermarkbuddy",
       url="https://github.com/cedricduriau/watermarkbuddy",
       packages=find_packages(where="python"),
       package_dir={"": "python"},
-      scripts=["bin/watermarkbuddy-cli", "bin/watermarkbuddy-gui"],
+      scripts=["bin/watermarkbuddy-cli",
+               "bin/watermarkbuddy-gui",
+               "bin/watermarkbuddy-bench",
+               "bin/watermarkbuddy-server",
+               "bin/watermarkbuddy-client"],
+      cmdclass={"build_py": BuildPy},
       install_requires=requirements_install,
-      extras_require={"dev": requirements_dev})
+      extras_require={"dev": requirements_dev,
+                      "gui": requirements_gui,
+                      "image": requirements_image,
+                      "yaml": requirements_yaml})